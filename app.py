@@ -1,10 +1,14 @@
 import os
+import time
 import logging
+
+_started = time.perf_counter()
+
 from flask import Flask
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Configure logging for debugging
-logging.basicConfig(level=logging.DEBUG)
+# LOG_LEVEL=DEBUG for verbose output while developing
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 # Create the Flask app
 app = Flask(__name__)
@@ -15,11 +19,55 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Log per-request peak memory for exports (most accurate under sync workers)
+app.config['REPORT_EXPORT_MEMORY'] = os.environ.get('REPORT_EXPORT_MEMORY', '').lower() in ('1', 'true', 'yes')
+
+# Content-addressed store for uploaded images
+app.config['MEDIA_FOLDER'] = os.environ.get('MEDIA_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'media'))
+# Uploads, generated images and their derivatives not used for MEDIA_MAX_AGE seconds
+# are deleted, least recently used first beyond MEDIA_MAX_BYTES (0 = no limit)
+app.config['MEDIA_MAX_BYTES'] = int(os.environ.get('MEDIA_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+app.config['MEDIA_MAX_AGE'] = int(os.environ.get('MEDIA_MAX_AGE', 30 * 24 * 60 * 60))
+
+# Disk cache for proxied Shutterstock previews
+app.config['PREVIEW_CACHE_FOLDER'] = os.environ.get('PREVIEW_CACHE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'previews'))
+app.config['PREVIEW_CACHE_MAX_BYTES'] = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['PREVIEW_CACHE_MAX_AGE'] = int(os.environ.get('PREVIEW_CACHE_MAX_AGE', 7 * 24 * 60 * 60))
+
+# Shared state of background generation jobs
+app.config['JOBS_FOLDER'] = os.environ.get('JOBS_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'jobs'))
+
+# Rate limit and circuit breaker state of the external APIs, shared by all workers
+app.config['UPSTREAM_STATE_FOLDER'] = os.environ.get('UPSTREAM_STATE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'upstreams'))
+
+# Finished exports keyed on the submitted canvas, format and options (EXPORT_CACHE=0 turns it off)
+app.config['EXPORT_CACHE'] = os.environ.get('EXPORT_CACHE', '1').lower() in ('1', 'true', 'yes')
+app.config['EXPORT_CACHE_FOLDER'] = os.environ.get('EXPORT_CACHE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'exports'))
+app.config['EXPORT_CACHE_MAX_BYTES'] = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['EXPORT_CACHE_MAX_AGE'] = int(os.environ.get('EXPORT_CACHE_MAX_AGE', 24 * 60 * 60))
+
+# Fingerprinted static assets: gzip/brotli variants, written by `python assets.py` or on first use
+app.config['ASSET_BUILD_FOLDER'] = os.environ.get('ASSET_BUILD_FOLDER', os.path.join('build', 'assets'))
+
+# Seconds between storage sweeps (0 = never sweep)
+app.config['STORAGE_SWEEP_INTERVAL'] = int(os.environ.get('STORAGE_SWEEP_INTERVAL', 600))
+
+# Per-worker metric snapshots, added up by /metrics (empty keeps metrics per worker)
+app.config['METRICS_FOLDER'] = os.environ.get('METRICS_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'metrics'))
+
+# Save sampled stacks of requests slower than this many seconds (0 = off)
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS', 0))
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'))
+
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Import routes after app creation to avoid circular imports
 from routes import *
 
+# Run `python perf.py` for a per-module breakdown of this number
+app.logger.info(f'Application loaded in {(time.perf_counter() - _started) * 1000:.0f} ms')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
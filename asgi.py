@@ -0,0 +1,441 @@
+"""
+ASGI entry point, for serving with an event loop instead of sync workers
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+Needs the `async` extra (uvicorn, a2wsgi, httpx). The routes that mostly wait
+on Shutterstock or Gemini run as coroutines, so thousands of them can be in
+flight per process: stock search, preview proxying, text generation and the
+job events stream. Calls to each upstream are capped by a semaphore
+(SHUTTERSTOCK_CONCURRENCY, GEMINI_CONCURRENCY); requests that wait longer than
+UPSTREAM_QUEUE_TIMEOUT for a slot get a 503, and calls running longer than
+SHUTTERSTOCK_TIMEOUT / GEMINI_TIMEOUT a 504.
+
+Blocking file I/O on the way (guard state, cache and blob files, job
+records) is done on threads with asyncio.to_thread.
+
+Every other route is the unchanged Flask app, run on a thread pool
+(ASGI_WSGI_THREADS). Exports get their own pool (ASGI_EXPORT_THREADS) so
+CPU-bound Pillow and ReportLab work neither blocks the event loop nor
+starves the quick routes; batch exports still fan out to their process pool.
+"""
+import os
+import re
+import json
+import math
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from app import app as flask_app
+import routes
+import shutterstock_api
+from shutterstock_api import get_async_shutterstock_client, is_preview_url
+from gemini import GeminiError, TEXT_TYPES, is_stubbed, genai_client, GeminiTextClient, StubTextClient, classify_error
+from upstream_guard import UpstreamUnavailable
+from jobs import ACTIVE_STATES
+from metrics import registry as metrics_registry, phase, start_request, finish_request, record_request
+
+EXPORT_PATHS = ('/export-image', '/export-pdf', '/export-batch')
+
+# How often an events stream re-reads its job record
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 0.5))
+JOB_PING_INTERVAL = 15
+
+upstream_rejections = metrics_registry.counter(
+    'upstream_queue_rejections_total', 'Requests turned away because an upstream had no free slot', ('upstream',))
+
+
+class UpstreamBusy(Exception):
+    """No free slot for an upstream within the queue timeout"""
+
+
+class UpstreamLimit:
+    """Caps concurrent calls to one upstream and bounds how long each may take"""
+
+    def __init__(self, name, concurrency, queue_timeout, timeout):
+        self.name = name
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @asynccontextmanager
+    async def slot(self):
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            upstream_rejections.inc(self.name)
+            raise UpstreamBusy(self.name)
+        try:
+            # Raises TimeoutError when the call overruns
+            async with asyncio.timeout(self.timeout):
+                yield
+        finally:
+            self._semaphore.release()
+
+
+shutterstock_limit = UpstreamLimit(
+    'shutterstock',
+    concurrency=int(os.environ.get('SHUTTERSTOCK_CONCURRENCY', 200)),
+    queue_timeout=float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 5)),
+    timeout=float(os.environ.get('SHUTTERSTOCK_TIMEOUT', 30))
+)
+
+gemini_limit = UpstreamLimit(
+    'gemini',
+    concurrency=int(os.environ.get('GEMINI_CONCURRENCY', 50)),
+    queue_timeout=float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 5)),
+    timeout=float(os.environ.get('GEMINI_TIMEOUT', 60))
+)
+
+
+class LimitedTextClient:
+    """Text client whose model calls (cache misses only) go through gemini_limit"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def generate_variants_async(self, prompt, text_type, count):
+        async with gemini_limit.slot():
+            return await self.client.generate_variants_async(prompt, text_type, count)
+
+
+def async_text_client():
+    """Raises GeminiError when Gemini is not configured"""
+    if is_stubbed():
+        return LimitedTextClient(StubTextClient(float(os.environ.get('GEMINI_STUB_LATENCY', 0.5))))
+    return LimitedTextClient(GeminiTextClient(genai_client()))
+
+
+class Request:
+    """The parts of an ASGI HTTP request the coroutine routes need"""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        # Set when a route hands the request to Flask after all
+        self.delegated = False
+
+    @property
+    def content_length(self):
+        value = self.headers.get('content-length', '')
+        return int(value) if value.isdigit() else None
+
+    async def body(self):
+        limit = flask_app.config['MAX_CONTENT_LENGTH']
+        chunks, size = [], 0
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if limit and size > limit:
+                raise ValueError('Request body too large')
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def json(self):
+        """The JSON body, or None when it is missing or invalid (like request.get_json(silent=True))"""
+        with phase('parse_json'):
+            try:
+                return json.loads(await self.body() or b'null')
+            except ValueError:
+                return None
+
+    def session_user(self):
+        """The uid from Flask's signed session cookie, or None"""
+        cookie = SimpleCookie(self.headers.get('cookie', ''))
+        morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        if morsel is None or serializer is None:
+            return None
+        try:
+            data = serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        return data.get('uid')
+
+
+async def send_start(send, status, content_type, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1'))]
+                   + [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    })
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send_start(send, status, 'application/json', list(headers) + [('content-length', str(len(body)))])
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_unavailable(send, error, message):
+    """503 for a call refused by an upstream's rate limit or open breaker (routes.upstream_unavailable)"""
+    await send_json(send, {'error': message}, 503, [('retry-after', str(math.ceil(error.retry_after)))])
+
+
+async def shutterstock_search(request, send):
+    """Search Shutterstock for stock images (routes.shutterstock_search without a blocked worker)"""
+    query = request.args.get('query', '')
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = min(int(request.args.get('per_page', 20)), 50)
+    except ValueError:
+        return await send_json(send, {'error': 'Invalid page or per_page'}, 400)
+    orientation = request.args.get('orientation')
+
+    if not query:
+        return await send_json(send, {'error': 'Search query is required'}, 400)
+
+    async def fetch_results():
+        shutterstock = get_async_shutterstock_client()
+        async with shutterstock_limit.slot():
+            results = await shutterstock.search_images(query=query, page=page, per_page=per_page, orientation=orientation)
+        with phase('format'):
+            return routes.format_search_results(results)
+
+    cache_key = routes.search_cache_key(query, page, per_page, orientation)
+    try:
+        formatted_results = await routes.search_cache.get_or_compute_async(cache_key, fetch_results)
+    except Exception as e:
+        # Shutterstock is failing, busy or refused by its breaker: answer with an expired copy if there is one
+        stale_results = await routes.search_cache.get_stale_async(cache_key)
+        if stale_results is not None:
+            flask_app.logger.warning(f"Serving stale search results: {str(e)}")
+            return await send_json(send, dict(stale_results, stale=True))
+        if isinstance(e, UpstreamUnavailable):
+            return await send_unavailable(send, e, 'Stock image search is temporarily unavailable, please retry')
+        if isinstance(e, UpstreamBusy):
+            return await send_json(send, {'error': 'Stock image search is busy, please retry'}, 503, [('retry-after', '1')])
+        if isinstance(e, TimeoutError):
+            return await send_json(send, {'error': 'Stock image search timed out'}, 504)
+        if isinstance(e, ValueError):
+            return await send_json(send, {'error': 'Shutterstock API credentials not configured'}, 503)
+        flask_app.logger.error(f"Shutterstock search error: {str(e)}")
+        return await send_json(send, {'error': 'Failed to search stock images'}, 500)
+    await send_json(send, formatted_results)
+
+
+def store_preview(writer, content_type, image_url):
+    """Publish a streamed preview and point its ref at it (may evict, so never on the event loop)"""
+    digest = writer.commit({'content_type': content_type, 'source': image_url})
+    routes.preview_store.set_ref(f'preview:{image_url}', digest)
+
+
+async def shutterstock_preview(request, send):
+    """Proxy a Shutterstock preview, streaming it through the disk cache; cache hits are served by Flask"""
+    image_url = request.args.get('url')
+    if not image_url:
+        return await send_json(send, {'error': 'Image URL is required'}, 400)
+    if not is_preview_url(image_url):
+        return await send_json(send, {'error': 'Invalid image URL'}, 400)
+
+    # Hits need conditional and Range handling, which send_blob already does
+    if await asyncio.to_thread(routes.preview_store.get_ref, f'preview:{image_url}'):
+        request.delegated = True
+        return await flask_bridge(request.scope, request.receive, send)
+
+    started = False
+    try:
+        shutterstock = get_async_shutterstock_client()
+        async with shutterstock_limit.slot():
+            upstream = await shutterstock.open_image_preview(image_url)
+            try:
+                content_type = upstream.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+                if not content_type.startswith('image/'):
+                    return await send_json(send, {'error': 'Upstream did not return an image'}, 502)
+
+                headers = [('cache-control', 'public, max-age=86400')]
+                if upstream.headers.get('Content-Length') and not upstream.headers.get('Content-Encoding'):
+                    headers.append(('content-length', upstream.headers['Content-Length']))
+                await send_start(send, 200, content_type, headers)
+                started = True
+
+                # Write-through: every chunk goes to the client and, on a thread, to the cache file
+                writer = await asyncio.to_thread(routes.preview_store.writer)
+                try:
+                    async for chunk in upstream.aiter_bytes(routes.PREVIEW_CHUNK_SIZE):
+                        await asyncio.gather(
+                            asyncio.to_thread(writer.write, chunk),
+                            send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                        )
+                    await asyncio.to_thread(store_preview, writer, content_type, image_url)
+                finally:
+                    await asyncio.to_thread(writer.discard)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                await upstream.aclose()
+    except Exception as e:
+        if started:
+            # Headers are out; dropping the connection is the only way to signal the failure
+            raise
+        if isinstance(e, UpstreamUnavailable):
+            return await send_unavailable(send, e, 'Image download is temporarily unavailable, please retry')
+        if isinstance(e, UpstreamBusy):
+            return await send_json(send, {'error': 'Image download is busy, please retry'}, 503, [('retry-after', '1')])
+        if isinstance(e, TimeoutError):
+            return await send_json(send, {'error': 'Image download timed out'}, 504)
+        if isinstance(e, ValueError):
+            return await send_json(send, {'error': 'Shutterstock API credentials not configured'}, 503)
+        flask_app.logger.error(f"Shutterstock preview error: {str(e)}")
+        return await send_json(send, {'error': 'Failed to download image'}, 500)
+
+
+async def generate_text(request, send):
+    """Generate text content using Google Gemini (routes.generate_text on the SDK's asyncio client)"""
+    try:
+        data = await request.json() or {}
+        prompt = str(data.get('prompt', '')).strip()
+        text_type = data.get('type', 'title')
+        if text_type not in TEXT_TYPES:
+            text_type = 'subtitle'
+
+        try:
+            variant = max(int(data.get('variant', 0)), 0)
+        except (TypeError, ValueError):
+            variant = 0
+
+        if not prompt:
+            return await send_json(send, {'error': 'Prompt is required'}, 400)
+
+        generated, variant, cached = await routes.text_variants.get_async(prompt, text_type, variant, async_text_client)
+
+        result = {'success': True, 'variant': variant, 'cached': cached}
+        if text_type == 'both':
+            result.update(title=generated['title'], subtitle=generated['subtitle'])
+        else:
+            result['text'] = generated
+        await send_json(send, result)
+
+    except GeminiError as e:
+        await send_json(send, {'error': e.message}, e.status)
+    except UpstreamUnavailable as e:
+        await send_unavailable(send, e, 'Text generation is temporarily unavailable, please retry')
+    except UpstreamBusy:
+        await send_json(send, {'error': 'Text generation is busy, please retry'}, 503, [('retry-after', '1')])
+    except TimeoutError:
+        await send_json(send, {'error': 'Text generation timed out'}, 504)
+    except Exception as e:
+        flask_app.logger.error(f"Gemini text generation error: {str(e)}")
+        error = classify_error(e, 'Text generation', 'text')
+        await send_json(send, {'error': error.message}, error.status)
+
+
+def job_event(job):
+    # job_payload builds URLs with url_for, which needs a request context
+    with flask_app.test_request_context():
+        return f'event: status\ndata: {json.dumps(routes.job_payload(job))}\n\n'.encode('utf-8')
+
+
+async def generation_job_events(request, send, job_id):
+    """Server-Sent Events for a generation job, holding no thread while the job runs"""
+    job = await asyncio.to_thread(routes.generation_jobs.get, job_id)
+    if job is None or job['user'] != request.session_user():
+        return await send_json(send, {'success': False, 'error': 'Job not found'}, 404)
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await request.receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await send_start(send, 200, 'text/event-stream', [('cache-control', 'no-store'), ('x-accel-buffering', 'no')])
+        await send({'type': 'http.response.body', 'body': job_event(job), 'more_body': True})
+        deadline = time.time() + routes.JOB_EVENTS_TIMEOUT
+        last_sent = time.time()
+        while job['status'] in ACTIVE_STATES and time.time() < deadline and not disconnected.is_set():
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            latest = await asyncio.to_thread(routes.generation_jobs.get, job_id)
+            if latest is None:
+                break
+            if latest['updated'] != job['updated'] or latest['status'] != job['status']:
+                job = latest
+                await send({'type': 'http.response.body', 'body': job_event(job), 'more_body': True})
+                last_sent = time.time()
+            elif time.time() - last_sent >= JOB_PING_INTERVAL:
+                # Keep-alive comment so proxies do not drop an idle stream
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                last_sent = time.time()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+
+# (method, path pattern, metrics endpoint name, coroutine); path groups are passed to the route
+ROUTES = [
+    ('GET', re.compile(r'/api/shutterstock/search'), 'shutterstock_search', shutterstock_search),
+    ('GET', re.compile(r'/api/shutterstock/preview'), 'shutterstock_preview', shutterstock_preview),
+    ('POST', re.compile(r'/api/gemini/generate-text'), 'generate_text', generate_text),
+    ('GET', re.compile(r'/api/gemini/jobs/([0-9a-f]{32})/events'), 'generation_job_events', generation_job_events),
+]
+
+flask_bridge = WSGIMiddleware(flask_app, workers=int(os.environ.get('ASGI_WSGI_THREADS', 32)))
+export_bridge = WSGIMiddleware(flask_app, workers=int(os.environ.get('ASGI_EXPORT_THREADS', os.cpu_count() or 2)))
+
+
+async def run_route(endpoint, route, request, send, params):
+    """Run a coroutine route with the same metrics and Server-Timing header as the Flask routes"""
+    timer = start_request(endpoint)
+    state = {'status': 500, 'bytes': 0}
+
+    async def instrumented_send(message):
+        if message['type'] == 'http.response.start':
+            state['status'] = message['status']
+            if timer.phases:
+                message = dict(message, headers=list(message['headers']) + [(b'server-timing', timer.server_timing().encode('latin-1'))])
+        elif message['type'] == 'http.response.body':
+            state['bytes'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        await route(request, instrumented_send, *params)
+    finally:
+        finish_request()
+        # Flask records the requests it ends up serving itself
+        if not request.delegated:
+            record_request(timer, request.method, state['status'], request.content_length, state['bytes'])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if shutterstock_api._async_client is not None:
+                await shutterstock_api._async_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    for method, pattern, endpoint, route in ROUTES:
+        match = pattern.fullmatch(scope['path'])
+        if match and scope['method'] == method:
+            return await run_route(endpoint, route, Request(scope, receive), send, match.groups())
+
+    if scope['path'] in EXPORT_PATHS:
+        return await export_bridge(scope, receive, send)
+    return await flask_bridge(scope, receive, send)
@@ -0,0 +1,187 @@
+"""
+Fingerprinted static assets and cached pages
+
+Every file under static/ is also served at /assets/<name>.<content hash>.<ext>.
+Because that URL changes whenever the file does, it is served with a
+one-year immutable Cache-Control, and repeat visits load the editor without
+a single revalidation. Text assets (JS, CSS, SVG, JSON) get gzip and, with
+the brotli package installed, br variants in ASSET_BUILD_FOLDER, chosen
+from Accept-Encoding.
+
+Hashes are computed at startup (static/ is small). Compressed variants are
+written on first request, or ahead of time by the deploy step:
+
+    python assets.py
+
+Rendered pages are kept per worker with their compressed bodies, since the
+templates only change on deploy.
+"""
+import os
+import sys
+import gzip
+import hashlib
+import tempfile
+import threading
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASH_LENGTH = 12
+
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.svg', '.json', '.txt', '.map')
+
+# Preferred first; gzip is always available
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def choose_encoding(accept_encodings, available):
+    """Best of the available encodings the client accepts (Werkzeug's request.accept_encodings), or None"""
+    for encoding in ENCODINGS:
+        if encoding in available and accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+class Asset:
+    """One static file and its fingerprinted name"""
+
+    def __init__(self, name, path, digest):
+        self.name = name
+        self.path = path
+        self.digest = digest
+        stem, extension = os.path.splitext(name)
+        self.hashed_name = f'{stem}.{digest}{extension}'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.compressible = extension.lower() in COMPRESSIBLE_EXTENSIONS
+
+
+class AssetManifest:
+    """Content hashes of the static folder, and the compressed variants in build_folder"""
+
+    def __init__(self, static_folder, build_folder):
+        self.static_folder = static_folder
+        self.build_folder = build_folder
+        self.scan()
+
+    def scan(self):
+        """(Re)hash every file under the static folder"""
+        assets = {}
+        for directory, _, files in os.walk(self.static_folder):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+                assets[name] = Asset(name, path, digest)
+        self.assets = assets
+        self.by_hashed_name = {asset.hashed_name: asset for asset in assets.values()}
+
+    def hashed_name(self, name):
+        """Fingerprinted name of a static file, or None if there is no such file"""
+        asset = self.assets.get(name)
+        return asset.hashed_name if asset else None
+
+    def lookup(self, hashed_name):
+        return self.by_hashed_name.get(hashed_name)
+
+    def variant_path(self, asset, encoding):
+        return os.path.join(self.build_folder, f'{asset.hashed_name}.{"br" if encoding == "br" else "gz"}')
+
+    def variant(self, asset, encoding):
+        """Path of a compressed copy of asset, written on first use"""
+        path = self.variant_path(asset, encoding)
+        if os.path.exists(path):
+            return path
+        with open(asset.path, 'rb') as f:
+            data = compress(f.read(), encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def resolve(self, asset, accept_encodings):
+        """Return (file path, content encoding or None) to send for asset"""
+        if asset.compressible:
+            encoding = choose_encoding(accept_encodings, ENCODINGS)
+            if encoding:
+                return self.variant(asset, encoding), encoding
+        return asset.path, None
+
+    def build(self):
+        """
+        Write every compressed variant ahead of time and delete those of
+        earlier versions; returns (asset, encoding, bytes) rows
+        """
+        rows = []
+        current = set()
+        for asset in self.assets.values():
+            if not asset.compressible:
+                continue
+            for encoding in ENCODINGS:
+                path = self.variant(asset, encoding)
+                current.add(os.path.abspath(path))
+                rows.append((asset, encoding, os.path.getsize(path)))
+        for directory, _, files in os.walk(self.build_folder):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                if os.path.abspath(path) not in current:
+                    os.remove(path)
+        return rows
+
+
+class CachedPage:
+    """A rendered page with its compressed bodies and ETag"""
+
+    def __init__(self, html):
+        body = html.encode('utf-8')
+        self.etag = hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+        self.bodies = {None: body}
+        for encoding in ENCODINGS:
+            self.bodies[encoding] = compress(body, encoding)
+
+
+class PageCache:
+    """Rendered pages by name, built once per worker"""
+
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, render):
+        page = self._pages.get(name)
+        if page is None:
+            with self._lock:
+                page = self._pages.get(name)
+                if page is None:
+                    page = self._pages[name] = CachedPage(render())
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def main():
+    from app import app
+
+    manifest = AssetManifest(app.static_folder, app.config['ASSET_BUILD_FOLDER'])
+    print(f"{'asset':<40}{'encoding':>10}{'bytes':>10}{'original':>10}")
+    for asset, encoding, size in manifest.build():
+        print(f'{asset.hashed_name:<40}{encoding:>10}{size:>10}{os.path.getsize(asset.path):>10}')
+    if not brotli:
+        print('brotli is not installed; only gzip variants were built', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
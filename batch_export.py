@@ -0,0 +1,352 @@
+"""
+Batch export: one decoded canvas fanned out to many sizes and formats
+
+The source is decoded (or rendered from scene JSON) once in the request and
+its RGBA pixels are written to a temporary file that pool workers map
+read-only, so every resize/encode job starts from the same pixels without
+decoding again or pickling the image per job. Results are streamed back as
+a ZIP archive in completion order.
+"""
+import io
+import os
+import json
+import mmap
+import time
+import logging
+import tempfile
+import threading
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+from encoders import FORMATS, EncoderError, encode, resolve_preset
+
+logger = logging.getLogger(__name__)
+
+# Named output sizes, matching the editor's orientations (1.91:1, 1:1, 4:5)
+SIZE_PRESETS = {
+    'horizontal': (1200, 628),
+    'square': (1080, 1080),
+    'vertical': (1080, 1350),
+}
+
+# format -> (Pillow format or 'PDF', file extension, MIME type)
+OUTPUT_FORMATS = dict(FORMATS, pdf=('PDF', 'pdf', 'application/pdf'))
+
+# contain pads to the target aspect ratio, cover crops to it
+FIT_MODES = ('contain', 'cover')
+
+MAX_OUTPUTS = int(os.environ.get('BATCH_EXPORT_MAX_OUTPUTS', 24))
+MAX_DIMENSION = int(os.environ.get('BATCH_EXPORT_MAX_DIMENSION', 8192))
+
+
+def default_workers():
+    """
+    The CPU count split between the web workers on this machine
+
+    Each gunicorn worker starts its own pool, so a pool per worker sized to
+    every core would run WEB_CONCURRENCY times more encoders than there are
+    cores. WEB_CONCURRENCY is gunicorn's default worker count.
+    """
+    try:
+        web_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    except ValueError:
+        web_workers = 1
+    return max(1, (os.cpu_count() or 1) // max(web_workers, 1))
+
+
+MAX_WORKERS = int(os.environ.get('BATCH_EXPORT_WORKERS', 0)) or default_workers()
+
+# Decoded pixels go to RAM-backed /dev/shm where available
+PIXEL_DIR = os.environ.get('BATCH_EXPORT_TMP') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+# Rows copied per write when spilling pixels, to avoid a second full-size buffer
+STRIP_ROWS = 256
+
+
+class BatchExportError(ValueError):
+    """Raised for batch export requests that cannot be fulfilled"""
+
+
+def _as_list(value):
+    """Accept 'png,jpeg' or ['png', 'jpeg']"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)):
+        raise BatchExportError('Expected a list or comma separated string')
+    return [str(item).strip().lower() for item in value if str(item).strip()]
+
+
+def _parse_size(size):
+    """Return (label, width, height); width and height are None for the original size"""
+    if isinstance(size, (list, tuple)) and len(size) == 2:
+        size = f'{size[0]}x{size[1]}'
+    size = str(size or 'original').strip().lower()
+    if size == 'original':
+        return 'original', None, None
+    if size in SIZE_PRESETS:
+        return (size,) + SIZE_PRESETS[size]
+    try:
+        width, height = (int(part) for part in size.split('x'))
+    except ValueError:
+        raise BatchExportError(f'Unknown size: {size}')
+    if not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+        raise BatchExportError(f'Size {size} is outside 1..{MAX_DIMENSION} pixels')
+    return size, width, height
+
+
+def parse_outputs(options):
+    """
+    Normalize the requested outputs
+
+    Either an explicit 'outputs' list of {"format", "size", "fit", "preset"} entries
+    (also accepted as a JSON string in the query string), or the cross
+    product of 'formats' and 'sizes'. Sizes are 'original', a preset name
+    or 'WIDTHxHEIGHT'. A top-level 'preset' applies to entries without one.
+    """
+    outputs = options.get('outputs')
+    if isinstance(outputs, str):
+        try:
+            outputs = json.loads(outputs)
+        except ValueError:
+            raise BatchExportError('outputs must be a JSON list')
+    if outputs is None:
+        fit = options.get('fit', 'contain')
+        outputs = [
+            {'format': fmt, 'size': size, 'fit': fit}
+            for size in (_as_list(options.get('sizes')) or ['original'])
+            for fmt in (_as_list(options.get('formats')) or ['png'])
+        ]
+    if not isinstance(outputs, list) or not outputs:
+        raise BatchExportError('No outputs requested')
+
+    members = []
+    seen = set()
+    for output in outputs:
+        if not isinstance(output, dict):
+            raise BatchExportError('Each output must be an object')
+        fmt = str(output.get('format', 'png')).lower()
+        if fmt not in OUTPUT_FORMATS:
+            raise BatchExportError(f'Unsupported format: {fmt}')
+        fit = str(output.get('fit', 'contain')).lower()
+        if fit not in FIT_MODES:
+            raise BatchExportError(f'Unsupported fit: {fit}')
+        label, width, height = _parse_size(output.get('size'))
+        try:
+            preset = resolve_preset(output.get('preset', options.get('preset')))
+        except EncoderError as e:
+            raise BatchExportError(str(e))
+
+        key = (OUTPUT_FORMATS[fmt][0], width, height, fit, preset)
+        if key in seen:
+            continue
+        seen.add(key)
+        members.append({'format': fmt, 'label': label, 'width': width, 'height': height, 'fit': fit, 'preset': preset})
+
+    if len(members) > MAX_OUTPUTS:
+        raise BatchExportError(f'At most {MAX_OUTPUTS} outputs per batch')
+    return members
+
+
+def resolve_sizes(members, original_size):
+    """Fill in the original size and give every member a unique archive name"""
+    names = set()
+    for member in members:
+        if member['width'] is None:
+            member['width'], member['height'] = original_size
+        extension = OUTPUT_FORMATS[member['format']][1]
+        dimensions = f"{member['width']}x{member['height']}"
+        stem = 'template_ad_' + (dimensions if member['label'] == dimensions else f"{member['label']}_{dimensions}")
+        if member['fit'] != 'contain':
+            stem += f"_{member['fit']}"
+        name = f'{stem}.{extension}'
+        counter = 1
+        while name in names:
+            counter += 1
+            name = f'{stem}_{counter}.{extension}'
+        names.add(name)
+        member['name'] = name
+    return members
+
+
+def render_multiplier(members, width, height, base=1.0):
+    """Scene render scale large enough that no sized output has to be upscaled"""
+    scale = base
+    for member in members:
+        if member['width'] is not None:
+            scale = max(scale, member['width'] / width, member['height'] / height)
+    return scale
+
+
+class PixelBuffer:
+    """Decoded RGBA pixels in a temporary file that pool workers map read-only"""
+
+    def __init__(self, image, directory=PIXEL_DIR):
+        if image.mode != 'RGBA':
+            raise ValueError('PixelBuffer expects an RGBA image')
+        self.size = image.size
+        fd, self.path = tempfile.mkstemp(prefix='batch-', suffix='.rgba', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for top in range(0, image.height, STRIP_ROWS):
+                    f.write(image.crop((0, top, image.width, min(top + STRIP_ROWS, image.height))).tobytes())
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def fit_image(image, size, fit):
+    """Resize to exactly size, padding (contain) or cropping (cover) to its aspect ratio"""
+    if image.size == size:
+        return image.copy()
+    if fit == 'cover':
+        return ImageOps.fit(image, size, Image.LANCZOS)
+    return ImageOps.pad(image, size, Image.LANCZOS, color=(0, 0, 0, 0))
+
+
+def encode_member(image, fmt, preset=None):
+    """Encode an RGBA image as one batch output"""
+    if OUTPUT_FORMATS[fmt][0] != 'PDF':
+        return encode(image, fmt, preset).getvalue()
+    
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
+    from pdf_renderer import POINTS_PER_PIXEL
+    
+    output = io.BytesIO()
+    page = (image.width * POINTS_PER_PIXEL, image.height * POINTS_PER_PIXEL)
+    pdf = canvas.Canvas(output, pagesize=page, pageCompression=1)
+    pdf.drawImage(ImageReader(image), 0, 0, page[0], page[1], mask='auto')
+    pdf.showPage()
+    pdf.save()
+    return output.getvalue()
+
+
+def render_member(pixel_path, source_size, member):
+    """Pool job: map the shared pixels, fit them to the member size and encode"""
+    with open(pixel_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pixels:
+        source = Image.frombuffer('RGBA', source_size, pixels, 'raw', 'RGBA', 0, 1)
+        image = fit_image(source, (member['width'], member['height']), member['fit'])
+        # The mapping cannot close while an image still points into it
+        del source
+    return encode_member(image, member['format'], member['preset'])
+
+
+def render_vector_member(document, resolved_assets):
+    """Pool job: vector PDF from scene JSON with asset paths resolved up front"""
+    from pdf_renderer import render_scene_pdf
+    return render_scene_pdf(document, resolved_assets.get)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process pool shared by all batches in this worker, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Never fork a (possibly multi-threaded) web worker
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def reset_pool():
+    """Drop a pool whose worker died so the next batch starts a fresh one"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+class _ZipSink:
+    """Write-only file object; ZipFile falls back to streaming mode without seek/tell"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class BatchExport:
+    """
+    Submits every output of one batch to the process pool and streams the ZIP
+
+    Raster outputs share one PixelBuffer. PDFs at the scene's own size are
+    drawn as vectors when a scene document is given. A manifest.json listing
+    each member (or its error) closes the archive.
+    """
+
+    def __init__(self, image, members, document=None, resolved_assets=None):
+        self.members = members
+        self.buffer = None
+        self.futures = {}
+        pool = get_pool()
+        try:
+            for member in members:
+                if document is not None and member['format'] == 'pdf' and member['label'] == 'original':
+                    future = pool.submit(render_vector_member, document, resolved_assets or {})
+                else:
+                    if self.buffer is None:
+                        self.buffer = PixelBuffer(image)
+                    future = pool.submit(render_member, self.buffer.path, self.buffer.size, member)
+                self.futures[future] = member
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        if self.buffer is not None:
+            self.buffer.close()
+
+    def stream(self):
+        """Yield the archive in chunks, one member at a time as jobs finish"""
+        sink = _ZipSink()
+        manifest = []
+        try:
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for future in as_completed(self.futures):
+                    member = self.futures[future]
+                    entry = {key: member[key] for key in ('name', 'format', 'width', 'height', 'fit', 'preset')}
+                    try:
+                        data = future.result()
+                    except BrokenProcessPool as e:
+                        reset_pool()
+                        entry['error'] = str(e) or 'worker process died'
+                    except Exception as e:
+                        logger.warning(f"Batch export of {member['name']} failed: {e}")
+                        entry['error'] = str(e)
+                    else:
+                        info = zipfile.ZipInfo(member['name'], date_time=time.localtime()[:6])
+                        archive.writestr(info, data)
+                        entry['bytes'] = len(data)
+                    manifest.append(entry)
+                    yield sink.drain()
+                archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+            yield sink.drain()
+        finally:
+            self.close()
@@ -0,0 +1,129 @@
+"""
+Measure output size against encode time for every encoder format and preset
+
+Encodes a few representative exports (a photo ad, a flat graphic ad and a
+transparent image) in-process with encoders.encode, reporting the median
+encode time and the size of each result. Results are saved as JSON under
+bench/results/ next to the load test results.
+
+    python bench/encoder_presets.py
+    python bench/encoder_presets.py --formats png,webp --presets fast,smallest --repeat 9
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+from datetime import datetime, timezone
+
+from PIL import Image, ImageDraw
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from encoders import FORMATS, PRESETS, encode
+from run import RESULTS_DIR, git_revision
+
+IMAGES_DIR = os.path.join(ROOT_DIR, 'static', 'images')
+
+# A 1200x628 horizontal ad exported at 2x, as the editor does by default
+EXPORT_SIZE = (2400, 1256)
+
+
+def photo_ad(size):
+    """Stock photo on one half, headline panel on the other"""
+    with Image.open(os.path.join(IMAGES_DIR, 'default-office.jpg')) as photo:
+        photo = photo.convert('RGB').resize((size[0] // 2, size[1]), Image.LANCZOS)
+    image = graphic_ad(size)
+    image.paste(photo, (0, 0))
+    return image
+
+
+def graphic_ad(size):
+    """Flat colours and text only, like a template without a photo"""
+    width, height = size
+    image = Image.new('RGB', size, '#1f2937')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width // 2, height), fill='#2563eb')
+    draw.text((width * 0.55, height * 0.25), 'Summer sale headline', fill='#ffffff', font_size=height // 12)
+    draw.text((width * 0.55, height * 0.45), 'A subtitle that explains the offer', fill='#e5e7eb', font_size=height // 24)
+    draw.rounded_rectangle((width * 0.55, height * 0.65, width * 0.8, height * 0.75), radius=height // 50, fill='#f59e0b')
+    draw.text((width * 0.58, height * 0.67), 'Shop now', fill='#111827', font_size=height // 28)
+    return image
+
+
+def transparent_image(size):
+    """The RGBA placeholder, as a logo or cut-out export would be"""
+    with Image.open(os.path.join(IMAGES_DIR, 'default-placeholder.png')) as image:
+        image = image.convert('RGBA')
+        image.thumbnail(size, Image.LANCZOS)
+        return image
+
+
+SAMPLES = {
+    'photo_ad': photo_ad,
+    'graphic_ad': graphic_ad,
+    'transparent': transparent_image,
+}
+
+
+def measure(image, fmt, preset, repeat):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = encode(image, fmt, preset)
+        timings.append(time.perf_counter() - started)
+        size = len(output.getbuffer())
+    return {'bytes': size, 'median_ms': round(statistics.median(timings) * 1000, 1),
+            'min_ms': round(min(timings) * 1000, 1)}
+
+
+def main():
+    formats = [fmt for fmt in FORMATS if fmt != 'jpg']
+    parser = argparse.ArgumentParser(description='Encoder size vs time per format and preset')
+    parser.add_argument('--formats', default=','.join(formats), help=f"comma separated, from: {', '.join(formats)}")
+    parser.add_argument('--presets', default=','.join(PRESETS))
+    parser.add_argument('--samples', default=','.join(SAMPLES), help=f"comma separated, from: {', '.join(SAMPLES)}")
+    parser.add_argument('--size', default=f'{EXPORT_SIZE[0]}x{EXPORT_SIZE[1]}', help='WIDTHxHEIGHT of the samples')
+    parser.add_argument('--repeat', type=int, default=5, help='encodes per measurement (median is reported)')
+    parser.add_argument('--output', help='result file (default: bench/results/encoders-<time>-<commit>.json)')
+    args = parser.parse_args()
+
+    size = tuple(int(part) for part in args.size.lower().split('x'))
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'size': list(size),
+            'repeat': args.repeat,
+        },
+        'samples': {}
+    }
+
+    print(f"{'sample':<13}{'format':<7}{'preset':<10}{'KB':>9}{'ms':>9}{'vs png/balanced':>17}")
+    for sample in args.samples.split(','):
+        image = SAMPLES[sample](size)
+        rows = results['samples'][sample] = {}
+        baseline = measure(image, 'png', 'balanced', 1)['bytes']
+        for fmt in args.formats.split(','):
+            for preset in args.presets.split(','):
+                row = rows.setdefault(fmt, {})[preset] = measure(image, fmt, preset, args.repeat)
+                print(f"{sample:<13}{fmt:<7}{preset:<10}{row['bytes'] / 1024:>9.1f}{row['median_ms']:>9.1f}"
+                      f"{row['bytes'] / baseline:>16.0%}")
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"encoders-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['meta']['revision']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved {output}')
+
+
+if __name__ == '__main__':
+    main()
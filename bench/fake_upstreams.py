@@ -0,0 +1,251 @@
+"""
+Local stand-ins for the Shutterstock and Gemini APIs
+
+One threaded HTTP server answers both protocols closely enough for the app's
+real clients (requests and google-genai) to talk to it:
+
+    GET  /v2/images/search                         Shutterstock search
+    GET  /v2/images/<id>                           Shutterstock image details
+    GET  /previews/<id>.jpg                        preview images
+    POST /v1beta/models/<model>:generateContent    Gemini text and image
+
+Point the app at it with SHUTTERSTOCK_API_BASE=http://host:port/v2,
+SHUTTERSTOCK_PREVIEW_HOSTS=host and GEMINI_API_BASE=http://host:port/.
+Latency and payload sizes are configurable so runs are reproducible.
+
+Run standalone with: python bench/fake_upstreams.py --port 8900
+"""
+import io
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+
+def noise_jpeg(target_bytes, seed=0):
+    """A JPEG of roughly target_bytes; noise keeps it from compressing away"""
+    rng = random.Random(seed)
+    # Noise at quality 85 costs roughly 1.1 bytes per pixel
+    side = max(int((target_bytes / 1.1) ** 0.5), 16)
+    image = Image.frombytes('RGB', (side, side), rng.randbytes(side * side * 3))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+class FakeUpstreamConfig:
+    """Latencies in seconds (each call sleeps latency +/- jitter) and payload sizes in bytes"""
+
+    def __init__(self, shutterstock_latency=0.15, preview_latency=0.1, gemini_text_latency=0.8,
+                 gemini_image_latency=3.0, jitter=0.2, preview_bytes=150 * 1024,
+                 gemini_image_bytes=1024 * 1024, results_per_page=20, seed=0):
+        self.shutterstock_latency = shutterstock_latency
+        self.preview_latency = preview_latency
+        self.gemini_text_latency = gemini_text_latency
+        self.gemini_image_latency = gemini_image_latency
+        self.jitter = jitter
+        self.preview_bytes = preview_bytes
+        self.gemini_image_bytes = gemini_image_bytes
+        self.results_per_page = results_per_page
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeUpstreams:
+    """Runs the fake API server on a background thread"""
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or FakeUpstreamConfig()
+        self.preview = noise_jpeg(self.config.preview_bytes, self.config.seed)
+        self.gemini_image = base64.b64encode(noise_jpeg(self.config.gemini_image_bytes, self.config.seed + 1)).decode('ascii')
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(self.config.seed)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def app_environment(self):
+        """Environment variables that route the app's upstream calls here"""
+        return {
+            'SHUTTERSTOCK_API_BASE': f'{self.base_url}/v2',
+            'SHUTTERSTOCK_API_TOKEN': 'bench-token',
+            'SHUTTERSTOCK_PREVIEW_HOSTS': self.host,
+            'GEMINI_API_BASE': f'{self.base_url}/',
+            'GEMINI_API_KEY': 'bench-key',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-upstreams', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _sleep(self, latency):
+        with self._lock:
+            factor = 1 + self._rng.uniform(-self.config.jitter, self.config.jitter)
+        time.sleep(max(latency * factor, 0))
+
+    def _search_results(self, query, page, per_page):
+        data = []
+        for index in range(per_page):
+            image_id = str(int(hashlib.sha256(f'{query}:{page}:{index}'.encode('utf-8')).hexdigest()[:8], 16))
+            preview = f'{self.base_url}/previews/{image_id}.jpg'
+            data.append({
+                'id': image_id,
+                'description': f'{query} stock photo {index}',
+                'aspect': 1.5,
+                'assets': {
+                    'preview': {'url': preview, 'width': 450, 'height': 300},
+                    'preview_1000': {'url': preview, 'width': 1000, 'height': 667},
+                }
+            })
+        return {'data': data, 'page': page, 'per_page': per_page, 'total_count': 10000}
+
+    def _gemini_response(self, model, prompt):
+        if 'image' in model:
+            parts = [{'inlineData': {'mimeType': 'image/jpeg', 'data': self.gemini_image}}]
+        else:
+            count = 5
+            if 'title and subtitle' in prompt:
+                text = json.dumps([{'title': f'Bench title {n}', 'subtitle': f'Bench subtitle {n}'} for n in range(count)])
+            else:
+                text = json.dumps([f'Bench text {n}' for n in range(count)])
+            parts = [{'text': text}]
+        return {
+            'candidates': [{'content': {'role': 'model', 'parts': parts}, 'finishReason': 'STOP', 'index': 0}],
+            'modelVersion': model
+        }
+
+    def _handler_class(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json'):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                params = parse_qs(parsed.query)
+                if parsed.path == '/v2/images/search':
+                    upstreams._count('shutterstock_search')
+                    upstreams._sleep(upstreams.config.shutterstock_latency)
+                    per_page = min(int(params.get('per_page', [upstreams.config.results_per_page])[0]), 50)
+                    page = int(params.get('page', [1])[0])
+                    self._send(200, upstreams._search_results(params.get('query', [''])[0], page, per_page))
+                elif parsed.path.startswith('/v2/images/'):
+                    upstreams._count('shutterstock_details')
+                    upstreams._sleep(upstreams.config.shutterstock_latency)
+                    self._send(200, {'id': parsed.path.rsplit('/', 1)[-1], 'aspect': 1.5})
+                elif parsed.path.startswith('/previews/'):
+                    upstreams._count('shutterstock_preview')
+                    upstreams._sleep(upstreams.config.preview_latency)
+                    self._send(200, upstreams.preview, 'image/jpeg')
+                else:
+                    self._send(404, {'error': 'not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                path = urlparse(self.path).path
+                if ':generateContent' not in path:
+                    self._send(404, {'error': 'not found'})
+                    return
+                model = path.rsplit('/', 1)[-1].split(':')[0]
+                prompt = ' '.join(
+                    part.get('text', '')
+                    for content in body.get('contents', [])
+                    for part in content.get('parts', [])
+                )
+                if 'image' in model:
+                    upstreams._count('gemini_image')
+                    upstreams._sleep(upstreams.config.gemini_image_latency)
+                else:
+                    upstreams._count('gemini_text')
+                    upstreams._sleep(upstreams.config.gemini_text_latency)
+                self._send(200, upstreams._gemini_response(model, prompt))
+
+        return Handler
+
+
+def add_config_arguments(parser):
+    defaults = FakeUpstreamConfig()
+    parser.add_argument('--shutterstock-latency', type=float, default=defaults.shutterstock_latency, help='seconds per Shutterstock API call')
+    parser.add_argument('--preview-latency', type=float, default=defaults.preview_latency, help='seconds per preview download')
+    parser.add_argument('--gemini-text-latency', type=float, default=defaults.gemini_text_latency, help='seconds per Gemini text call')
+    parser.add_argument('--gemini-image-latency', type=float, default=defaults.gemini_image_latency, help='seconds per Gemini image call')
+    parser.add_argument('--jitter', type=float, default=defaults.jitter, help='relative latency jitter (0.2 = +/-20%%)')
+    parser.add_argument('--preview-kb', type=int, default=defaults.preview_bytes // 1024, help='preview image size')
+    parser.add_argument('--gemini-image-kb', type=int, default=defaults.gemini_image_bytes // 1024, help='generated image size')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+
+
+def config_from_arguments(args):
+    return FakeUpstreamConfig(
+        shutterstock_latency=args.shutterstock_latency,
+        preview_latency=args.preview_latency,
+        gemini_text_latency=args.gemini_text_latency,
+        gemini_image_latency=args.gemini_image_latency,
+        jitter=args.jitter,
+        preview_bytes=args.preview_kb * 1024,
+        gemini_image_bytes=args.gemini_image_kb * 1024,
+        seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    upstreams = FakeUpstreams(config_from_arguments(args), args.host, args.port)
+    print(f'Fake upstreams on {upstreams.base_url}; app environment:')
+    for name, value in upstreams.app_environment().items():
+        print(f'  export {name}={value}')
+    upstreams.server.serve_forever()
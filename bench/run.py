@@ -0,0 +1,591 @@
+"""
+Benchmark the app under gunicorn against local fake Shutterstock/Gemini servers
+
+Each scenario runs on its own for --duration seconds with --concurrency
+closed-loop clients against a freshly started server, so peak worker RSS can
+be attributed to it, followed by a weighted mix of all of them. Results are
+printed and saved as JSON under bench/results/ (named by time and git commit)
+for comparison between commits.
+
+    python bench/run.py
+    python bench/run.py --scenarios export_png,search --duration 20 --workers 4
+    python bench/run.py --compare bench/results/<earlier run>.json
+    python bench/run.py --diff OLD.json NEW.json
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from perf import current_rss, peak_rss, reset_peak_rss
+from fake_upstreams import FakeUpstreams, add_config_arguments, config_from_arguments
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+QUERIES = [
+    'coffee', 'laptop', 'running shoes', 'beach', 'office team', 'city skyline', 'mountains', 'pizza',
+    'yoga', 'sneakers', 'wedding', 'dog', 'cat', 'finance', 'startup', 'summer sale', 'autumn',
+    'skincare', 'headphones', 'bicycle', 'kitchen', 'garden', 'holiday', 'fitness', 'camera'
+]
+
+PROMPTS = ['eco-friendly water bottle', 'noise cancelling headphones', 'artisan coffee beans',
+           'summer shoe sale', 'online yoga classes', 'budget travel app', 'smart home camera']
+
+
+class Payloads:
+    """Request bodies generated once per run, from a fixed seed"""
+
+    def __init__(self, seed=0, canvas_size=(3056, 1600)):
+        rng = random.Random(seed)
+        # Smooth, photo-like canvas: low-resolution noise upscaled to export size
+        coarse = Image.frombytes('RGB', (191, 100), rng.randbytes(191 * 100 * 3))
+        canvas = coarse.resize(canvas_size, Image.BICUBIC)
+        self.canvas_png = self._encode(canvas, 'PNG')
+        self.canvas_jpeg = self._encode(canvas, 'JPEG', quality=95)
+        self.upload_small = self._encode(coarse.resize((800, 600), Image.BICUBIC), 'JPEG', quality=90)
+        self.upload_large = self._encode(
+            Image.frombytes('RGB', (2000, 1500), rng.randbytes(2000 * 1500 * 3)), 'JPEG', quality=90
+        )
+        self.scene = {
+            'width': 1528,
+            'height': 800,
+            'scene': {
+                'background': '#1f2937',
+                'objects': [
+                    {'type': 'rect', 'left': 0, 'top': 0, 'width': 764, 'height': 800, 'fill': '#2563eb'},
+                    {'type': 'textbox', 'left': 820, 'top': 200, 'width': 640, 'height': 120, 'fontSize': 56,
+                     'fontWeight': 'bold', 'fill': '#ffffff', 'text': 'Benchmark headline that wraps'},
+                    {'type': 'textbox', 'left': 820, 'top': 420, 'width': 640, 'height': 60, 'fontSize': 28,
+                     'fill': '#e5e7eb', 'text': 'A subtitle for the benchmark scene'}
+                ]
+            }
+        }
+
+    @staticmethod
+    def _encode(image, fmt, **options):
+        output = io.BytesIO()
+        image.save(output, format=fmt, **options)
+        return output.getvalue()
+
+
+def unique(data, rng):
+    """Append random bytes after the image data so every upload has new content"""
+    return data + rng.randbytes(16)
+
+
+# Each scenario performs one user action and returns (ok, bytes sent, bytes received)
+
+def wire_bytes(response):
+    """Bytes on the wire: the compressed length when the body was sent encoded"""
+    return int(response.headers.get('Content-Length') or len(response.content))
+
+
+def scenario_page_first_visit(client, ctx):
+    """Load the editor with an empty browser cache: the page, then every local asset it links"""
+    headers = {'Accept-Encoding': 'gzip, br'}
+    r = client.get(f'{ctx.base}/', headers=headers)
+    ok, received = r.ok, wire_bytes(r)
+    for path in set(re.findall(r'(?:src|href)="(/(?:assets|static)/[^"]+)"', r.text)):
+        asset = client.get(ctx.base + path, headers=headers)
+        ok, received = ok and asset.ok, received + wire_bytes(asset)
+    return ok, 0, received
+
+
+def scenario_page_repeat_visit(client, ctx):
+    """
+    Load the editor again with a warm browser cache
+
+    The page is revalidated. Fingerprinted /assets/ URLs are immutable and
+    come from the cache without a request; plain /static/ files are
+    revalidated one by one, as browsers do without a max-age.
+    """
+    headers = {'Accept-Encoding': 'gzip, br'}
+    conditional = dict(headers, **{'If-None-Match': ctx.validators['/']}) if '/' in ctx.validators else headers
+    r = client.get(f'{ctx.base}/', headers=conditional)
+    ok, received = r.status_code in (200, 304), wire_bytes(r) if r.status_code == 200 else 0
+    if r.status_code == 200:
+        ctx.validators['/'] = r.headers.get('ETag')
+        ctx.page_assets = set(re.findall(r'(?:src|href)="(/static/[^"]+)"', r.text))
+    for path in ctx.page_assets:
+        conditional = dict(headers, **{'If-None-Match': ctx.validators[path]}) if path in ctx.validators else headers
+        asset = client.get(ctx.base + path, headers=conditional)
+        ok = ok and asset.status_code in (200, 304)
+        if asset.status_code == 200:
+            ctx.validators[path] = asset.headers.get('ETag')
+            received += wire_bytes(asset)
+    return ok, 0, received
+
+
+def scenario_upload_small(client, ctx):
+    body = unique(ctx.payloads.upload_small, ctx.rng)
+    r = client.post(f'{ctx.base}/upload-image', files={'file': ('photo.jpg', body, 'image/jpeg')}, data={'type': 'main'})
+    return r.ok and r.json().get('success', False), len(body), len(r.content)
+
+
+def scenario_upload_large(client, ctx):
+    body = unique(ctx.payloads.upload_large, ctx.rng)
+    r = client.post(f'{ctx.base}/upload-image', files={'file': ('photo.jpg', body, 'image/jpeg')}, data={'type': 'main'})
+    return r.ok and r.json().get('success', False), len(body), len(r.content)
+
+
+def scenario_export_png(client, ctx):
+    body = ctx.payloads.canvas_png
+    r = client.post(f'{ctx.base}/export-image?format=png', data=body, headers={'Content-Type': 'image/png'})
+    return r.ok and r.headers.get('Content-Type') == 'image/png', len(body), len(r.content)
+
+
+def scenario_export_jpeg(client, ctx):
+    body = ctx.payloads.canvas_jpeg
+    r = client.post(f'{ctx.base}/export-image?format=jpg', data=body, headers={'Content-Type': 'image/jpeg'})
+    return r.ok and r.headers.get('Content-Type') == 'image/jpeg', len(body), len(r.content)
+
+
+def scenario_export_pdf(client, ctx):
+    body = ctx.payloads.canvas_png
+    r = client.post(f'{ctx.base}/export-pdf', data=body, headers={'Content-Type': 'image/png'})
+    return r.ok and r.headers.get('Content-Type') == 'application/pdf', len(body), len(r.content)
+
+
+def scenario_export_scene(client, ctx):
+    body = json.dumps(dict(ctx.payloads.scene, multiplier=2)).encode('utf-8')
+    r = client.post(f'{ctx.base}/export-image', data=body, headers={'Content-Type': 'application/json'})
+    return r.ok and r.headers.get('Content-Type') == 'image/png', len(body), len(r.content)
+
+
+def scenario_export_batch(client, ctx):
+    body = ctx.payloads.canvas_png
+    r = client.post(f'{ctx.base}/export-batch?formats=png,jpeg,webp,pdf&sizes=original,square',
+                    data=body, headers={'Content-Type': 'image/png'})
+    return r.ok and r.headers.get('Content-Type') == 'application/zip', len(body), len(r.content)
+
+
+def scenario_search(client, ctx):
+    # Popular queries repeat, like real traffic, so the result cache sees hits
+    query = QUERIES[min(int(ctx.rng.paretovariate(1.2)) - 1, len(QUERIES) - 1)]
+    r = client.get(f'{ctx.base}/api/shutterstock/search', params={'query': query, 'per_page': 20})
+    return r.ok and 'images' in r.json(), 0, len(r.content)
+
+
+def scenario_download(client, ctx):
+    image_id = ctx.rng.randrange(500)
+    url = f'{ctx.upstream}/previews/{image_id}.jpg'
+    r = client.get(f'{ctx.base}/api/shutterstock/preview', params={'url': url})
+    return r.ok and r.headers.get('Content-Type', '').startswith('image/'), 0, len(r.content)
+
+
+def scenario_ai_text(client, ctx):
+    prompt = ctx.rng.choice(PROMPTS)
+    r = client.post(f'{ctx.base}/api/gemini/generate-text',
+                    json={'prompt': prompt, 'type': 'both', 'variant': ctx.rng.randrange(3)})
+    return r.ok and r.json().get('success', False), len(prompt), len(r.content)
+
+
+def scenario_ai_image(client, ctx):
+    """Submit a generation job and poll it; latency covers the whole job"""
+    r = client.post(f'{ctx.base}/api/gemini/generate-image', json={'prompt': ctx.rng.choice(PROMPTS)})
+    received = len(r.content)
+    if r.status_code != 202:
+        return False, 0, received
+    status_url = ctx.base + r.json()['status_url']
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        time.sleep(0.25)
+        r = client.get(status_url)
+        received += len(r.content)
+        status = r.json().get('status')
+        if status == 'succeeded':
+            return True, 0, received
+        if status == 'failed' or not r.ok:
+            return False, 0, received
+    return False, 0, received
+
+
+SCENARIOS = {
+    'page_first_visit': scenario_page_first_visit,
+    'page_repeat_visit': scenario_page_repeat_visit,
+    'upload_small': scenario_upload_small,
+    'upload_large': scenario_upload_large,
+    'export_png': scenario_export_png,
+    'export_jpeg': scenario_export_jpeg,
+    'export_pdf': scenario_export_pdf,
+    'export_scene': scenario_export_scene,
+    'export_batch': scenario_export_batch,
+    'search': scenario_search,
+    'download': scenario_download,
+    'ai_text': scenario_ai_text,
+    'ai_image': scenario_ai_image,
+}
+
+DEFAULT_SCENARIOS = ('page_first_visit', 'page_repeat_visit', 'upload_small', 'upload_large', 'export_png', 'export_jpeg', 'export_pdf',
+                     'search', 'download', 'ai_text', 'ai_image')
+
+# Relative frequency of each action in the mixed phase
+MIX_WEIGHTS = {
+    'search': 30, 'download': 20, 'upload_small': 10, 'upload_large': 3, 'ai_text': 12,
+    'ai_image': 3, 'export_png': 8, 'export_jpeg': 8, 'export_pdf': 4,
+    'export_scene': 2, 'export_batch': 1, 'page_first_visit': 2, 'page_repeat_visit': 6,
+}
+
+
+class ClientContext:
+    def __init__(self, base, upstream, payloads, seed):
+        self.base = base
+        self.upstream = upstream
+        self.payloads = payloads
+        self.rng = random.Random(seed)
+        # Browser cache state for the page scenarios
+        self.validators = {}
+        self.page_assets = set()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """samples: [(ok, latency, sent, received)] for one scenario"""
+    latencies = sorted(latency for ok, latency, _, _ in samples if ok)
+    ok_count = len(latencies)
+    to_ms = lambda value: None if value is None else round(value * 1000, 1)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - ok_count,
+        'throughput': round(ok_count / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'mean_ms': to_ms(sum(latencies) / ok_count) if ok_count else None,
+        'bytes_sent': sum(sample[2] for sample in samples),
+        'bytes_received': sum(sample[3] for sample in samples),
+    }
+
+
+def child_pids(pid):
+    """Direct children of a process, from /proc (Linux)"""
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+class MemoryProbe:
+    """
+    Peak RSS of every gunicorn worker while a phase runs
+
+    Resets each worker's kernel high-water mark where permitted and also
+    samples RSS, so the result is correct either way.
+    """
+
+    def __init__(self, master_pid, interval=0.05):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _pids(self):
+        # Include grandchildren such as the batch export pool
+        pids = []
+        pending = child_pids(self.master_pid)
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(child_pids(pid))
+        return pids
+
+    def _sample(self):
+        for pid in self._pids():
+            rss = current_rss(pid)
+            if rss:
+                self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.resettable = all(reset_peak_rss(pid) for pid in self._pids())
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        if self.resettable:
+            for pid in self._pids():
+                peak = peak_rss(pid)
+                if peak:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), peak)
+        return False
+
+    def result(self):
+        return {
+            'peak_worker_rss_mb': round(max(self.peaks.values(), default=0) / 2 ** 20, 1),
+            'peak_total_rss_mb': round(sum(self.peaks.values()) / 2 ** 20, 1),
+        }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AppServer:
+    """The app under gunicorn, with its storage in a throwaway directory"""
+
+    def __init__(self, environment, workers=2, threads=1, worker_class='sync', preload=False):
+        self.port = free_port()
+        self.base = f'http://127.0.0.1:{self.port}'
+        self.data_dir = tempfile.mkdtemp(prefix='template-ads-bench-')
+        self.log_path = os.path.join(self.data_dir, 'gunicorn.log')
+        self.environment = dict(os.environ, **environment)
+        self.environment.update({
+            'MEDIA_FOLDER': os.path.join(self.data_dir, 'media'),
+            'PREVIEW_CACHE_FOLDER': os.path.join(self.data_dir, 'previews'),
+            'JOBS_FOLDER': os.path.join(self.data_dir, 'jobs'),
+            'METRICS_FOLDER': os.path.join(self.data_dir, 'metrics'),
+            'ASSET_BUILD_FOLDER': os.path.join(self.data_dir, 'assets'),
+            'UPSTREAM_STATE_FOLDER': os.path.join(self.data_dir, 'upstreams'),
+            # The fakes have no quota; measure the app rather than the rate limits
+            'SHUTTERSTOCK_RATE_LIMIT': '0',
+            'GEMINI_RATE_LIMIT': '0',
+            # Every run posts the same canvases; keep the export scenarios measuring rendering
+            'EXPORT_CACHE': '0',
+            # Sizes the batch export pool the way a deployment setting WEB_CONCURRENCY would
+            'WEB_CONCURRENCY': str(workers),
+            'LOG_LEVEL': 'WARNING',
+            'GUNICORN_PRELOAD': '1' if preload else '',
+        })
+        self.environment.pop('GEMINI_STUB', None)
+        self.command = [
+            sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{self.port}',
+            '--workers', str(workers), '--threads', str(threads), '--worker-class', worker_class,
+            '--timeout', '120', 'main:app'
+        ]
+        self.process = None
+
+    def start(self, timeout=60):
+        self._log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(self.command, cwd=ROOT_DIR, env=self.environment,
+                                        stdout=self._log, stderr=subprocess.STDOUT)
+        started = time.time()
+        while time.time() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited; see {self.log_path}')
+            try:
+                if requests.get(self.base + '/', timeout=2).ok:
+                    self.startup_seconds = time.time() - started
+                    return self
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f'gunicorn did not become ready; see {self.log_path}')
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self._log.close()
+
+    def cleanup(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def run_phase(server, upstream, payloads, scenarios, weights, concurrency, duration, warmup, seed):
+    """Closed-loop load: each client issues its next request as soon as the last one finishes"""
+    samples = {name: [] for name in scenarios}
+    lock = threading.Lock()
+    start_at = time.time() + warmup
+    stop_at = start_at + duration
+
+    def client_loop(index):
+        ctx = ClientContext(server.base, upstream.base_url, payloads, seed * 1000 + index)
+        names = list(scenarios)
+        choice_weights = [weights.get(name, 1) for name in names]
+        with requests.Session() as client:
+            while time.time() < stop_at:
+                name = ctx.rng.choices(names, choice_weights)[0]
+                measured = time.time() >= start_at
+                began = time.perf_counter()
+                try:
+                    ok, sent, received = SCENARIOS[name](client, ctx)
+                except (requests.RequestException, ValueError):
+                    ok, sent, received = False, 0, 0
+                latency = time.perf_counter() - began
+                # Requests started during warmup are not measured
+                if measured:
+                    with lock:
+                        samples[name].append((ok, latency, sent, received))
+
+    with MemoryProbe(server.process.pid) as memory:
+        threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    elapsed = duration
+    phase = {'scenarios': {name: summarize(values, elapsed) for name, values in samples.items()}}
+    total = [sample for values in samples.values() for sample in values]
+    phase['total'] = summarize(total, elapsed)
+    phase['total'].update(memory.result())
+    return phase
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_phase(name, phase):
+    print(f'\n== {name} ==')
+    print(f"{'scenario':<19}{'req':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = list(phase['scenarios'].items()) + [('total', phase['total'])]
+    for scenario, stats in rows:
+        if not stats['requests']:
+            continue
+        fmt = lambda value: '-' if value is None else f'{value:.1f}'
+        print(f"{scenario:<19}{stats['requests']:>7}{stats['errors']:>6}{stats['throughput']:>9.2f}"
+              f"{fmt(stats['p50_ms']):>10}{fmt(stats['p95_ms']):>10}{fmt(stats['p99_ms']):>10}")
+    print(f"peak RSS: {phase['total']['peak_worker_rss_mb']} MB per worker, {phase['total']['peak_total_rss_mb']} MB total")
+
+
+def compare(old, new, threshold=0.10):
+    """Print throughput and p95 changes between two result files; returns the number of regressions"""
+    print(f"\nComparing {old['meta']['revision']} ({old['meta']['timestamp']}) -> "
+          f"{new['meta']['revision']} ({new['meta']['timestamp']})")
+    print(f"{'phase':<19}{'req/s':>18}{'p95 ms':>22}{'peak RSS MB':>20}")
+    regressions = 0
+    for name, phase in new['phases'].items():
+        previous = old['phases'].get(name)
+        if not previous:
+            continue
+        before, after = previous['total'], phase['total']
+        flags = []
+        if before['throughput'] and after['throughput'] < before['throughput'] * (1 - threshold):
+            flags.append('throughput')
+        if before['p95_ms'] and after['p95_ms'] and after['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            flags.append('p95')
+        if before['peak_worker_rss_mb'] and after['peak_worker_rss_mb'] > before['peak_worker_rss_mb'] * (1 + threshold):
+            flags.append('memory')
+        regressions += bool(flags)
+        print(f"{name:<19}{before['throughput']:>8.2f} -> {after['throughput']:<8.2f}"
+              f"{before['p95_ms'] or 0:>10.1f} -> {after['p95_ms'] or 0:<10.1f}"
+              f"{before['peak_worker_rss_mb']:>8.1f} -> {after['peak_worker_rss_mb']:<8.1f}"
+              f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app under gunicorn against fake upstreams')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--no-mix', action='store_true', help='skip the mixed phase')
+    parser.add_argument('--duration', type=float, default=15, help='measured seconds per phase')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds before each phase')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--preload', action='store_true', help='start gunicorn with GUNICORN_PRELOAD=1')
+    parser.add_argument('--output', help='result file (default: bench/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare this run with')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help='only compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change counted as a regression')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.diff:
+        with open(args.diff[0]) as f_old, open(args.diff[1]) as f_new:
+            sys.exit(1 if compare(json.load(f_old), json.load(f_new), args.threshold) else 0)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    payloads = Payloads(args.seed)
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('compare', 'diff', 'output')},
+        },
+        'phases': {}
+    }
+
+    with FakeUpstreams(config_from_arguments(args)) as upstream:
+        phases = [(name, [name]) for name in scenarios]
+        if not args.no_mix and len(scenarios) > 1:
+            phases.append(('mixed', scenarios))
+        startup = []
+        for index, (name, phase_scenarios) in enumerate(phases):
+            # A fresh server per phase, so memory kept by one endpoint is not charged to the next
+            server = AppServer(upstream.app_environment(), args.workers, args.threads, args.worker_class, args.preload)
+            try:
+                server.start()
+                startup.append(server.startup_seconds)
+                phase = run_phase(server, upstream, payloads, phase_scenarios, MIX_WEIGHTS,
+                                  args.concurrency, args.duration, args.warmup, args.seed + index)
+            finally:
+                server.stop()
+                server.cleanup()
+            phase['startup_seconds'] = round(server.startup_seconds, 3)
+            results['phases'][name] = phase
+            print_phase(name, phase)
+        results['meta']['startup_seconds'] = round(min(startup), 3)
+        results['upstream_calls'] = dict(upstream.counts)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['meta']['revision']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Only bump a blob's last-access time once per interval to avoid a write per hit
+TOUCH_INTERVAL = 60
+
+# Blobs used this recently are never evicted, so a file is not deleted while
+# another worker is still serving or re-committing it
+EVICTION_GRACE = 600
+
+# Temp files older than this belong to a writer that crashed
+STALE_TMP_AGE = 3600
+
+
+def is_valid_digest(digest):
+    """Check that a digest is a bare sha256 hex string (safe to use in paths)"""
+    return bool(digest) and bool(DIGEST_PATTERN.match(digest))
+
+
+class BlobWriter:
+    """
+    Streams bytes into a temp file while hashing them, then publishes the
+    result under its sha256 digest
+
+    Use as a context manager: anything not committed is discarded on exit.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir, suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.digest = None
+        self.duplicate = False
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def finish(self):
+        """Close the temp file and return its digest without publishing it"""
+        if not self._file.closed:
+            self._file.close()
+            self.digest = self._hash.hexdigest()
+        return self.digest
+
+    def commit(self, metadata=None):
+        """
+        Publish the blob and return its digest
+
+        If a blob with the same content already exists the temp file is
+        dropped and the existing blob is reused.
+        """
+        digest = self.finish()
+        if self.store.exists(digest):
+            self.duplicate = True
+            self.discard()
+            self.store.touch(digest, force=True)
+            return digest
+
+        blob_path = self.store.path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        meta = dict(metadata or {})
+        meta.setdefault('size', self.size)
+        meta.setdefault('created', time.time())
+        # Metadata goes first so a visible blob always has its sidecar
+        self.store._write_json(self.store.meta_path(digest), meta)
+        os.replace(self.tmp_path, blob_path)
+        self.tmp_path = None
+        self.store._account(self.size)
+        return digest
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if self.tmp_path:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+            self.tmp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.discard()
+        return False
+
+
+class BlobStore:
+    """
+    Content-addressed file store with size- and age-bounded LRU eviction
+
+    Blobs live at <root>/objects/<first two hex chars>/<sha256>, with a JSON
+    metadata sidecar next to each one. Named references (for example an
+    upstream URL) map to digests through small files under
+    <root>/refs/<first two hex chars>/. A blob's mtime is its last access.
+    Eviction and clean-up take an flock on <root>/.lock, so workers sharing
+    the directory never sweep it at the same time.
+    """
+
+    def __init__(self, root, max_bytes=None, max_age=None, grace=EVICTION_GRACE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.grace = grace
+        self.objects_dir = os.path.join(root, 'objects')
+        self.refs_dir = os.path.join(root, 'refs')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.lock_path = os.path.join(root, '.lock')
+        for directory in (self.objects_dir, self.refs_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._approx_bytes = None
+
+    def path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def meta_path(self, digest):
+        return self.path(digest) + '.json'
+
+    def exists(self, digest):
+        return is_valid_digest(digest) and os.path.exists(self.path(digest))
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def put_bytes(self, data, metadata=None):
+        with self.writer() as writer:
+            writer.write(data)
+            return writer.commit(metadata)
+
+    def metadata(self, digest):
+        try:
+            with open(self.meta_path(digest), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def touch(self, digest, force=False):
+        """Record an access so LRU eviction keeps recently used blobs"""
+        path = self.path(digest)
+        try:
+            if force or time.time() - os.path.getmtime(path) > TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def _ref_path(self, name):
+        key = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.refs_dir, key[:2], key)
+
+    def _legacy_ref_path(self, name):
+        # Refs used to sit directly under refs/
+        return os.path.join(self.refs_dir, hashlib.sha256(name.encode('utf-8')).hexdigest())
+
+    def get_ref(self, name):
+        """Return the digest a reference points to, if that blob still exists"""
+        for path in (self._ref_path(name), self._legacy_ref_path(name)):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    digest = f.read().strip()
+            except OSError:
+                continue
+            return digest if self.exists(digest) else None
+        return None
+
+    def set_ref(self, name, digest):
+        path = self._ref_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.ref')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(digest)
+        os.replace(tmp_path, path)
+
+    def _write_json(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def iter_blobs(self):
+        """Yield (digest, size, last_access) for every stored blob"""
+        for shard in os.scandir(self.objects_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not is_valid_digest(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.name, stat.st_size, stat.st_mtime
+
+    def remove(self, digest):
+        for path in (self.path(digest), self.meta_path(digest)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @contextmanager
+    def locked(self, blocking=True):
+        """
+        Exclusive lock across every worker process sharing this store
+
+        Yields False instead of waiting when blocking is off and another
+        process holds the lock.
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _account(self, size):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = sum(blob[1] for blob in self.iter_blobs())
+            else:
+                self._approx_bytes += size
+            over_budget = self._approx_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self, max_bytes=None, max_age=None):
+        """
+        Delete blobs not accessed within max_age seconds, then least recently
+        used blobs until the store fits in max_bytes
+
+        Blobs accessed within the grace period are kept either way. Returns
+        the number of blobs removed; 0 when another process is already
+        evicting.
+        """
+        limit = max_bytes or self.max_bytes
+        max_age = max_age or self.max_age
+        if not limit and not max_age:
+            return 0
+        with self.locked(blocking=False) as acquired:
+            if not acquired:
+                return 0
+            now = time.time()
+            blobs = sorted(self.iter_blobs(), key=lambda blob: blob[2])
+            total = sum(blob[1] for blob in blobs)
+            removed = 0
+            for digest, size, last_access in blobs:
+                expired = max_age and now - last_access > max_age
+                if not expired and (not limit or total <= limit):
+                    break
+                if now - last_access < self.grace:
+                    break
+                self.remove(digest)
+                total -= size
+                removed += 1
+            with self._lock:
+                self._approx_bytes = total
+        return removed
+
+    def remove_stale_tmp(self, max_age=STALE_TMP_AGE):
+        """Delete temp files left behind by writers that crashed; returns how many"""
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.tmp_dir):
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def _iter_ref_files(self):
+        for entry in os.scandir(self.refs_dir):
+            if entry.is_dir():
+                yield from os.scandir(entry.path)
+            else:
+                yield entry
+
+    def prune_refs(self):
+        """Delete references whose blob has been evicted; returns how many"""
+        removed = 0
+        for entry in self._iter_ref_files():
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    digest = f.read().strip()
+                if not self.exists(digest):
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def usage(self):
+        """Blob count, bytes and access range, plus the number of refs and temp files"""
+        blobs = total = 0
+        oldest = newest = None
+        for _, size, last_access in self.iter_blobs():
+            blobs += 1
+            total += size
+            oldest = last_access if oldest is None else min(oldest, last_access)
+            newest = last_access if newest is None else max(newest, last_access)
+        return {
+            'blobs': blobs,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age,
+            'oldest_access': oldest,
+            'newest_access': newest,
+            'refs': sum(1 for _ in self._iter_ref_files()),
+            'tmp_files': sum(1 for _ in os.scandir(self.tmp_dir))
+        }
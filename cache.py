@@ -0,0 +1,458 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+
+
+class LRUCache:
+    """
+    In-process LRU cache with a size bound and per-entry TTLs
+
+    Expired entries are kept for another stale_ttl seconds, for get_stale().
+    With max_bytes set, sizeof(value) is also summed over the entries and the
+    least recently used are dropped to stay under it (0 = no byte limit).
+    """
+
+    def __init__(self, max_entries=256, default_ttl=300, stale_ttl=0, max_bytes=0, sizeof=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        return self.sizeof(value) if self.max_bytes and self.sizeof else 0
+
+    def _pop(self, key):
+        value, _ = self._entries.pop(key)
+        self.total_bytes -= self._size(value)
+
+    def get(self, key, stale=False):
+        """Return the cached value, or None if missing or expired (or, with stale, past the stale window)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            now = time.time()
+            if expires_at + self.stale_ttl < now:
+                self._pop(key)
+                return None
+            if expires_at < now and not stale:
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        size = self._size(value)
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            if self.max_bytes and size > self.max_bytes:
+                # Would evict everything else and then itself
+                return
+            self._entries[key] = (value, expires_at)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """
+    JSON-on-disk cache tier shared by every worker on the machine
+
+    Entries are written atomically (temp file + rename), so concurrent workers
+    never observe a half-written file. A file's mtime is its last access; once
+    the directory holds more than max_entries files, the least recently used
+    are deleted down to 90% of it (0 = no limit).
+
+    Each entry can also have a `.fill` lock file next to it. Workers filling
+    the same missing key take turns on its flock (fill_lock), so one of them
+    computes the value and the others read it from disk.
+    """
+
+    # Temp files (and fill locks) older than this belong to a writer that crashed
+    STALE_TMP_AGE = 3600
+
+    # Longest a worker waits for another worker's fill before computing itself
+    FILL_WAIT = 30
+    FILL_POLL_INTERVAL = 0.05
+
+    def __init__(self, directory, default_ttl=300, stale_ttl=0, max_entries=10000):
+        self.directory = directory
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.lock_path = os.path.join(directory, '.lock')
+        self._count_lock = threading.Lock()
+        self._approx_entries = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{digest}.json')
+
+    def get(self, key, stale=False):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        expires_at = entry.get('expires_at', 0)
+        now = time.time()
+        if expires_at + self.stale_ttl < now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        if expires_at < now and not stale:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get('value')
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': expires_at, 'value': value}, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._account()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _try_fill_lock(self, key):
+        """The open, flocked fill lock file for key, or None while another worker holds it"""
+        path = self._path(key)[:-len('.json')] + '.fill'
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        # evict() keeps lock files that were used recently
+        os.utime(path)
+        return lock_file
+
+    @staticmethod
+    def _release_fill_lock(lock_file):
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    @contextmanager
+    def fill_lock(self, key):
+        """
+        Hold key's fill lock across workers; yields whether another worker held it first
+
+        A caller that waited should re-read the entry before computing. After
+        FILL_WAIT seconds the caller goes ahead without the lock.
+        """
+        deadline = time.time() + self.FILL_WAIT
+        waited = False
+        lock_file = self._try_fill_lock(key)
+        while lock_file is None and time.time() < deadline:
+            waited = True
+            time.sleep(self.FILL_POLL_INTERVAL)
+            lock_file = self._try_fill_lock(key)
+        try:
+            yield waited
+        finally:
+            self._release_fill_lock(lock_file)
+
+    @asynccontextmanager
+    async def fill_lock_async(self, key):
+        """fill_lock() for coroutines, waiting without blocking the event loop"""
+        deadline = time.time() + self.FILL_WAIT
+        waited = False
+        lock_file = await asyncio.to_thread(self._try_fill_lock, key)
+        while lock_file is None and time.time() < deadline:
+            waited = True
+            await asyncio.sleep(self.FILL_POLL_INTERVAL)
+            lock_file = await asyncio.to_thread(self._try_fill_lock, key)
+        try:
+            yield waited
+        finally:
+            await asyncio.to_thread(self._release_fill_lock, lock_file)
+
+    def _account(self):
+        if not self.max_entries:
+            return
+        with self._count_lock:
+            if self._approx_entries is None:
+                self._approx_entries = sum(1 for entry in os.scandir(self.directory) if entry.name.endswith('.json'))
+            else:
+                # Overwrites are counted too; evict() corrects the estimate
+                self._approx_entries += 1
+            over_budget = self._approx_entries > self.max_entries
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries down to 90% of max_entries, and
+        temp files of crashed writers; returns how many entries were removed
+
+        Does nothing when another worker is already evicting.
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                now = time.time()
+                entries = []
+                for entry in os.scandir(self.directory):
+                    try:
+                        mtime = entry.stat().st_mtime
+                        if entry.name.endswith(('.tmp', '.fill')) and now - mtime > self.STALE_TMP_AGE:
+                            os.remove(entry.path)
+                        elif entry.name.endswith('.json'):
+                            entries.append((mtime, entry.path))
+                    except OSError:
+                        continue
+                entries.sort()
+                excess = len(entries) - int(self.max_entries * 0.9) if self.max_entries else 0
+                removed = 0
+                for _, path in entries[:max(excess, 0)]:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+                with self._count_lock:
+                    self._approx_entries = len(entries) - removed
+                return removed
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single computation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """
+        Run fn() once for all concurrent callers sharing key
+
+        The first caller computes; the rest wait and receive the same result
+        (or the same exception).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines sharing one event loop"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        """Await fn() once for all concurrent callers sharing key"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # A caller that goes away does not cancel the others' result
+        return await asyncio.shield(task)
+
+
+class TieredCache:
+    """
+    Memory LRU in front of an optional shared disk tier, with single-flight fills
+
+    Values must be JSON-serializable when a disk tier is configured. Misses
+    are coalesced per process, and with a disk tier also across workers. Expired
+    values stay available to get_stale() for stale_ttl seconds, for answering
+    while the source is down.
+    """
+
+    def __init__(self, max_entries=256, default_ttl=300, disk_dir=None, stale_ttl=0, disk_max_entries=10000):
+        self.default_ttl = default_ttl
+        self.memory = LRUCache(max_entries=max_entries, default_ttl=default_ttl, stale_ttl=stale_ttl)
+        self.disk = DiskCache(
+            disk_dir, default_ttl=default_ttl, stale_ttl=stale_ttl, max_entries=disk_max_entries) if disk_dir else None
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self._stats_lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stale_hits': 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _get_memory(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+        return value
+
+    def _get_disk(self, key):
+        value = self.disk.get(key)
+        if value is not None:
+            self._count('disk_hits')
+            self.memory.set(key, value)
+        return value
+
+    def get(self, key):
+        value = self._get_memory(key)
+        if value is None and self.disk is not None:
+            value = self._get_disk(key)
+        return value
+
+    async def get_async(self, key):
+        """get() with the disk tier read on a thread, off the event loop"""
+        value = self._get_memory(key)
+        if value is None and self.disk is not None:
+            value = await asyncio.to_thread(self._get_disk, key)
+        return value
+
+    def get_stale(self, key):
+        """The value for key even if it expired less than stale_ttl ago, or None"""
+        value = self.memory.get(key, stale=True)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key, stale=True)
+        if value is not None:
+            self._count('stale_hits')
+        return value
+
+    async def get_stale_async(self, key):
+        if self.disk is None:
+            return self.get_stale(key)
+        return await asyncio.to_thread(self.get_stale, key)
+
+    def set(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+
+    async def set_async(self, key, value, ttl=None):
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value, ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """
+        Return the cached value for key, computing it at most once per miss
+
+        Concurrent misses are coalesced within the process, and with a disk
+        tier also across workers through the entry's fill lock.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        def compute_and_set():
+            self._count('misses')
+            result = compute()
+            self.set(key, result, ttl)
+            return result
+
+        def fill():
+            # Another flight may have filled the cache while we waited
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            if self.disk is None:
+                return compute_and_set()
+            with self.disk.fill_lock(key) as waited:
+                # Another worker may have filled the disk tier while we waited
+                cached = self.get(key) if waited else None
+                return cached if cached is not None else compute_and_set()
+
+        return self._flight.do(key, fill)
+
+    async def get_or_compute_async(self, key, compute, ttl=None):
+        """get_or_compute for a coroutine function, coalescing misses within the event loop and across workers"""
+        value = await self.get_async(key)
+        if value is not None:
+            return value
+
+        async def compute_and_set():
+            self._count('misses')
+            result = await compute()
+            await self.set_async(key, result, ttl)
+            return result
+
+        async def fill():
+            # A flight that finished after our miss may have filled the cache
+            cached = await self.get_async(key)
+            if cached is not None:
+                return cached
+            if self.disk is None:
+                return await compute_and_set()
+            async with self.disk.fill_lock_async(key) as waited:
+                cached = await self.get_async(key) if waited else None
+                return cached if cached is not None else await compute_and_set()
+
+        return await self._async_flight.do(key, fill)
@@ -0,0 +1,94 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from cache import SingleFlight
+from imaging import open_image, has_alpha
+from encoders import FORMATS, encode, format_mimetype
+
+logger = logging.getLogger(__name__)
+
+# Longest-edge sizes of the derivative pyramid
+DERIVATIVE_SIZES = (256, 1024, 2048)
+
+# Size the editor works with; larger versions are only built on demand
+EDITOR_SIZE = 1024
+
+# In order of preference; 'fallback' is JPEG, or PNG for images with transparency
+DERIVATIVE_FORMATS = tuple(fmt for fmt in ('avif', 'webp') if fmt in FORMATS) + ('fallback',)
+
+# Built right after upload: what most browsers negotiate, and the fallback
+EAGER_FORMATS = (DERIVATIVE_FORMATS[0], 'fallback')
+
+
+class DerivativeBuilder:
+    """
+    Builds downscaled AVIF/WebP (with JPEG/PNG fallback) versions of stored images
+
+    Derivatives requested before they exist are built inline on the request
+    thread; the ones every upload needs are queued on a bounded thread pool
+    right after the upload. Either way they are stored in the same blob store
+    as the originals and found again through refs, and concurrent requests
+    share one build, so each (image, size, format) is encoded at most once.
+    """
+
+    def __init__(self, store, max_workers=2, preset='balanced'):
+        self.store = store
+        self.preset = preset
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='derivatives')
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def ref_name(digest, size, fmt):
+        return f'derivative:{digest}:{size}:{fmt}'
+
+    def lookup(self, digest, size, fmt):
+        """Return the digest of an already built derivative, or None"""
+        return self.store.get_ref(self.ref_name(digest, size, fmt))
+
+    def get(self, digest, size, fmt):
+        """Return the derivative digest, building it on this thread if needed"""
+        cached = self.lookup(digest, size, fmt)
+        if cached:
+            return cached
+        # Waiting on the pool would only add a thread hop and queueing to the same work
+        return self._build_once(digest, size, fmt)
+
+    def schedule(self, digest, sizes=(EDITOR_SIZE,), formats=EAGER_FORMATS):
+        """Queue background generation without waiting for the result"""
+        for size in sizes:
+            for fmt in formats:
+                if not self.lookup(digest, size, fmt):
+                    future = self._executor.submit(self._build_once, digest, size, fmt)
+                    future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        error = future.exception()
+        if error is not None:
+            logger.warning(f'Derivative generation failed: {error}')
+
+    def _build_once(self, digest, size, fmt):
+        ref = self.ref_name(digest, size, fmt)
+        return self._flight.do(ref, lambda: self.lookup(digest, size, fmt) or self._build(digest, size, fmt))
+
+    def _build(self, digest, size, fmt):
+        with open_image(self.store.path(digest)) as image:
+            # Let the JPEG decoder downscale while decoding
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.LANCZOS)
+
+            output_format = fmt
+            if fmt == 'fallback':
+                output_format = 'png' if has_alpha(image) else 'jpeg'
+            output = encode(image, output_format, self.preset)
+
+        derivative = self.store.put_bytes(output.getvalue(), {
+            'content_type': format_mimetype(output_format),
+            'format': FORMATS[output_format][0],
+            'width': image.width,
+            'height': image.height,
+            'source': digest
+        })
+        self.store.set_ref(self.ref_name(digest, size, fmt), derivative)
+        return derivative
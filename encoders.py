@@ -0,0 +1,147 @@
+"""
+Image encoders with named presets
+
+Every image the app produces (exports, batch members, upload derivatives)
+is encoded here. A preset trades encode time against size:
+
+    fast      lowest CPU per image, larger files
+    balanced  the default (EXPORT_PRESET)
+    smallest  slowest, smallest files; PNGs are palette-quantized (lossy)
+
+`python bench/encoder_presets.py` measures size against encode time for every
+format and preset; the settings below follow its results.
+"""
+import io
+import os
+from PIL import Image, features
+from imaging import flatten, has_alpha
+
+PRESETS = ('fast', 'balanced', 'smallest')
+
+DEFAULT_PRESET = os.environ.get('EXPORT_PRESET', 'balanced')
+
+# format -> (Pillow format, file extension, MIME type); AVIF only where Pillow was built with it
+FORMATS = {
+    'png': ('PNG', 'png', 'image/png'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'jpg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+}
+if features.check('avif'):
+    FORMATS['avif'] = ('AVIF', 'avif', 'image/avif')
+
+# Pillow save options per format and preset. WebP methods above 2 and AVIF
+# speeds below 9 cost 2-4x the time for a few percent on a 2400x1256 export,
+# so only smallest uses them.
+ENCODER_OPTIONS = {
+    'PNG': {
+        'fast': {'compress_level': 1},
+        'balanced': {'compress_level': 6},
+        'smallest': {'compress_level': 9, 'optimize': True},
+    },
+    'JPEG': {
+        'fast': {'quality': 90},
+        'balanced': {'quality': 90, 'optimize': True, 'progressive': True},
+        'smallest': {'quality': 80, 'optimize': True, 'progressive': True},
+    },
+    'WEBP': {
+        'fast': {'quality': 85, 'method': 0},
+        'balanced': {'quality': 85, 'method': 2},
+        'smallest': {'quality': 75, 'method': 4},
+    },
+    'AVIF': {
+        'fast': {'quality': 70, 'speed': 10},
+        'balanced': {'quality': 65, 'speed': 9},
+        'smallest': {'quality': 55, 'speed': 7},
+    },
+}
+
+# PNG palette conversion: 'lossless' only when the image already has at most
+# 256 colours (flat graphics), a number quantizes to that many colours
+PNG_PALETTE = {
+    'fast': None,
+    'balanced': 'lossless',
+    'smallest': 256,
+}
+
+
+class EncoderError(ValueError):
+    """Raised for formats or presets that cannot be produced"""
+
+
+def resolve_format(fmt):
+    """Normalize a format name such as 'JPG' or 'webp'; raises EncoderError when unavailable"""
+    fmt = str(fmt or 'png').strip().lower()
+    if fmt not in FORMATS:
+        if fmt == 'avif':
+            raise EncoderError('AVIF output is not supported by this server')
+        raise EncoderError(f'Unsupported format: {fmt}')
+    return fmt
+
+
+def resolve_preset(preset):
+    preset = str(preset or DEFAULT_PRESET).strip().lower()
+    if preset not in PRESETS:
+        raise EncoderError(f"Unknown preset: {preset} (use {', '.join(PRESETS)})")
+    return preset
+
+
+def format_mimetype(fmt):
+    return FORMATS[fmt][2]
+
+
+def format_extension(fmt):
+    return FORMATS[fmt][1]
+
+
+def _to_palette(image, palette):
+    if palette == 'lossless':
+        if image.mode not in ('RGB', 'L') or image.getcolors(256) is None:
+            return image
+        return image.convert('P', palette=Image.ADAPTIVE, colors=256)
+    # Octree is the only built-in quantizer that keeps alpha
+    method = Image.Quantize.FASTOCTREE if image.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+    return image.quantize(colors=palette, method=method)
+
+
+def prepare(image, save_format, preset):
+    """Convert an image to a mode the encoder stores efficiently"""
+    if save_format == 'JPEG':
+        return flatten(image)
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA' if has_alpha(image) else 'RGB')
+    if save_format == 'PNG' and PNG_PALETTE[preset]:
+        image = _to_palette(image, PNG_PALETTE[preset])
+    return image
+
+
+def encode(image, fmt, preset=None, **options):
+    """
+    Encode an image as fmt with a preset; extra options override the preset's
+
+    Returns a BytesIO positioned at 0. Transparent images are flattened onto
+    white for JPEG.
+    """
+    fmt = resolve_format(fmt)
+    preset = resolve_preset(preset)
+    save_format = FORMATS[fmt][0]
+    save_options = dict(ENCODER_OPTIONS[save_format][preset], **options)
+
+    output = io.BytesIO()
+    prepare(image, save_format, preset).save(output, format=save_format, **save_options)
+    output.seek(0)
+    return output
+
+
+def negotiate(accept, candidates=('avif', 'webp')):
+    """
+    First of candidates the client explicitly lists in its Accept header, or None
+
+    accept is Werkzeug's MIMEAccept (request.accept_mimetypes). A wildcard
+    does not count: browsers send */* for images they cannot decode.
+    """
+    listed = {value.lower(): quality for value, quality in accept}
+    for fmt in candidates:
+        if fmt in FORMATS and listed.get(format_mimetype(fmt), 0) > 0:
+            return fmt
+    return None
@@ -0,0 +1,80 @@
+"""
+Rendered exports keyed on the submitted canvas
+
+Users often click export twice, or export one design as PNG and then as
+PDF. Each export request body is hashed as it is read (sha256), and the
+finished file is stored in a BlobStore under a ref built from that hash,
+the kind of export and the options that change the output. Repeating a
+request then costs one hash of the body and a file send; Pillow and
+ReportLab are never loaded for it.
+
+The store is size-bounded (EXPORT_CACHE_MAX_BYTES) with LRU eviction, and
+swept by the storage janitor like the other stores.
+"""
+import hashlib
+from metrics import registry as metrics_registry
+
+# Bump when a renderer or encoder change alters the output for the same input
+CACHE_VERSION = 1
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+export_cache_requests = metrics_registry.counter(
+    'export_cache_requests_total', 'Exports answered from the export cache (hit) or rendered (miss)', ('kind', 'result'))
+
+
+class HashingReader:
+    """File-like wrapper that feeds everything read through it into a sha256"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hash.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def hash_stream(stream, chunk_size=HASH_CHUNK_SIZE):
+    """sha256 of a seekable stream's contents, leaving it at position 0"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class ExportCache:
+    """Finished exports by (kind, canvas hash, options), stored in a BlobStore"""
+
+    def __init__(self, store, enabled=True):
+        self.store = store
+        self.enabled = enabled
+
+    def key(self, kind, canvas_digest, **options):
+        """
+        Ref name for an export, or None when caching is off or the body was not hashed
+
+        options are the settings that change the output bytes.
+        """
+        if not self.enabled or not canvas_digest:
+            return None
+        settings = ','.join(f'{name}={options[name]}' for name in sorted(options))
+        return f'export:v{CACHE_VERSION}:{kind}:{canvas_digest}:{settings}'
+
+    def get(self, key, kind):
+        """Digest of the stored export for key, or None"""
+        digest = self.store.get_ref(key)
+        export_cache_requests.inc(kind, 'hit' if digest else 'miss')
+        return digest
+
+    def put(self, key, data, content_type):
+        """Store a finished export under key and return its digest (also its ETag)"""
+        digest = self.store.put_bytes(data, {'content_type': content_type})
+        self.store.set_ref(key, digest)
+        return digest
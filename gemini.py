@@ -0,0 +1,392 @@
+"""Gemini model access, with stub clients for running without an API key"""
+import io
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from PIL import Image
+from cache import SingleFlight, AsyncSingleFlight
+from metrics import upstream_call
+from upstream_guard import UpstreamUnavailable, gemini_guard, http_status
+
+IMAGE_MODEL = 'gemini-2.0-flash-preview-image-generation'
+TEXT_MODEL = 'gemini-2.5-flash'
+
+MAX_TEXT_LENGTH = 200
+TEXT_TYPES = ('title', 'subtitle', 'both')
+
+
+class GeminiError(Exception):
+    """A Gemini failure with the HTTP status and message to report to the client"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# google.genai error status -> (HTTP status for our client, message)
+ERROR_STATUSES = {
+    'RESOURCE_EXHAUSTED': (402, 'Gemini API quota exceeded. Please check your usage limits.'),
+    'UNAUTHENTICATED': (401, 'Invalid Gemini API key. Please verify your key is correct.'),
+    'PERMISSION_DENIED': (401, 'Invalid Gemini API key. Please verify your key is correct.'),
+    'NOT_FOUND': (503, 'Gemini {model} model not available. Please try again later.'),
+    'INVALID_ARGUMENT': (400, '{action} request was rejected by Gemini. Please change the prompt and try again.'),
+}
+
+# Used when an error carries only an HTTP status
+HTTP_ERROR_STATUSES = {
+    400: 'INVALID_ARGUMENT', 401: 'UNAUTHENTICATED', 403: 'PERMISSION_DENIED', 404: 'NOT_FOUND', 429: 'RESOURCE_EXHAUSTED'
+}
+
+
+def classify_error(error, action='Image generation', model='image generation'):
+    """
+    Map an exception from a Gemini call to a GeminiError
+
+    Looks at the structured status of google-genai's APIError (`status`,
+    e.g. RESOURCE_EXHAUSTED, and the HTTP `code`) or of an HTTP response,
+    never at the message text.
+    """
+    if isinstance(error, GeminiError):
+        return error
+    if isinstance(error, UpstreamUnavailable):
+        return GeminiError(f'{action} is temporarily unavailable, please retry in a few seconds.', 503)
+    code = http_status(error)
+    status = getattr(error, 'status', None)
+    if not isinstance(status, str) or status not in ERROR_STATUSES:
+        status = HTTP_ERROR_STATUSES.get(code)
+    if status:
+        http_code, message = ERROR_STATUSES[status]
+        return GeminiError(message.format(action=action, model=model), http_code)
+    if code is not None and code >= 500:
+        return GeminiError(f'Gemini API is unavailable ({code}). Please try again later.', 503)
+    # The SDK talks to the API through httpx
+    import httpx
+    if isinstance(error, (TimeoutError, httpx.TimeoutException)):
+        return GeminiError(f'{action} timed out. Please try again later.', 504)
+    return GeminiError(f'{action} failed: {error}', 500)
+
+
+def classify_image_error(error):
+    """Map an exception from image generation to a GeminiError"""
+    return classify_error(error, 'Image generation', 'image generation')
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def is_stubbed():
+    return os.environ.get('GEMINI_STUB', '').lower() in ('1', 'true', 'yes')
+
+
+def genai_client():
+    """
+    Return the per-worker google-genai client, creating it on first use
+
+    Reusing one client keeps its HTTP connections alive between calls.
+    Raises GeminiError (503) when GEMINI_API_KEY is missing.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                api_key = os.environ.get('GEMINI_API_KEY')
+                if not api_key:
+                    raise GeminiError('Gemini API key not configured. Please check your API key.', 503)
+                # The SDK takes longer to import than the rest of the app; load it on first use
+                from google import genai
+
+                # GEMINI_API_BASE points the SDK at another endpoint (e.g. the benchmark fakes)
+                base_url = os.environ.get('GEMINI_API_BASE')
+                http_options = {'base_url': base_url} if base_url else None
+                _client = genai.Client(api_key=api_key, http_options=http_options)
+    return _client
+
+
+class GeminiImageClient:
+    """Image generation through the Gemini API"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def generate_image(self, prompt):
+        """Return (image bytes, MIME type) for a prompt"""
+        from google.genai import types
+        
+        with gemini_guard.call(), upstream_call('gemini', 'image'):
+            response = self.client.models.generate_content(
+                model=IMAGE_MODEL,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    response_modalities=['TEXT', 'IMAGE']))
+
+        if not response.candidates:
+            raise GeminiError('No image generated by Gemini', 500)
+
+        content = response.candidates[0].content
+        if not content or not content.parts:
+            raise GeminiError('Invalid response from Gemini API', 500)
+
+        # Find the image data in the response
+        for part in content.parts:
+            if part.inline_data and part.inline_data.data:
+                return part.inline_data.data, part.inline_data.mime_type or 'image/png'
+
+        raise GeminiError('No image data found in Gemini response', 500)
+
+
+class StubImageClient:
+    """
+    Local stand-in for the image model (GEMINI_STUB=1)
+
+    Sleeps for GEMINI_STUB_LATENCY seconds and returns a gradient whose colors
+    are derived from the prompt, so identical prompts give identical images.
+    """
+
+    def __init__(self, latency=2.0, size=(1024, 1024)):
+        self.latency = latency
+        self.size = size
+
+    def generate_image(self, prompt):
+        from PIL import ImageDraw
+        
+        time.sleep(self.latency)
+        seed = hashlib.sha256(prompt.encode('utf-8')).digest()
+        start, end = seed[:3], seed[3:6]
+        width, height = self.size
+        image = Image.new('RGB', self.size)
+        draw = ImageDraw.Draw(image)
+        for y in range(height):
+            t = y / max(height - 1, 1)
+            draw.line([(0, y), (width, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(start, end)))
+        draw.text((24, 24), prompt[:80], fill=(255, 255, 255))
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        return output.getvalue(), 'image/png'
+
+
+def image_client():
+    """Image client for a new job; raises GeminiError when Gemini is not configured"""
+    if is_stubbed():
+        return StubImageClient(float(os.environ.get('GEMINI_STUB_LATENCY', 2)))
+    return GeminiImageClient(genai_client())
+
+
+def variants_prompt(prompt, text_type, count):
+    """Ask for several alternatives in one call so 'regenerate' needs no new request"""
+    if text_type == 'both':
+        return f"""
+            Generate {count} different pairs of a compelling advertising title and subtitle for: {prompt}
+            
+            Requirements:
+            - Title: Short, catchy, max 10 words, under 200 characters
+            - Subtitle: Persuasive tagline that complements the title, max 15 words, under 200 characters
+            - Make every pair clearly different in angle or wording
+            - Return in JSON format: [{{"title": "Your Title", "subtitle": "Your Subtitle"}}, ...]
+            - Only return the JSON, nothing else
+            """
+    if text_type == 'title':
+        return f"Generate {count} different compelling, concise ad titles (maximum 200 characters, preferably under 8 words) for: {prompt}. Return only a JSON array of the title strings, no explanations."
+    return f"Generate {count} different engaging subtitles or descriptions (maximum 200 characters, preferably under 25 words) for: {prompt}. Return only a JSON array of the subtitle strings, no explanations."
+
+
+def clean_text(text):
+    """Strip surrounding quotes and whitespace and cap the length"""
+    text = str(text or '').strip()
+    for quote in ('"', "'"):
+        if len(text) > 1 and text.startswith(quote) and text.endswith(quote):
+            text = text[1:-1].strip()
+    return text[:MAX_TEXT_LENGTH].strip()
+
+
+def parse_variants(text, text_type, prompt):
+    """Turn a model reply into a list of variants, falling back to one per line"""
+    text = text.strip()
+    # Remove any markdown formatting if present
+    if text.startswith('```'):
+        text = re.sub(r'^```(?:json)?|```$', '', text).strip()
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, (dict, str)):
+        data = [data]
+
+    variants = []
+    for item in data if isinstance(data, list) else []:
+        if text_type == 'both' and isinstance(item, dict):
+            variant = {'title': clean_text(item.get('title')), 'subtitle': clean_text(item.get('subtitle'))}
+            if variant['title'] or variant['subtitle']:
+                variants.append(variant)
+        elif text_type != 'both' and isinstance(item, str) and clean_text(item):
+            variants.append(clean_text(item))
+    if variants:
+        return variants
+
+    # Fallback: take the text line by line
+    lines = [clean_text(line) for line in text.split('\n') if clean_text(line)]
+    if text_type == 'both':
+        return [{
+            'title': lines[0] if len(lines) > 0 else f"Amazing {prompt}"[:MAX_TEXT_LENGTH],
+            'subtitle': lines[1] if len(lines) > 1 else f"Discover the best {prompt}"[:MAX_TEXT_LENGTH]
+        }]
+    return lines[:1]
+
+
+class GeminiTextClient:
+    """Ad copy generation through the Gemini API"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def generate_variants(self, prompt, text_type, count):
+        """Return up to count variants: strings, or {title, subtitle} dicts for 'both'"""
+        with gemini_guard.call(), upstream_call('gemini', 'text'):
+            response = self.client.models.generate_content(
+                model=TEXT_MODEL,
+                contents=variants_prompt(prompt, text_type, count)
+            )
+        return self._variants(response, prompt, text_type, count)
+
+    async def generate_variants_async(self, prompt, text_type, count):
+        """generate_variants on the SDK's asyncio client"""
+        async with gemini_guard.acall():
+            with upstream_call('gemini', 'text'):
+                response = await self.client.aio.models.generate_content(
+                    model=TEXT_MODEL,
+                    contents=variants_prompt(prompt, text_type, count)
+                )
+        return self._variants(response, prompt, text_type, count)
+
+    @staticmethod
+    def _variants(response, prompt, text_type, count):
+        if not response or not response.text:
+            raise GeminiError('No text generated', 500)
+        variants = parse_variants(response.text, text_type, prompt)
+        if not variants:
+            raise GeminiError('No text generated', 500)
+        return variants[:count]
+
+
+class StubTextClient:
+    """Local stand-in for the text model (GEMINI_STUB=1)"""
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def generate_variants(self, prompt, text_type, count):
+        time.sleep(self.latency)
+        return self._variants(prompt, text_type, count)
+
+    async def generate_variants_async(self, prompt, text_type, count):
+        await asyncio.sleep(self.latency)
+        return self._variants(prompt, text_type, count)
+
+    @staticmethod
+    def _variants(prompt, text_type, count):
+        subject = prompt.strip().title()
+        if text_type == 'both':
+            return [{'title': f'{subject} #{n}', 'subtitle': f'Discover {prompt.strip()}, take {n}'} for n in range(1, count + 1)]
+        return [f'{subject} {text_type} #{n}' for n in range(1, count + 1)]
+
+
+def text_client():
+    """Text client for a request; raises GeminiError when Gemini is not configured"""
+    if is_stubbed():
+        return StubTextClient(float(os.environ.get('GEMINI_STUB_LATENCY', 0.5)))
+    return GeminiTextClient(genai_client())
+
+
+def normalize_prompt(prompt):
+    """Case, spacing and trailing punctuation do not change what the model is asked"""
+    return re.sub(r'\s+', ' ', prompt).strip().strip('.!?,;:').strip().casefold()
+
+
+class TextVariantCache:
+    """
+    Generated text variants per normalized (prompt, type)
+
+    One model call yields batch_size variants. Request n of the same prompt
+    (the editor's "regenerate") is answered from the cached list, and a new
+    batch is requested only once the list runs out. After max_variants the
+    list is cycled instead of calling the model again, and so is whatever was
+    generated for the prompt before while Gemini is unavailable.
+    """
+
+    def __init__(self, cache, batch_size=5, max_variants=20):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_variants = max_variants
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+
+    @staticmethod
+    def key(prompt, text_type):
+        return f'gemini-text:{text_type}:{normalize_prompt(prompt)}'
+
+    def get(self, prompt, text_type, index, make_client):
+        """
+        Return (variant, index served, whether it came from the cache)
+
+        make_client() builds the text client and is only called on a miss,
+        so cached variants are served without loading the Gemini SDK (or an
+        API key).
+        """
+        key = self.key(prompt, text_type)
+        variants = self.cache.get(key) or []
+        cached = index < len(variants) or len(variants) >= self.max_variants
+        if not cached:
+            try:
+                # Concurrent requests for the same missing batch share one model call
+                variants = self._flight.do(f'{key}:{len(variants)}', lambda: self._extend(key, prompt, text_type, make_client))
+            except UpstreamUnavailable:
+                # Keep cycling what was generated before, even if it expired
+                variants, cached = variants or self.cache.get_stale(key), True
+                if not variants:
+                    raise
+        index %= len(variants)
+        return variants[index], index, cached
+
+    async def get_async(self, prompt, text_type, index, make_client):
+        """get() for the asyncio entry point; make_client() must return a client with generate_variants_async"""
+        key = self.key(prompt, text_type)
+        variants = await self.cache.get_async(key) or []
+        cached = index < len(variants) or len(variants) >= self.max_variants
+        if not cached:
+            async def extend():
+                current = await self.cache.get_async(key) or []
+                generated = await make_client().generate_variants_async(prompt, text_type, self.batch_size)
+                merged = self._merged(current, generated)
+                await self.cache.set_async(key, merged)
+                return merged
+            try:
+                variants = await self._async_flight.do(f'{key}:{len(variants)}', extend)
+            except UpstreamUnavailable:
+                # Keep cycling what was generated before, even if it expired
+                variants, cached = variants or await self.cache.get_stale_async(key), True
+                if not variants:
+                    raise
+        index %= len(variants)
+        return variants[index], index, cached
+
+    def _extend(self, key, prompt, text_type, make_client):
+        current = self.cache.get(key) or []
+        return self._merge(key, current, make_client().generate_variants(prompt, text_type, self.batch_size))
+
+    def _merge(self, key, current, generated):
+        variants = self._merged(current, generated)
+        self.cache.set(key, variants)
+        return variants
+
+    def _merged(self, current, generated):
+        fresh = [variant for variant in generated if variant not in current]
+        variants = (current + fresh)[:self.max_variants] or current
+        if not variants:
+            raise GeminiError('No text generated', 500)
+        return variants
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings, picked up automatically from the working directory
+
+Command-line flags (such as --bind in .replit) still take precedence.
+"""
+import os
+import time
+import importlib
+
+# Import the app once in the master and fork workers from it. Leave off with
+# --reload, which needs each worker to import the code itself.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+# SDKs the app imports lazily on first use; with a preloaded app and several
+# workers, importing them once in the master shares them with every worker
+WARM_IMPORTS = ('google.genai', 'reportlab.pdfgen.canvas', 'scene_renderer', 'pdf_renderer')
+
+
+def when_ready(server):
+    """Runs in the master before the first worker is forked"""
+    if not (server.cfg.preload_app and server.cfg.workers > 1):
+        return
+    started = time.perf_counter()
+    for module in WARM_IMPORTS:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            server.log.warning(f'Could not preload {module}: {e}')
+    server.log.info(f'Preloaded {", ".join(WARM_IMPORTS)} in {(time.perf_counter() - started) * 1000:.0f} ms')
@@ -0,0 +1,153 @@
+"""
+Bounded decoding for images that come from clients or upstream APIs
+
+Every route that opens an image goes through here, so one pixel budget
+applies everywhere. Dimensions are read from the header and checked before
+any pixel data is decoded; raw request bodies are checked after their first
+chunk, so an oversized canvas is refused without reading the rest of it.
+JPEGs that are only needed at a smaller size are scaled down by the decoder
+itself (draft), which never allocates the full-resolution bitmap.
+"""
+import io
+import os
+import warnings
+from PIL import Image, UnidentifiedImageError
+
+ALLOWED_FORMATS = ('PNG', 'JPEG', 'GIF', 'BMP', 'WEBP')
+
+# 50 MP is an 8K x 6K canvas, about 200 MB as RGBA
+MAX_IMAGE_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+MAX_IMAGE_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 16384))
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Pillow's own bomb check stays on as a backstop for code that calls Image.open directly.
+# Its warning (between 1x and 2x the limit) is silenced: check_dimensions refuses those with a 413.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+
+class ImageDecodeError(ValueError):
+    """An image that cannot be accepted, with the HTTP status to report"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def check_dimensions(width, height, max_pixels=None):
+    """Raise ImageDecodeError (413) when a width x height image is over the budget"""
+    max_pixels = MAX_IMAGE_PIXELS if max_pixels is None else max_pixels
+    if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION or width * height > max_pixels:
+        raise ImageDecodeError(
+            f'Image is too large ({width}x{height}); the limit is {max_pixels / 1_000_000:g} megapixels '
+            f'and {MAX_IMAGE_DIMENSION}px per side.', 413)
+
+
+def open_image(source, formats=ALLOWED_FORMATS, max_pixels=None):
+    """
+    Open an image lazily and check its header dimensions
+
+    Nothing but the header has been read when this returns; pixels are only
+    decoded by load() or the first operation that needs them.
+    """
+    try:
+        image = Image.open(source, formats=formats)
+    except Image.DecompressionBombError:
+        raise ImageDecodeError('Image is too large.', 413)
+    except UnidentifiedImageError:
+        raise ImageDecodeError('Unsupported or corrupt image. Please use PNG, JPG, GIF, BMP, or WEBP.')
+    try:
+        check_dimensions(image.width, image.height, max_pixels)
+    except ImageDecodeError:
+        image.close()
+        raise
+    return image
+
+
+def decode_image(source, max_size=None, formats=ALLOWED_FORMATS, max_pixels=None):
+    """
+    Open, check and fully decode an image
+
+    With max_size=(width, height), a JPEG is decoded at the smallest 1/2,
+    1/4 or 1/8 scale that still covers that size; other formats decode at
+    full size. The result may therefore be larger than max_size, never
+    smaller; callers resize exactly afterwards.
+    """
+    image = open_image(source, formats, max_pixels)
+    try:
+        if max_size and image.format == 'JPEG':
+            image.draft(image.mode, max_size)
+        image.load()
+    except (OSError, SyntaxError, ValueError) as e:
+        image.close()
+        raise ImageDecodeError(f'Could not decode image: {e}')
+    return image
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def flatten(image, background=(255, 255, 255)):
+    """
+    Composite an image with transparency onto a solid background, as RGB
+
+    The image itself serves as the paste mask (Pillow uses its alpha band),
+    so no channel is split out and no intermediate copy is made; only
+    palette images need one conversion first. Images without alpha are only
+    converted when they are not already RGB or L.
+    """
+    if not has_alpha(image):
+        return image if image.mode in ('RGB', 'L') else image.convert('RGB')
+    if image.mode in ('P', 'PA'):
+        image = image.convert('RGBA')
+    result = Image.new('RGB', image.size, background)
+    result.paste(image, mask=image)
+    return result
+
+
+def _probe_header(data, max_pixels):
+    """Check the dimensions in an image's first bytes; False when they do not hold the full header yet"""
+    try:
+        with Image.open(io.BytesIO(data), formats=ALLOWED_FORMATS) as header:
+            check_dimensions(header.width, header.height, max_pixels)
+        return True
+    except ImageDecodeError:
+        raise
+    except Image.DecompressionBombError:
+        raise ImageDecodeError('Image is too large.', 413)
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        return False
+
+
+def read_image_stream(stream, max_pixels=None, chunk_size=READ_CHUNK_SIZE, header_limit=1024 * 1024):
+    """
+    Read an image upload stream into memory, checking its dimensions early
+
+    The header is probed after the first chunk and again each time the data
+    read so far has doubled, over at most the first header_limit bytes, so
+    the prefix is copied O(header_limit) times in total. An image over the
+    budget is refused before the rest is read. The chunks go into one
+    buffer, which is returned as a BytesIO positioned at 0 (None for an
+    empty stream).
+    """
+    buffer = io.BytesIO()
+    checked = False
+    next_probe = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer.write(chunk)
+        if not checked and buffer.tell() >= next_probe:
+            with buffer.getbuffer() as view:
+                prefix = bytes(view[:header_limit])
+            # Header incomplete so far; open_image has the final say on the whole body
+            checked = _probe_header(prefix, max_pixels) or len(prefix) >= header_limit
+            next_probe = buffer.tell() * 2
+    if not buffer.tell():
+        return None
+    buffer.seek(0)
+    return buffer
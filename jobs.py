@@ -0,0 +1,209 @@
+"""
+Background jobs for slow upstream calls
+
+Job records are JSON files in a directory shared by every worker on the
+machine, so a status poll can land on any worker. The worker that accepted a
+job runs it on its own bounded thread pool and wakes local listeners
+directly; other workers notice changes by re-reading the record.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class JobError(Exception):
+    """A job failure with the HTTP status and message to report to the client"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class JobLimitError(JobError):
+    """Raised when a submission would exceed the per-user or global job limits"""
+
+
+def is_valid_job_id(job_id):
+    return isinstance(job_id, str) and len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+
+class JobStore:
+    """Job records as atomically replaced JSON files, plus a lock file for submissions"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock_path = os.path.join(directory, '.lock')
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def get(self, job_id):
+        if not is_valid_job_id(job_id):
+            return None
+        try:
+            with open(self._path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, job):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(job, f)
+            os.replace(tmp_path, self._path(job['id']))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except OSError:
+            pass
+
+    def iter_jobs(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                job = self.get(entry.name[:-5])
+                if job is not None:
+                    yield job
+
+    @contextmanager
+    def locked(self):
+        """Exclusive lock across every worker process on the machine"""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class JobQueue:
+    """
+    Runs submitted jobs on a bounded thread pool
+
+    Each user may have at most per_user_limit queued or running jobs and the
+    machine at most max_pending; both are counted from the shared store under
+    its lock so the limits hold across workers. Running jobs whose record has
+    not been updated for stale_after seconds (for example after a worker
+    crash) are reported as failed. Finished records are removed after ttl.
+    """
+
+    def __init__(self, store, max_workers=4, per_user_limit=2, max_pending=32, ttl=3600, stale_after=300):
+        self.store = store
+        self.per_user_limit = per_user_limit
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.stale_after = stale_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobs')
+        self._changed = threading.Condition()
+
+    def _is_stale(self, job, now):
+        return job['status'] in ACTIVE_STATES and now - job['updated'] > self.stale_after
+
+    def _expire(self, job, now):
+        """Mark an abandoned job as failed in the returned copy"""
+        if self._is_stale(job, now):
+            job = dict(job, status=FAILED, error={'status': 504, 'message': 'Job timed out'})
+        return job
+
+    def _sweep(self, now):
+        for job in self.store.iter_jobs():
+            finished = job.get('finished') or (job['updated'] if self._is_stale(job, now) else None)
+            if finished and now - finished > self.ttl:
+                self.store.delete(job['id'])
+
+    def submit(self, user, fn, kind='job', **params):
+        """
+        Queue fn(**params) and return the new job record
+
+        fn returns a JSON-serializable result; raising JobError reports its
+        status and message, any other exception a generic failure.
+        """
+        now = time.time()
+        with self.store.locked():
+            self._sweep(now)
+            active = [job for job in self.store.iter_jobs() if job['status'] in ACTIVE_STATES and not self._is_stale(job, now)]
+            if len(active) >= self.max_pending:
+                raise JobLimitError('The generator is busy. Please try again in a moment.', 503)
+            if sum(1 for job in active if job['user'] == user) >= self.per_user_limit:
+                raise JobLimitError(f'You can run at most {self.per_user_limit} generations at a time.', 429)
+
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'user': user,
+                'status': QUEUED,
+                'created': now,
+                'updated': now,
+                'started': None,
+                'finished': None,
+                'result': None,
+                'error': None
+            }
+            self.store.save(job)
+
+        self._executor.submit(self._run, job, fn, params)
+        return dict(job)
+
+    def _update(self, job, **fields):
+        fields['updated'] = time.time()
+        job.update(fields)
+        self.store.save(job)
+        with self._changed:
+            self._changed.notify_all()
+
+    def _run(self, job, fn, params):
+        self._update(job, status=RUNNING, started=time.time())
+        try:
+            result = fn(**params)
+        except JobError as e:
+            self._update(job, status=FAILED, finished=time.time(), error={'status': e.status, 'message': e.message})
+        except Exception as e:
+            logger.error(f"Job {job['id']} ({job['kind']}) failed: {e}")
+            self._update(job, status=FAILED, finished=time.time(), error={'status': 500, 'message': 'Job failed. Please try again.'})
+        else:
+            self._update(job, status=SUCCEEDED, finished=time.time(), result=result)
+
+    def get(self, job_id):
+        job = self.store.get(job_id)
+        return None if job is None else self._expire(job, time.time())
+
+    def wait(self, job_id, since, timeout):
+        """
+        Block until the job's record changes after `since` or timeout passes
+
+        Wakes immediately for jobs running in this worker; for jobs owned by
+        another worker the record is re-read every half second.
+        """
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['updated'] > since or job['status'] not in ACTIVE_STATES or remaining <= 0:
+                return job
+            with self._changed:
+                self._changed.wait(min(remaining, 0.5))
@@ -0,0 +1,322 @@
+"""
+Request metrics in Prometheus text format
+
+Counters and histograms live in each worker's memory. With a shared
+directory configured, every worker periodically writes a snapshot there and
+/metrics adds up the snapshots of all live workers, so a scrape that lands
+on any worker sees the whole machine. Snapshots of workers that have exited
+are dropped, which Prometheus treats as a counter reset.
+
+Phase timers attribute a request's time to steps such as body parsing,
+decoding, encoding or upstream calls:
+
+    with phase('decode'):
+        image.load()
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; covers quick cache hits up to slow image generation
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    """A monotonically increasing value per label combination"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        key = tuple(str(value) for value in label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(target, samples):
+        for key, value in samples:
+            key = tuple(key)
+            target[key] = target.get(key, 0) + value
+
+    def render(self, values):
+        lines = []
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Observations counted into fixed buckets per label combination"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        key = tuple(str(label) for label in label_values)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            # Per-bucket counts (not cumulative), then the +Inf bucket and the sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts)] for key, counts in self._values.items()]
+
+    @staticmethod
+    def merge(target, samples):
+        for key, counts in samples:
+            key = tuple(key)
+            current = target.get(key)
+            if current is None or len(current) != len(counts):
+                target[key] = list(counts)
+            else:
+                target[key] = [a + b for a, b in zip(current, counts)]
+
+    def render(self, values):
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", _format_value(bound))])} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {round(counts[-1], 6)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """The metrics of one process, optionally aggregated across workers through a directory"""
+
+    def __init__(self, directory=None, flush_interval=5):
+        self.directory = None
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._last_flush = 0
+        self.set_directory(directory)
+
+    def set_directory(self, directory):
+        """Share snapshots through directory; None keeps metrics per worker"""
+        self.directory = directory or None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def counter(self, name, documentation, labels=()):
+        return self._metrics.setdefault(name, Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def flush(self, force=False):
+        """Write this worker's snapshot for the others, at most every flush_interval seconds"""
+        if not self.directory:
+            return
+        now = time.time()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path(os.getpid()))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _worker_snapshots(self):
+        """Snapshots written by other live workers; files of exited workers are removed"""
+        if not self.directory:
+            return
+        for entry in os.listdir(self.directory):
+            name, ext = os.path.splitext(entry)
+            if ext != '.json' or not name.isdigit() or int(name) == os.getpid():
+                continue
+            try:
+                os.kill(int(name), 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(os.path.join(self.directory, entry))
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.directory, entry), 'r', encoding='utf-8') as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def render(self):
+        """Prometheus text exposition of all workers' metrics"""
+        merged = {name: {} for name in self._metrics}
+        snapshots = [self.snapshot()]
+        snapshots.extend(self._worker_snapshots())
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                if name in self._metrics:
+                    self._metrics[name].merge(merged[name], samples)
+
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            lines.extend(metric.render(merged[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTimer:
+    """Phase durations of the request being handled"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing header value, shown in the browser's network panel"""
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.phases.items())
+
+
+_current_timer = ContextVar('request_timer', default=None)
+
+
+def start_request(endpoint):
+    timer = RequestTimer(endpoint)
+    _current_timer.set(timer)
+    return timer
+
+
+def finish_request():
+    timer = _current_timer.get()
+    _current_timer.set(None)
+    return timer
+
+
+@contextmanager
+def phase(name):
+    """Time a step of the current request; does nothing outside a request"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+# The app points this at METRICS_FOLDER
+registry = Registry(flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)))
+
+http_requests = registry.counter(
+    'http_requests_total', 'Requests handled, by endpoint, method and status', ('endpoint', 'method', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time from request start until the response body was sent', ('endpoint',))
+http_request_bytes = registry.counter(
+    'http_request_bytes_total', 'Request body bytes received', ('endpoint',))
+http_response_bytes = registry.counter(
+    'http_response_bytes_total', 'Response body bytes sent', ('endpoint',))
+request_phase_duration = registry.histogram(
+    'request_phase_duration_seconds', 'Time spent in each phase of a request', ('endpoint', 'phase'))
+upstream_duration = registry.histogram(
+    'upstream_request_duration_seconds', 'Latency of calls to external APIs', ('upstream', 'operation', 'outcome'))
+slow_requests_profiled = registry.counter(
+    'slow_requests_profiled_total', 'Requests over the profiling threshold whose samples were saved', ('endpoint',))
+
+
+class UpstreamCall:
+    """Outcome of one external call; callers may set an HTTP status instead of 'ok'"""
+
+    def __init__(self):
+        self.outcome = 'ok'
+
+
+@contextmanager
+def upstream_call(upstream, operation):
+    """Record the latency of an external API call, and count it as a phase of the current request"""
+    call = UpstreamCall()
+    started = time.perf_counter()
+    try:
+        with phase(f'{upstream}_{operation}'):
+            yield call
+    except BaseException:
+        call.outcome = 'error'
+        raise
+    finally:
+        upstream_duration.observe(time.perf_counter() - started, upstream, operation, call.outcome)
+
+
+def record_request(timer, method, status, request_bytes, response_bytes):
+    """Fold a finished request into the metrics"""
+    endpoint = timer.endpoint
+    http_requests.inc(endpoint, method, status)
+    http_request_duration.observe(timer.elapsed(), endpoint)
+    if request_bytes:
+        http_request_bytes.inc(endpoint, amount=request_bytes)
+    if response_bytes:
+        http_response_bytes.inc(endpoint, amount=response_bytes)
+    for name, seconds in timer.phases.items():
+        request_phase_duration.observe(seconds, endpoint, name)
+    registry.flush()
@@ -0,0 +1,235 @@
+"""Render Fabric.js scene JSON as a vector PDF with ReportLab"""
+import io
+import os
+import threading
+from reportlab.pdfgen import canvas
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.utils import ImageReader
+from cache import LRUCache
+from imaging import open_image
+from scene import (
+    CSS_DPI, TEXT_TYPES, parse_scene_document, parse_color, object_size,
+    object_center, absolute_clip_box, font_resolver, primary_family, is_bold,
+    is_italic, layout_text, load_scene_image, image_source
+)
+
+POINTS_PER_PIXEL = 72.0 / CSS_DPI
+
+# PDF text render modes
+TEXT_FILL = 0
+TEXT_FILL_STROKE = 2
+
+# Standard PDF fonts used when no TrueType file is available
+BASE14_FONTS = {
+    (False, False): 'Helvetica',
+    (True, False): 'Helvetica-Bold',
+    (False, True): 'Helvetica-Oblique',
+    (True, True): 'Helvetica-BoldOblique',
+}
+
+_font_lock = threading.Lock()
+_registered_fonts = {}
+
+def reader_bytes(reader):
+    """Memory an ImageReader may hold once ReportLab has decoded it"""
+    width, height = reader.getSize()
+    return width * height * 4
+
+
+# ImageReaders for repeated images (logos, backgrounds), shared across documents, bounded by decoded size
+_image_readers = LRUCache(
+    max_entries=int(os.environ.get('PDF_IMAGE_CACHE_SIZE', 32)),
+    default_ttl=3600,
+    max_bytes=int(os.environ.get('PDF_IMAGE_CACHE_BYTES', 128 * 1024 * 1024)),
+    sizeof=reader_bytes
+)
+
+
+def register_font(obj):
+    """
+    Return the ReportLab font name for a text object, registering its TrueType
+    file once per process (ReportLab embeds only the glyphs actually used)
+    """
+    bold = is_bold(obj.get('fontWeight'))
+    italic = is_italic(obj.get('fontStyle'))
+    path = font_resolver.find(primary_family(obj.get('fontFamily')), bold, italic)
+    if path is None:
+        return BASE14_FONTS[(bold, italic)]
+
+    with _font_lock:
+        name = _registered_fonts.get(path)
+        if name is None:
+            name = 'Scene-' + os.path.splitext(os.path.basename(path))[0]
+            pdfmetrics.registerFont(TTFont(name, path))
+            _registered_fonts[path] = name
+    return name
+
+
+def image_reader(src, resolve_asset):
+    """Cached ImageReader for a scene image; JPEG files are embedded without re-encoding"""
+    if not src:
+        return None
+    path = None if src.startswith('data:') else resolve_asset(src)
+    key = path or src
+    reader = _image_readers.get(key)
+    if reader is None:
+        if path:
+            # Header check only; ReportLab decodes (or, for JPEG, embeds) the file itself
+            open_image(path).close()
+            reader = ImageReader(path)
+        else:
+            image = load_scene_image(src, resolve_asset)
+            if image is None:
+                return None
+            reader = ImageReader(image)
+        _image_readers.set(key, reader)
+    return reader
+
+
+class VectorPdfRenderer:
+    """
+    Draws a scene as native PDF objects on a page the size of the ad
+
+    The page uses a y-down, pixel-unit coordinate system like the canvas so
+    Fabric transforms apply directly; text and images are flipped locally.
+    Shadows are drawn as an unblurred offset copy in the shadow color.
+    """
+
+    def __init__(self, resolve_asset):
+        self.resolve_asset = resolve_asset
+
+    def render(self, document):
+        scene, width, height = parse_scene_document(document)
+        output = io.BytesIO()
+        pdf = canvas.Canvas(output, pagesize=(width * POINTS_PER_PIXEL, height * POINTS_PER_PIXEL), pageCompression=1)
+        pdf.setTitle(document.get('title') or 'Template Ad')
+
+        pdf.translate(0, height * POINTS_PER_PIXEL)
+        pdf.scale(POINTS_PER_PIXEL, -POINTS_PER_PIXEL)
+
+        background = parse_color(scene.get('background'))
+        if background:
+            self._set_fill(pdf, background)
+            pdf.rect(0, 0, width, height, stroke=0, fill=1)
+
+        for obj in scene.get('objects', []):
+            self._draw(pdf, obj, clip=True)
+
+        pdf.showPage()
+        pdf.save()
+        return output.getvalue()
+
+    def _draw(self, pdf, obj, clip=False, opacity=1.0):
+        if not isinstance(obj, dict) or obj.get('visible') is False:
+            return
+        opacity *= float(obj.get('opacity', 1))
+
+        pdf.saveState()
+        clip_box = absolute_clip_box(obj) if clip else None
+        if clip_box:
+            path = pdf.beginPath()
+            path.rect(clip_box[0], clip_box[1], clip_box[2] - clip_box[0], clip_box[3] - clip_box[1])
+            pdf.clipPath(path, stroke=0, fill=0)
+
+        center_x, center_y = object_center(obj)
+        pdf.translate(center_x, center_y)
+        angle = float(obj.get('angle', 0) or 0)
+        if angle:
+            pdf.rotate(angle)
+        pdf.scale(
+            float(obj.get('scaleX', 1)) * (-1 if obj.get('flipX') else 1),
+            float(obj.get('scaleY', 1)) * (-1 if obj.get('flipY') else 1)
+        )
+
+        kind = obj.get('type')
+        if kind == 'rect':
+            self._draw_rect(pdf, obj, opacity)
+        elif kind == 'image':
+            self._draw_image(pdf, obj, opacity)
+        elif kind in TEXT_TYPES:
+            self._draw_text(pdf, obj, opacity)
+        elif kind == 'group':
+            for child in obj.get('objects', []):
+                self._draw(pdf, child, opacity=opacity)
+        pdf.restoreState()
+
+    @staticmethod
+    def _set_fill(pdf, color, opacity=1.0):
+        pdf.setFillColorRGB(color[0] / 255, color[1] / 255, color[2] / 255)
+        pdf.setFillAlpha(color[3] / 255 * opacity)
+
+    @staticmethod
+    def _set_stroke(pdf, color, opacity=1.0):
+        pdf.setStrokeColorRGB(color[0] / 255, color[1] / 255, color[2] / 255)
+        pdf.setStrokeAlpha(color[3] / 255 * opacity)
+
+    def _draw_rect(self, pdf, obj, opacity):
+        width, height = object_size(obj)
+        fill = parse_color(obj.get('fill'))
+        stroke = parse_color(obj.get('stroke'))
+        stroke_width = float(obj.get('strokeWidth', 0) or 0)
+        if fill:
+            self._set_fill(pdf, fill, opacity)
+        if stroke and stroke_width:
+            self._set_stroke(pdf, stroke, opacity)
+            pdf.setLineWidth(stroke_width)
+        radius = float(obj.get('rx', 0) or 0)
+        draw_stroke = 1 if stroke and stroke_width else 0
+        if radius:
+            pdf.roundRect(-width / 2, -height / 2, width, height, radius, stroke=draw_stroke, fill=1 if fill else 0)
+        else:
+            pdf.rect(-width / 2, -height / 2, width, height, stroke=draw_stroke, fill=1 if fill else 0)
+
+    def _draw_image(self, pdf, obj, opacity):
+        reader = image_reader(image_source(obj), self.resolve_asset)
+        if reader is None:
+            return
+        width, height = object_size(obj)
+        pdf.setFillAlpha(opacity)
+        # Images draw bottom-up, so flip locally inside the y-down page
+        pdf.saveState()
+        pdf.translate(-width / 2, height / 2)
+        pdf.scale(1, -1)
+        pdf.drawImage(reader, 0, 0, width, height, mask='auto')
+        pdf.restoreState()
+
+    def _draw_text(self, pdf, obj, opacity):
+        font_name = register_font(obj)
+        font_size = float(obj.get('fontSize', 40))
+        measure = lambda text: pdfmetrics.stringWidth(text, font_name, font_size)
+        lines = layout_text(obj, measure)
+        width, height = object_size(obj)
+
+        shadow = obj.get('shadow') if isinstance(obj.get('shadow'), dict) else None
+        shadow_color = parse_color(shadow.get('color')) if shadow else None
+        if shadow_color:
+            offset = (float(shadow.get('offsetX', 0) or 0), float(shadow.get('offsetY', 0) or 0))
+            self._set_fill(pdf, shadow_color, opacity)
+            self._draw_lines(pdf, lines, font_name, font_size, width, height, offset, TEXT_FILL)
+
+        fill = parse_color(obj.get('fill')) or (0, 0, 0, 255)
+        stroke = parse_color(obj.get('stroke'))
+        stroke_width = float(obj.get('strokeWidth', 0) or 0)
+        mode = TEXT_FILL
+        self._set_fill(pdf, fill, opacity)
+        if stroke and stroke_width:
+            self._set_stroke(pdf, stroke, opacity)
+            pdf.setLineWidth(stroke_width)
+            mode = TEXT_FILL_STROKE
+        self._draw_lines(pdf, lines, font_name, font_size, width, height, (0, 0), mode)
+
+    @staticmethod
+    def _draw_lines(pdf, lines, font_name, font_size, width, height, offset, mode):
+        for line, x, baseline in lines:
+            pdf.saveState()
+            pdf.translate(-width / 2 + x + offset[0], -height / 2 + baseline + offset[1])
+            pdf.scale(1, -1)
+            pdf.setFont(font_name, font_size)
+            pdf.drawString(0, 0, line, mode=mode)
+            pdf.restoreState()
+
+
+def render_scene_pdf(document, resolve_asset):
+    """Render a scene document to PDF bytes"""
+    return VectorPdfRenderer(resolve_asset).render(document)
@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import resource
+import threading
+import subprocess
+from datetime import datetime
+
+
+def _read_status_kb(field, pid='self'):
+    """Read a memory field (in kB) from /proc/<pid>/status, in bytes; None where unavailable"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss(pid='self'):
+    return _read_status_kb('VmRSS', pid)
+
+
+def peak_rss(pid='self'):
+    """Process high-water mark of resident memory, in bytes"""
+    peak = _read_status_kb('VmHWM', pid)
+    if peak is None and pid == 'self':
+        # ru_maxrss is kB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if os.uname().sysname != 'Darwin':
+            peak *= 1024
+    return peak
+
+
+def reset_peak_rss(pid='self'):
+    """Reset the kernel's RSS high-water mark (Linux only); returns True on success"""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    """
+    Measure how far resident memory rises above its starting point inside a block
+
+    Per-request numbers are only meaningful when a worker handles one request
+    at a time (gunicorn sync workers). Where the high-water mark cannot be
+    reset, the result is the growth of the process-wide peak instead.
+    """
+
+    def __init__(self):
+        self.baseline = None
+        self.peak = None
+
+    def __enter__(self):
+        if reset_peak_rss():
+            self.baseline = current_rss()
+        else:
+            self.baseline = peak_rss()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.peak = peak_rss()
+        return False
+
+    @property
+    def delta(self):
+        if self.baseline is None or self.peak is None:
+            return None
+        return max(self.peak - self.baseline, 0)
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler that keeps the stacks of slow requests only
+
+    One background thread samples the stack of every thread that is inside a
+    tracked request every `interval` seconds. When a request finishes after
+    more than `threshold` seconds, its samples are written to `directory` in
+    collapsed-stack format (one "frame;frame;frame count" line per stack),
+    which flamegraph.pl and speedscope read directly. Faster requests are
+    discarded, so the cost is a stack walk per interval while requests run.
+    """
+
+    def __init__(self, directory, threshold=1.0, interval=0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _ensure_sampler(self):
+        # Started lazily so it also runs in workers forked after import
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sample_loop, name='slow-request-profiler', daemon=True)
+            self._thread.start()
+
+    def start(self):
+        """Begin sampling the calling thread"""
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._ensure_sampler()
+            self._active[thread_id] = {}
+        return thread_id
+
+    def stop(self, thread_id, elapsed, label):
+        """Stop sampling; returns the path of the saved profile when the request was slow"""
+        with self._lock:
+            stacks = self._active.pop(thread_id, None)
+        if not stacks or elapsed < self.threshold:
+            return None
+        safe_label = ''.join(c if c.isalnum() or c in '-_' else '_' for c in label)
+        path = os.path.join(
+            self.directory,
+            f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe_label}-{elapsed * 1000:.0f}ms.folded"
+        )
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                f.write(f'{stack} {count}\n')
+        return path
+
+    @staticmethod
+    def _stack(frame):
+        # Line numbers only on the innermost frame, so callers merge in a flame graph
+        frames = [f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})']
+        frame = frame.f_back
+        while frame is not None:
+            frames.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})')
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stack = self._stack(frame)
+                        stacks[stack] = stacks.get(stack, 0) + 1
+
+
+def import_costs(module='main', python=None):
+    """
+    Import a module in a fresh interpreter under -X importtime
+
+    Returns [(module, self_us, cumulative_us, depth)] for the module and
+    everything it pulled in (interpreter startup is left out), with depth 0
+    for the module itself.
+    """
+    result = subprocess.run(
+        [python or sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+
+    costs = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        costs.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    # importtime lists children before their parent; keep the module's subtree
+    end = max(i for i, row in enumerate(costs) if row[0] == module and row[3] == 0)
+    start = max((i for i in range(end) if costs[i][3] == 0), default=-1) + 1
+    return costs[start:end + 1]
+
+
+def format_import_report(costs, top=20, max_depth=3):
+    """Text table of the most expensive imports down to max_depth levels"""
+    total = costs[-1][2] if costs else 0
+    rows = sorted((row for row in costs if row[3] <= max_depth), key=lambda row: row[2], reverse=True)[:top]
+    lines = [f'Total import time: {total / 1000:.1f} ms', f"{'cumulative ms':>14} {'self ms':>8}  module"]
+    for name, self_us, cumulative_us, depth in rows:
+        lines.append(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>8.1f}  {'  ' * depth}{name}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Startup report: python perf.py [module] [top]
+    print(format_import_report(
+        import_costs(sys.argv[1] if len(sys.argv) > 1 else 'main'),
+        top=int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    ))
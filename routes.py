@@ -1,33 +1,273 @@
 import os
 import io
+import json
+import time
 import base64
+import hashlib
+import math
 import uuid
-from PIL import Image, ImageDraw, ImageFont
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.utils import ImageReader
-from flask import render_template, request, jsonify, send_file, current_app
-from werkzeug.utils import secure_filename
+from contextlib import nullcontext
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+from flask import render_template, request, jsonify, send_file, current_app, Response, url_for, session, stream_with_context, g
+from werkzeug.utils import secure_filename, safe_join
 from app import app
-from shutterstock_api import ShutterstockAPI
-
-from google import genai
-from google.genai import types
+from shutterstock_api import get_shutterstock_client, is_preview_url
+from cache import TieredCache
+from blob_store import BlobStore
+from storage import StorageJanitor
+from assets import AssetManifest, PageCache, choose_encoding
+from export_cache import ExportCache, HashingReader, hash_stream
+from perf import PeakMemory, SlowRequestProfiler
+from metrics import registry as metrics_registry, phase, start_request, finish_request, record_request, slow_requests_profiled
+from derivatives import DerivativeBuilder, DERIVATIVE_SIZES, DERIVATIVE_FORMATS, EDITOR_SIZE
+from scene import SceneError, scene_multiplier, parse_scene_document, scene_image_sources
+from batch_export import BatchExport, BatchExportError, parse_outputs, resolve_sizes, render_multiplier
+from gemini import GeminiError, TextVariantCache, TEXT_TYPES, image_client, text_client, classify_error, classify_image_error
+from upstream_guard import UpstreamUnavailable, gemini_guard, set_state_directory as set_upstream_state_directory, stats as upstream_guard_stats
+from jobs import JobStore, JobQueue, JobError, SUCCEEDED, ACTIVE_STATES
+from imaging import ALLOWED_FORMATS, ImageDecodeError, open_image, decode_image, flatten, read_image_stream
+from encoders import EncoderError, encode, negotiate, resolve_format, resolve_preset, format_mimetype, format_extension
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Formatted Shutterstock search responses, shared across workers when a
+# SEARCH_CACHE_DIR is configured; expired results are still served for
+# SEARCH_CACHE_STALE_TTL seconds while Shutterstock is failing
+search_cache = TieredCache(
+    max_entries=int(os.environ.get('SEARCH_CACHE_SIZE', 512)),
+    default_ttl=int(os.environ.get('SEARCH_CACHE_TTL', 600)),
+    disk_dir=os.environ.get('SEARCH_CACHE_DIR') or None,
+    stale_ttl=int(os.environ.get('SEARCH_CACHE_STALE_TTL', 24 * 60 * 60)),
+    disk_max_entries=int(os.environ.get('SEARCH_CACHE_DISK_SIZE', 10000))
+)
+
+# Content-addressed store of uploaded images
+media_store = BlobStore(
+    app.config['MEDIA_FOLDER'],
+    max_bytes=app.config['MEDIA_MAX_BYTES'] or None,
+    max_age=app.config['MEDIA_MAX_AGE'] or None
+)
+
+# Downscaled versions of uploads, built lazily on a bounded worker pool
+derivative_builder = DerivativeBuilder(
+    media_store,
+    max_workers=int(os.environ.get('DERIVATIVE_WORKERS', 2)),
+    preset=os.environ.get('DERIVATIVE_PRESET', 'balanced')
+)
+
+# Content-addressed cache of proxied Shutterstock previews
+preview_store = BlobStore(
+    app.config['PREVIEW_CACHE_FOLDER'],
+    max_bytes=app.config['PREVIEW_CACHE_MAX_BYTES'],
+    max_age=app.config['PREVIEW_CACHE_MAX_AGE'] or None
+)
+
+# Finished exports by canvas hash, format and options, so repeated exports skip rendering
+export_cache = ExportCache(
+    BlobStore(
+        app.config['EXPORT_CACHE_FOLDER'],
+        max_bytes=app.config['EXPORT_CACHE_MAX_BYTES'] or None,
+        max_age=app.config['EXPORT_CACHE_MAX_AGE'] or None
+    ),
+    enabled=app.config['EXPORT_CACHE']
+)
+
+# Sweeps the stores and moves pre-blob-store leftovers in UPLOAD_FOLDER into the media store
+storage_janitor = StorageJanitor(
+    app.config['UPLOAD_FOLDER'],
+    {'media': media_store, 'previews': preview_store, 'exports': export_cache.store},
+    interval=app.config['STORAGE_SWEEP_INTERVAL'],
+    legacy_store=media_store
+)
+
+PREVIEW_CHUNK_SIZE = 64 * 1024
+
+# Content-hashed URLs for the files in static/, and the rendered pages that link to them
+asset_manifest = AssetManifest(app.static_folder, app.config['ASSET_BUILD_FOLDER'])
+page_cache = PageCache()
+
+# Gemini image generation runs in the background; callers poll or subscribe
+generation_jobs = JobQueue(
+    JobStore(app.config['JOBS_FOLDER']),
+    max_workers=int(os.environ.get('JOB_WORKERS', 4)),
+    per_user_limit=int(os.environ.get('JOB_USER_LIMIT', 2)),
+    max_pending=int(os.environ.get('JOB_MAX_PENDING', 32)),
+    ttl=int(os.environ.get('JOB_TTL', 3600)),
+    stale_after=int(os.environ.get('JOB_TIMEOUT', 300))
+)
+
+# Generated ad copy per normalized (prompt, type); one model call fills
+# several variants that later "regenerate" clicks are served from
+text_variants = TextVariantCache(
+    TieredCache(
+        max_entries=int(os.environ.get('GEMINI_TEXT_CACHE_SIZE', 1024)),
+        default_ttl=int(os.environ.get('GEMINI_TEXT_CACHE_TTL', 3600)),
+        disk_dir=os.environ.get('GEMINI_TEXT_CACHE_DIR') or None,
+        stale_ttl=int(os.environ.get('GEMINI_TEXT_CACHE_STALE_TTL', 24 * 60 * 60)),
+        disk_max_entries=int(os.environ.get('GEMINI_TEXT_CACHE_DISK_SIZE', 10000))
+    ),
+    batch_size=int(os.environ.get('GEMINI_TEXT_VARIANTS', 5)),
+    max_variants=int(os.environ.get('GEMINI_TEXT_MAX_VARIANTS', 20))
+)
+
+# Longest a single Server-Sent Events stream stays open
+JOB_EVENTS_TIMEOUT = int(os.environ.get('JOB_EVENTS_TIMEOUT', 120))
+
+# Workers add up each other's metrics through this directory
+metrics_registry.set_directory(app.config['METRICS_FOLDER'])
+
+# Rate limits and circuit breakers of the external APIs hold across workers
+set_upstream_state_directory(app.config['UPSTREAM_STATE_FOLDER'])
+
+# Opt-in: keep sampled stacks of requests slower than PROFILE_SLOW_REQUESTS seconds
+slow_request_profiler = SlowRequestProfiler(
+    app.config['PROFILE_FOLDER'],
+    threshold=app.config['PROFILE_SLOW_REQUESTS'],
+    interval=app.config['PROFILE_INTERVAL']
+) if app.config['PROFILE_SLOW_REQUESTS'] > 0 else None
+
+@app.before_request
+def start_request_metrics():
+    # Started lazily so each (possibly forked) worker gets its own sweeper thread
+    storage_janitor.start()
+    g.request_timer = start_request(request.endpoint or 'unmatched')
+    g.profiled_thread = slow_request_profiler.start() if slow_request_profiler else None
+
+def count_body_bytes(chunks, counter):
+    """Pass a streamed response body through, counting its bytes"""
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+@app.after_request
+def finish_request_metrics(response):
+    """Record the request once its body has been sent, so streamed responses count in full"""
+    timer = g.get('request_timer')
+    if timer is None:
+        return response
+    if timer.phases:
+        response.headers['Server-Timing'] = timer.server_timing()
+    
+    response_bytes = [response.content_length or 0]
+    if response.content_length is None and response.is_streamed:
+        response.response = count_body_bytes(response.response, response_bytes)
+    method, status, request_bytes = request.method, response.status_code, request.content_length
+    profiled_thread = g.get('profiled_thread')
+    
+    def finish():
+        # Runs after the request context is gone, so only captured values are used
+        finish_request()
+        elapsed = timer.elapsed()
+        record_request(timer, method, status, request_bytes, response_bytes[0])
+        if profiled_thread is not None:
+            path = slow_request_profiler.stop(profiled_thread, elapsed, timer.endpoint)
+            if path:
+                slow_requests_profiled.inc(timer.endpoint)
+                app.logger.warning(f'Slow request {method} {timer.endpoint} took {elapsed:.2f}s; profile saved to {path}')
+    
+    if response.direct_passthrough:
+        # Werkzeug skips close callbacks for passthrough (send_file) bodies;
+        # their length is known, so record them now
+        finish()
+    else:
+        response.call_on_close(finish)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request, phase and upstream metrics of all workers in Prometheus text format"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def asset_url(name):
+    """URL of a static file that changes with its content (plain /static/ for unknown files)"""
+    hashed_name = asset_manifest.hashed_name(name)
+    if hashed_name is None:
+        return url_for('static', filename=name)
+    return url_for('serve_asset', filename=hashed_name)
+
+def asset_urls(prefix):
+    """Fingerprinted URLs of every static file under prefix, for scripts that load them"""
+    return {name: asset_url(name) for name in sorted(asset_manifest.assets) if name.startswith(prefix)}
+
+app.jinja_env.globals.update(asset_url=asset_url, asset_urls=asset_urls)
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """Serve a fingerprinted static file, precompressed when the browser accepts it; cache forever"""
+    asset = asset_manifest.lookup(filename)
+    if asset is None:
+        return jsonify({'success': False, 'error': 'Asset not found'}), 404
+    
+    path, encoding = asset_manifest.resolve(asset, request.accept_encodings)
+    response = send_file(
+        path,
+        mimetype=asset.mimetype,
+        etag=f'{asset.digest}-{encoding}' if encoding else asset.digest,
+        max_age=IMMUTABLE_MAX_AGE,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if asset.compressible:
+        response.vary.add('Accept-Encoding')
+    return response
+
+def cached_page(template):
+    """
+    Serve a template rendered once per worker, compressed, with an ETag
+
+    Browsers revalidate on every visit (no-cache) and get a 304 until a
+    deploy changes the page. In debug mode pages and hashes are rebuilt on
+    every request so edits show up.
+    """
+    if current_app.debug:
+        asset_manifest.scan()
+        return render_template(template)
+    
+    page = page_cache.get(template, lambda: render_template(template))
+    encoding = choose_encoding(request.accept_encodings, page.bodies)
+    response = Response(page.bodies[encoding], mimetype='text/html')
+    response.set_etag(f'{page.etag}-{encoding}' if encoding else page.etag)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/')
 def index():
     """Main page with the template ads designer"""
-    return render_template('index.html')
+    return cached_page('index.html')
 
 @app.route('/zoom-solutions')
 def zoom_solutions():
     """Demo page showing different zoom solution options"""
-    return render_template('zoom-solutions.html')
+    return cached_page('zoom-solutions.html')
+
+def sniff_image(path):
+    """
+    Read just the image header with Pillow; returns (format, width, height) or None
+
+    Raises ImageDecodeError (413) for images over the pixel budget.
+    """
+    try:
+        with open_image(path) as image:
+            return image.format, image.width, image.height
+    except ImageDecodeError as e:
+        if e.status == 413:
+            raise
+        return None
+    except Exception:
+        return None
 
 @app.route('/upload-image', methods=['POST'])
 def upload_image():
@@ -41,78 +281,231 @@ def upload_image():
             return jsonify({'success': False, 'error': 'No file selected'})
         
         if file and allowed_file(file.filename):
-            # Generate unique filename
-            filename = str(uuid.uuid4()) + '.' + file.filename.rsplit('.', 1)[1].lower()
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+            # Hash while streaming to disk; identical content maps to the same ID
+            with media_store.writer() as writer:
+                with phase('receive'):
+                    while True:
+                        chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                    writer.finish()
+                
+                metadata = {}
+                if not media_store.exists(writer.digest):
+                    # Cheap header sniff instead of trusting the extension
+                    with phase('sniff'):
+                        sniffed = sniff_image(writer.tmp_path)
+                    if not sniffed or sniffed[0] not in ALLOWED_FORMATS:
+                        return jsonify({'success': False, 'error': 'Invalid file type. Please upload PNG, JPG, JPEG, GIF, BMP, or WEBP files.'})
+                    img_format, width, height = sniffed
+                    metadata = {
+                        'content_type': Image.MIME.get(img_format, 'application/octet-stream'),
+                        'format': img_format,
+                        'width': width,
+                        'height': height
+                    }
+                with phase('store'):
+                    digest = writer.commit(metadata)
             
-            # Save and process image
-            file.save(filepath)
+            # Build the editing-size derivative in the background
+            derivative_builder.schedule(digest)
             
-            # Convert to base64 for frontend use
-            with open(filepath, 'rb') as img_file:
-                img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                img_format = filepath.split('.')[-1].upper()
-                if img_format == 'JPG':
-                    img_format = 'JPEG'
-                
-                return jsonify({
-                    'success': True,
-                    'filename': filename,
-                    'data_url': f'data:image/{img_format.lower()};base64,{img_data}'
-                })
+            return jsonify({
+                'success': True,
+                'id': digest,
+                'filename': digest,
+                'duplicate': writer.duplicate,
+                'url': url_for('serve_upload', digest=digest),
+                'preview_url': url_for('serve_upload_derivative', digest=digest, size=EDITOR_SIZE)
+            })
         else:
             return jsonify({'success': False, 'error': 'Invalid file type. Please upload PNG, JPG, JPEG, GIF, BMP, or WEBP files.'})
     
+    except ImageDecodeError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         current_app.logger.error(f'Upload error: {str(e)}')
         return jsonify({'success': False, 'error': 'Upload failed. Please try again.'})
 
+@app.route('/uploads/<digest>')
+def serve_upload(digest):
+    """Serve an uploaded image; content-addressed URLs never change, so cache forever"""
+    if not media_store.exists(digest):
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    return send_blob(media_store, digest, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+
+@app.route('/uploads/<digest>/<int:size>')
+def serve_upload_derivative(digest, size):
+    """Serve a downscaled version of an upload, AVIF or WebP when the browser accepts it"""
+    if size not in DERIVATIVE_SIZES or not media_store.exists(digest):
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    
+    try:
+        # Only browsers that explicitly advertise AVIF or WebP get it; */* is not enough
+        fmt = negotiate(request.accept_mimetypes, DERIVATIVE_FORMATS) or 'fallback'
+        derivative = derivative_builder.get(digest, size, fmt)
+    except Exception as e:
+        current_app.logger.error(f'Derivative error: {str(e)}')
+        return jsonify({'success': False, 'error': 'Image processing failed'}), 500
+    
+    response = send_blob(media_store, derivative, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    response.vary.add('Accept')
+    return response
+
+def read_canvas_upload():
+    """
+    Read the canvas submitted for export
+
+    Accepts a raw image/* request body, a multipart upload (field 'image' or
+    'file'), or the legacy JSON body with a base64 data URL in 'imageData'.
+    Returns (file-like image source or None, options mapping, transport name,
+    sha256 of the submitted canvas or scene for the export cache). A JSON
+    data URL is only base64-decoded once the source is read.
+    """
+    if request.mimetype.startswith('image/'):
+        # Oversized canvases are refused from their header, before the rest is read;
+        # the body is hashed as it streams in
+        with phase('receive'):
+            reader = HashingReader(request.stream)
+            body = read_image_stream(reader)
+        return body, request.args, 'raw', reader.hexdigest()
+    
+    if request.mimetype == 'multipart/form-data':
+        with phase('receive'):
+            upload = request.files.get('image') or request.files.get('file')
+            digest = hash_stream(upload.stream) if upload else None
+        options = request.args.to_dict()
+        options.update(request.form.to_dict())
+        return (upload.stream if upload else None), options, 'multipart', digest
+    
+    with phase('parse_json'):
+        data = request.get_json()
+        # Hashes the raw body Flask already buffered for get_json
+        digest = hashlib.sha256(request.get_data()).hexdigest()
+    image_data = data.get('imageData')
+    if not image_data:
+        return None, data, 'json', digest
+    # Decoded only if the export is not already cached
+    return DataUrlSource(image_data), data, 'json', digest
+
+class DataUrlSource:
+    """File-like view of a base64 image data URL, decoded on first use"""
+    
+    def __init__(self, image_data):
+        self.image_data = image_data
+        self._stream = None
+    
+    def __getattr__(self, name):
+        if self._stream is None:
+            image_data = self.image_data
+            # Remove data URL prefix
+            if image_data.startswith('data:image'):
+                image_data = image_data.split(',')[1]
+            with phase('base64_decode'):
+                self._stream = io.BytesIO(base64.b64decode(image_data))
+        return getattr(self._stream, name)
+
+def resolve_scene_asset(src):
+    """Map an image src from the editor's scene JSON to a local file (never fetches arbitrary URLs)"""
+    parsed = urlparse(src)
+    parts = parsed.path.strip('/').split('/')
+    
+    # Uploads and their derivatives render from the original
+    if parts[0] == 'uploads' and len(parts) in (2, 3) and media_store.exists(parts[1]):
+        return media_store.path(parts[1])
+    
+    if parsed.path.rstrip('/') == '/api/shutterstock/preview':
+        image_url = parse_qs(parsed.query).get('url', [None])[0]
+        if image_url and is_preview_url(image_url):
+            return preview_store.path(fetch_preview(image_url))
+        return None
+    
+    if parts[0] == 'assets' and len(parts) > 1:
+        asset = asset_manifest.lookup('/'.join(parts[1:]))
+        return asset.path if asset else None
+    
+    if parts[0] == 'static' and len(parts) > 1:
+        path = safe_join(current_app.static_folder, *parts[1:])
+        if path and os.path.isfile(path):
+            return path
+    
+    return None
+
+def report_export_memory(response, probe, transport):
+    """Attach the request's peak memory growth when REPORT_EXPORT_MEMORY is on"""
+    if probe is None or probe.delta is None:
+        return response
+    current_app.logger.info(f'{request.path} via {transport}: peak memory +{probe.delta / (1024 * 1024):.1f} MiB')
+    response.headers['X-Peak-Memory'] = str(probe.delta)
+    response.headers['X-Export-Transport'] = transport
+    return response
+
+def send_export(digest, filename, cache_result):
+    """Send a finished export from the export cache, with its digest as the ETag"""
+    response = send_blob(export_cache.store, digest, max_age=0, download_name=filename)
+    response.headers['X-Export-Cache'] = cache_result
+    return response
+
 @app.route('/export-image', methods=['POST'])
 def export_image():
-    """Export the canvas as PNG or JPG"""
+    """Export the canvas as PNG, JPG, WebP or AVIF ('auto' picks from the Accept header)"""
     try:
-        data = request.get_json()
-        image_data = data.get('imageData')
-        format_type = data.get('format', 'png').lower()
-        
-        if not image_data:
-            return jsonify({'success': False, 'error': 'No image data provided'})
-        
-        # Remove data URL prefix
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-        
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
+        probe = PeakMemory() if current_app.config['REPORT_EXPORT_MEMORY'] else None
+        with probe or nullcontext():
+            image_source, options, transport, canvas_digest = read_canvas_upload()
+            format_type = str(options.get('format', 'png')).lower()
+            negotiated = format_type == 'auto'
+            if negotiated:
+                format_type = negotiate(request.accept_mimetypes) or 'png'
+            format_type = resolve_format(format_type)
+            preset = resolve_preset(options.get('preset'))
+            filename = f'template_ad_{uuid.uuid4().hex[:8]}.{format_extension(format_type)}'
+            
+            # The same canvas exported again is sent as stored, without decoding or encoding
+            cache_key = export_cache.key('image', canvas_digest, format=format_extension(format_type), preset=preset)
+            cached = export_cache.get(cache_key, 'image') if cache_key else None
+            if not cached:
+                if transport == 'json' and options.get('scene'):
+                    # Render the editor's scene JSON server-side instead of a screenshot
+                    from scene_renderer import render_scene
+                    with phase('render'):
+                        image = render_scene(options, resolve_scene_asset, scene_multiplier(options))
+                    transport = 'scene'
+                elif image_source is None:
+                    return jsonify({'success': False, 'error': 'No image data provided'})
+                else:
+                    # Decode up front so the time is not counted as encoding
+                    with phase('decode'):
+                        image = decode_image(image_source)
+                
+                # Flatten onto white if exporting as JPG
+                if format_type in ('jpg', 'jpeg'):
+                    with phase('flatten'):
+                        image = flatten(image)
+                
+                with phase('encode'):
+                    img_io = encode(image, format_type, preset)
         
-        # Convert to RGB if exporting as JPG
-        if format_type == 'jpg' or format_type == 'jpeg':
-            if image.mode in ('RGBA', 'LA', 'P'):
-                # Create white background
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                if image.mode == 'P':
-                    image = image.convert('RGBA')
-                background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                image = background
-            format_type = 'JPEG'
+        if cached:
+            response = send_export(cached, filename, 'hit')
+        elif cache_key:
+            response = send_export(export_cache.put(cache_key, img_io.getvalue(), format_mimetype(format_type)), filename, 'miss')
         else:
-            format_type = 'PNG'
-        
-        # Save to BytesIO
-        img_io = io.BytesIO()
-        image.save(img_io, format=format_type, quality=95 if format_type == 'JPEG' else None)
-        img_io.seek(0)
-        
-        filename = f'template_ad_{uuid.uuid4().hex[:8]}.{format_type.lower()}'
-        
-        return send_file(
-            img_io,
-            mimetype=f'image/{format_type.lower()}',
-            as_attachment=True,
-            download_name=filename
-        )
+            response = send_file(
+                img_io,
+                mimetype=format_mimetype(format_type),
+                as_attachment=True,
+                download_name=filename
+            )
+        if negotiated:
+            response.vary.add('Accept')
+        return report_export_memory(response, probe, transport)
     
+    except (SceneError, EncoderError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except ImageDecodeError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         current_app.logger.error(f'Export error: {str(e)}')
         return jsonify({'success': False, 'error': 'Export failed. Please try again.'})
@@ -121,61 +514,167 @@ def export_image():
 def export_pdf():
     """Export the canvas as PDF"""
     try:
-        data = request.get_json()
-        image_data = data.get('imageData')
-        
-        if not image_data:
-            return jsonify({'success': False, 'error': 'No image data provided'})
-        
-        # Remove data URL prefix
-        if image_data.startswith('data:image'):
-            image_data = image_data.split(',')[1]
-        
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Create PDF
-        pdf_io = io.BytesIO()
-        pdf_canvas = canvas.Canvas(pdf_io, pagesize=letter)
-        
-        # Calculate dimensions to fit on page
-        page_width, page_height = letter
-        img_width, img_height = image.size
-        
-        # Scale image to fit page while maintaining aspect ratio
-        scale = min((page_width - 72) / img_width, (page_height - 72) / img_height)  # 72 points = 1 inch margin
-        new_width = img_width * scale
-        new_height = img_height * scale
-        
-        # Center image on page
-        x = (page_width - new_width) / 2
-        y = (page_height - new_height) / 2
-        
-        # Convert PIL image to ReportLab ImageReader
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
-        img_reader = ImageReader(img_buffer)
-        
-        # Draw image on PDF
-        pdf_canvas.drawImage(img_reader, x, y, new_width, new_height)
-        pdf_canvas.save()
-        
-        pdf_io.seek(0)
-        filename = f'template_ad_{uuid.uuid4().hex[:8]}.pdf'
+        probe = PeakMemory() if current_app.config['REPORT_EXPORT_MEMORY'] else None
+        with probe or nullcontext():
+            image_source, options, transport, canvas_digest = read_canvas_upload()
+            filename = f'template_ad_{uuid.uuid4().hex[:8]}.pdf'
+            
+            # The same canvas exported again is sent as stored, without loading ReportLab
+            cache_key = export_cache.key('pdf', canvas_digest)
+            cached = export_cache.get(cache_key, 'pdf') if cache_key else None
+            if not cached:
+                if transport == 'json' and options.get('scene'):
+                    # Vector mode: text, shapes and images as native PDF objects
+                    from pdf_renderer import render_scene_pdf
+                    with phase('pdf'):
+                        pdf_io = io.BytesIO(render_scene_pdf(options, resolve_scene_asset))
+                    transport = 'scene'
+                elif image_source is None:
+                    return jsonify({'success': False, 'error': 'No image data provided'})
+                else:
+                    # ReportLab is only loaded once someone exports a PDF
+                    from reportlab.pdfgen import canvas
+                    from reportlab.lib.pagesizes import letter, landscape
+                    from reportlab.lib.utils import ImageReader
+                    
+                    with phase('decode'):
+                        image = decode_image(image_source)
+                    
+                    with phase('pdf'):
+                        # Create PDF on a page oriented like the ad
+                        img_width, img_height = image.size
+                        pagesize = landscape(letter) if img_width > img_height else letter
+                        pdf_io = io.BytesIO()
+                        pdf_canvas = canvas.Canvas(pdf_io, pagesize=pagesize)
+                        
+                        # Calculate dimensions to fit on page
+                        page_width, page_height = pagesize
+                        
+                        # Scale image to fit page while maintaining aspect ratio
+                        scale = min((page_width - 72) / img_width, (page_height - 72) / img_height)  # 72 points = 1 inch margin
+                        new_width = img_width * scale
+                        new_height = img_height * scale
+                        
+                        # Center image on page
+                        x = (page_width - new_width) / 2
+                        y = (page_height - new_height) / 2
+                        
+                        # Hand the decoded image to ReportLab directly instead of re-encoding it to PNG
+                        img_reader = ImageReader(image)
+                        
+                        # Draw image on PDF
+                        pdf_canvas.drawImage(img_reader, x, y, new_width, new_height, mask='auto')
+                        pdf_canvas.save()
+                        
+                        pdf_io.seek(0)
         
-        return send_file(
-            pdf_io,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=filename
-        )
+        if cached:
+            response = send_export(cached, filename, 'hit')
+        elif cache_key:
+            response = send_export(export_cache.put(cache_key, pdf_io.getvalue(), 'application/pdf'), filename, 'miss')
+        else:
+            response = send_file(
+                pdf_io,
+                mimetype='application/pdf',
+                as_attachment=True,
+                download_name=filename
+            )
+        return report_export_memory(response, probe, transport)
     
+    except SceneError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except ImageDecodeError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
     except Exception as e:
         current_app.logger.error(f'PDF export error: {str(e)}')
         return jsonify({'success': False, 'error': 'PDF export failed. Please try again.'})
 
+@app.route('/export-batch', methods=['POST'])
+def export_batch():
+    """Export the canvas in several formats and sizes as one streamed ZIP archive"""
+    try:
+        image_source, options, transport, _ = read_canvas_upload()
+        members = parse_outputs(options)
+        document = resolved_assets = None
+        
+        if transport == 'json' and options.get('scene'):
+            # Resolve assets here, inside the request; pool workers only see file paths
+            scene, width, height = parse_scene_document(options)
+            resolved_assets = {
+                src: resolve_scene_asset(src)
+                for src in set(scene_image_sources(scene.get('objects', [])))
+                if not src.startswith('data:')
+            }
+            base = scene_multiplier(options)
+            from scene_renderer import render_scene
+            image = render_scene(options, resolved_assets.get, render_multiplier(members, width, height, base))
+            original_size = (int(round(width * base)), int(round(height * base)))
+            members = resolve_sizes(members, original_size)
+            document = options
+        elif image_source is None:
+            return jsonify({'success': False, 'error': 'No image data provided'})
+        else:
+            # Sizes come from the header; a JPEG is then decoded no larger than the biggest output needs
+            with open_image(image_source) as opened:
+                original_size = opened.size
+            members = resolve_sizes(members, original_size)
+            image_source.seek(0)
+            largest = (max(member['width'] for member in members), max(member['height'] for member in members))
+            # Decoded once; every output is produced from these pixels
+            image = decode_image(image_source, max_size=largest)
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+        
+        batch = BatchExport(image, members, document, resolved_assets)
+    except (SceneError, BatchExportError, EncoderError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except ImageDecodeError as e:
+        return jsonify({'success': False, 'error': e.message}), e.status
+    except Exception as e:
+        current_app.logger.error(f'Batch export error: {str(e)}')
+        return jsonify({'success': False, 'error': 'Batch export failed. Please try again.'})
+    
+    response = Response(batch.stream(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename=template_ads_{uuid.uuid4().hex[:8]}.zip'
+    # Let proxies pass members through as they finish
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(batch.close)
+    return response
+
+def upstream_unavailable(error, message):
+    """503 for a call refused by an upstream's rate limit or open breaker"""
+    response = jsonify({'error': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+def format_search_results(results):
+    """Shape a raw Shutterstock search response for the frontend"""
+    formatted_results = {
+        'total_count': results.get('total_count', 0),
+        'page': results.get('page', 1),
+        'per_page': results.get('per_page', 20),
+        'images': []
+    }
+    
+    for image in results.get('data', []):
+        formatted_results['images'].append({
+            'id': image['id'],
+            'description': image.get('description', ''),
+            'preview_url': image['assets']['preview']['url'],
+            'thumbnail_url': image['assets']['preview_1000']['url'],
+            'width': image['assets']['preview']['width'],
+            'height': image['assets']['preview']['height'],
+            'aspect_ratio': image['aspect']
+        })
+    
+    return formatted_results
+
+def search_cache_key(query, page, per_page, orientation):
+    """Normalize search parameters so equivalent queries share a cache entry"""
+    normalized_query = ' '.join(query.lower().split())
+    return f"search:{normalized_query}:{page}:{per_page}:{orientation or ''}"
+
 @app.route('/api/shutterstock/search')
 def shutterstock_search():
     """Search Shutterstock for stock images"""
@@ -188,75 +687,237 @@ def shutterstock_search():
         if not query:
             return jsonify({'error': 'Search query is required'}), 400
         
-        # Initialize Shutterstock API
-        shutterstock = ShutterstockAPI()
-        
-        # Search for images
-        results = shutterstock.search_images(
-            query=query,
-            page=page,
-            per_page=per_page,
-            orientation=orientation
-        )
-        
-        # Format results for frontend
-        formatted_results = {
-            'total_count': results.get('total_count', 0),
-            'page': results.get('page', 1),
-            'per_page': results.get('per_page', 20),
-            'images': []
-        }
+        def fetch_results():
+            # Reuse the pooled per-worker Shutterstock client
+            shutterstock = get_shutterstock_client()
+            
+            # Search for images
+            results = shutterstock.search_images(
+                query=query,
+                page=page,
+                per_page=per_page,
+                orientation=orientation
+            )
+            
+            # Cache the already formatted response
+            with phase('format'):
+                return format_search_results(results)
         
-        for image in results.get('data', []):
-            formatted_results['images'].append({
-                'id': image['id'],
-                'description': image.get('description', ''),
-                'preview_url': image['assets']['preview']['url'],
-                'thumbnail_url': image['assets']['preview_1000']['url'],
-                'width': image['assets']['preview']['width'],
-                'height': image['assets']['preview']['height'],
-                'aspect_ratio': image['aspect']
-            })
+        # Identical concurrent misses share a single upstream call
+        cache_key = search_cache_key(query, page, per_page, orientation)
+        try:
+            formatted_results = search_cache.get_or_compute(cache_key, fetch_results)
+        except Exception as e:
+            # Shutterstock is failing or refused by its breaker: answer with an expired copy if there is one
+            stale_results = search_cache.get_stale(cache_key)
+            if stale_results is None:
+                raise
+            current_app.logger.warning(f"Serving stale search results: {str(e)}")
+            return jsonify(dict(stale_results, stale=True))
         
         return jsonify(formatted_results)
         
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, 'Stock image search is temporarily unavailable, please retry')
     except ValueError as e:
         return jsonify({'error': 'Shutterstock API credentials not configured'}), 503
     except Exception as e:
         current_app.logger.error(f"Shutterstock search error: {str(e)}")
         return jsonify({'error': 'Failed to search stock images'}), 500
 
+def send_blob(store, digest, max_age=86400, immutable=False, download_name=None):
+    """Serve a stored blob with its real MIME type, ETag, Last-Modified and Range support"""
+    metadata = store.metadata(digest)
+    store.touch(digest)
+    response = send_file(
+        store.path(digest),
+        mimetype=metadata.get('content_type', 'application/octet-stream'),
+        as_attachment=download_name is not None,
+        download_name=download_name,
+        etag=digest,
+        last_modified=metadata.get('created'),
+        max_age=max_age,
+        conditional=True
+    )
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+def fetch_preview(image_url):
+    """Return the digest of a cached preview, downloading it into the cache on a miss"""
+    ref = f'preview:{image_url}'
+    digest = preview_store.get_ref(ref)
+    if digest:
+        return digest
+    
+    upstream = get_shutterstock_client().open_image_preview(image_url)
+    try:
+        content_type = upstream.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+        with preview_store.writer() as writer:
+            for chunk in upstream.iter_content(PREVIEW_CHUNK_SIZE):
+                writer.write(chunk)
+            digest = writer.commit({'content_type': content_type, 'source': image_url})
+    finally:
+        upstream.close()
+    
+    preview_store.set_ref(ref, digest)
+    return digest
+
+@app.route('/api/shutterstock/preview')
+def shutterstock_preview():
+    """Proxy a Shutterstock preview image, streaming it through the disk cache"""
+    try:
+        image_url = request.args.get('url')
+        if not image_url:
+            return jsonify({'error': 'Image URL is required'}), 400
+        if not is_preview_url(image_url):
+            return jsonify({'error': 'Invalid image URL'}), 400
+        
+        # Cache hit: serve from disk with conditional and Range support
+        digest = preview_store.get_ref(f'preview:{image_url}')
+        if digest:
+            return send_blob(preview_store, digest)
+        
+        # Reuse the pooled per-worker Shutterstock client
+        shutterstock = get_shutterstock_client()
+        upstream = shutterstock.open_image_preview(image_url)
+        content_type = upstream.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+        if not content_type.startswith('image/'):
+            upstream.close()
+            return jsonify({'error': 'Upstream did not return an image'}), 502
+        
+        def stream_and_store():
+            # Write-through: every chunk goes to the client and the cache file
+            try:
+                with preview_store.writer() as writer:
+                    for chunk in upstream.iter_content(PREVIEW_CHUNK_SIZE):
+                        writer.write(chunk)
+                        yield chunk
+                    digest = writer.commit({'content_type': content_type, 'source': image_url})
+                preview_store.set_ref(f'preview:{image_url}', digest)
+            finally:
+                upstream.close()
+        
+        response = Response(stream_and_store(), mimetype=content_type)
+        if upstream.headers.get('Content-Length') and not upstream.headers.get('Content-Encoding'):
+            response.headers['Content-Length'] = upstream.headers['Content-Length']
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+        return response
+        
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, 'Image download is temporarily unavailable, please retry')
+    except ValueError as e:
+        return jsonify({'error': 'Shutterstock API credentials not configured'}), 503
+    except Exception as e:
+        current_app.logger.error(f"Shutterstock preview error: {str(e)}")
+        return jsonify({'error': 'Failed to download image'}), 500
+
 @app.route('/api/shutterstock/download')
 def shutterstock_download():
-    """Download a Shutterstock image for use in the editor"""
+    """Download a Shutterstock image for use in the editor (legacy data URL response)"""
     try:
         image_url = request.args.get('url')
         if not image_url:
             return jsonify({'error': 'Image URL is required'}), 400
+        if not is_preview_url(image_url):
+            return jsonify({'error': 'Invalid image URL'}), 400
         
-        # Initialize Shutterstock API
-        shutterstock = ShutterstockAPI()
-        
-        # Download the image
-        image_data = shutterstock.download_image_preview(image_url)
+        # Download through the shared preview cache
+        digest = fetch_preview(image_url)
+        content_type = preview_store.metadata(digest).get('content_type', 'image/jpeg')
         
         # Convert to base64 for frontend
-        image_b64 = base64.b64encode(image_data).decode('utf-8')
+        with open(preview_store.path(digest), 'rb') as f:
+            image_b64 = base64.b64encode(f.read()).decode('utf-8')
         
         return jsonify({
             'success': True,
-            'image_data': f"data:image/jpeg;base64,{image_b64}"
+            'image_url': url_for('shutterstock_preview', url=image_url),
+            'image_data': f"data:{content_type};base64,{image_b64}"
         })
         
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, 'Image download is temporarily unavailable, please retry')
+    except ValueError as e:
+        return jsonify({'error': 'Shutterstock API credentials not configured'}), 503
     except Exception as e:
         current_app.logger.error(f"Shutterstock download error: {str(e)}")
         return jsonify({'error': 'Failed to download image'}), 500
 
+@app.route('/api/shutterstock/pool-stats')
+def shutterstock_pool_stats():
+    """Report connection pool reuse for this worker's Shutterstock client"""
+    try:
+        return jsonify(get_shutterstock_client().pool_stats())
+    except ValueError:
+        return jsonify({'error': 'Shutterstock API credentials not configured'}), 503
+
+@app.route('/api/storage/stats')
+def storage_stats():
+    """Report disk usage of the upload, generated image and preview stores"""
+    return jsonify(storage_janitor.stats())
+
+@app.route('/api/upstreams/status')
+def upstreams_status():
+    """Report the circuit breaker state and rate limit of each external API"""
+    response = jsonify(upstream_guard_stats())
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def current_user_id():
+    """Anonymous per-browser id kept in the session cookie, used for job limits"""
+    if 'uid' not in session:
+        session['uid'] = uuid.uuid4().hex
+    return session['uid']
+
+def run_image_job(client, prompt):
+    """Job body: generate an image and store it with the uploads"""
+    try:
+        image_data, content_type = client.generate_image(prompt)
+    except Exception as e:
+        error = classify_image_error(e)
+        raise JobError(error.message, error.status)
+    
+    # Written once into the content-addressed store, never read back for base64
+    try:
+        with open_image(io.BytesIO(image_data)) as image:
+            image_format, width, height = image.format, image.width, image.height
+    except ImageDecodeError as e:
+        raise JobError(f'Generated image rejected: {e.message}', 502)
+    digest = media_store.put_bytes(image_data, {
+        'content_type': content_type,
+        'format': image_format,
+        'width': width,
+        'height': height,
+        'source': 'gemini'
+    })
+    derivative_builder.schedule(digest)
+    return {'id': digest}
+
+def job_payload(job):
+    """Client view of a generation job"""
+    payload = {'success': True, 'job_id': job['id'], 'status': job['status']}
+    if job['status'] == SUCCEEDED:
+        digest = job['result']['id']
+        payload['image_url'] = url_for('serve_upload', digest=digest)
+        payload['preview_url'] = url_for('serve_upload_derivative', digest=digest, size=EDITOR_SIZE)
+    elif job['error']:
+        payload['success'] = False
+        payload['error'] = job['error']['message']
+        payload['error_status'] = job['error']['status']
+    return payload
 
+def find_job(job_id):
+    """The caller's own job, or None"""
+    job = generation_jobs.get(job_id)
+    if job is None or job['user'] != current_user_id():
+        return None
+    return job
 
 @app.route('/api/gemini/generate-image', methods=['POST'])
 def generate_ai_image():
-    """Generate an AI image using Google Gemini"""
+    """Queue AI image generation with Google Gemini; returns a job to poll"""
     try:
         data = request.get_json()
         prompt = data.get('prompt', '').strip()
@@ -265,73 +926,63 @@ def generate_ai_image():
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
         
-        # Check if Gemini API key is available
-        api_key = os.environ.get('GEMINI_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'Gemini API key not configured. Please check your API key.'}), 503
-        
-        # Initialize Gemini client
-        client = genai.Client(api_key=api_key)
-        
-        # Create a unique filename for the generated image
-        import uuid
-        image_filename = f"generated_image_{uuid.uuid4().hex[:8]}.png"
-        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)
-        
-        # Generate image using Gemini
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-preview-image-generation",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_modalities=['TEXT', 'IMAGE']))
-        
-        if not response.candidates:
-            return jsonify({'error': 'No image generated by Gemini'}), 500
-        
-        content = response.candidates[0].content
-        if not content or not content.parts:
-            return jsonify({'error': 'Invalid response from Gemini API'}), 500
-        
-        # Find the image data in the response
-        image_data = None
-        for part in content.parts:
-            if part.inline_data and part.inline_data.data:
-                image_data = part.inline_data.data
-                break
+        # Do not queue jobs that would only fail while Gemini's breaker is open
+        gemini_guard.check()
+        job = generation_jobs.submit(current_user_id(), run_image_job, kind='gemini-image', client=image_client(), prompt=prompt)
         
-        if not image_data:
-            return jsonify({'error': 'No image data found in Gemini response'}), 500
-        
-        # Save the image data to a file
-        with open(image_path, 'wb') as f:
-            f.write(image_data)
-        
-        # Convert to base64 for frontend use
-        with open(image_path, 'rb') as f:
-            img_data = f.read()
-            img_base64 = base64.b64encode(img_data).decode('utf-8')
-        
-        # Clean up the temporary file
-        os.remove(image_path)
-        
-        return jsonify({
-            'success': True,
-            'image_url': f'data:image/png;base64,{img_base64}'
-        })
+        payload = job_payload(job)
+        payload['status_url'] = url_for('generation_job_status', job_id=job['id'])
+        payload['events_url'] = url_for('generation_job_events', job_id=job['id'])
+        return jsonify(payload), 202
         
+    except (GeminiError, JobError) as e:
+        return jsonify({'error': e.message}), e.status
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, 'Image generation is temporarily unavailable, please retry')
     except Exception as e:
-        error_msg = str(e)
-        current_app.logger.error(f"Gemini image generation error: {error_msg}")
-        
-        # Provide more specific error messages
-        if "quota" in error_msg.lower() or "limit" in error_msg.lower():
-            return jsonify({'error': 'Gemini API quota exceeded. Please check your usage limits.'}), 402
-        elif "key" in error_msg.lower() or "auth" in error_msg.lower():
-            return jsonify({'error': 'Invalid Gemini API key. Please verify your key is correct.'}), 401
-        elif "model" in error_msg.lower():
-            return jsonify({'error': 'Gemini image generation model not available. Please try again later.'}), 503
-        else:
-            return jsonify({'error': f'Image generation failed: {error_msg}'}), 500
+        current_app.logger.error(f"Gemini image generation error: {str(e)}")
+        return jsonify({'error': f'Image generation failed: {str(e)}'}), 500
+
+@app.route('/api/gemini/jobs/<job_id>')
+def generation_job_status(job_id):
+    """Poll a generation job"""
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    response = jsonify(job_payload(job))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/gemini/jobs/<job_id>/events')
+def generation_job_events(job_id):
+    """
+    Stream job status changes as Server-Sent Events until the job finishes
+
+    Each stream holds a connection for up to JOB_EVENTS_TIMEOUT seconds, so
+    it suits threaded or async workers; sync workers should poll instead.
+    """
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    
+    def events(job):
+        deadline = time.time() + JOB_EVENTS_TIMEOUT
+        yield f'event: status\ndata: {json.dumps(job_payload(job))}\n\n'
+        while job['status'] in ACTIVE_STATES and time.time() < deadline:
+            updated = job['updated']
+            job = generation_jobs.wait(job['id'], updated, min(15, deadline - time.time()))
+            if job is None:
+                return
+            if job['updated'] == updated and job['status'] in ACTIVE_STATES:
+                # Keep-alive comment so proxies do not drop an idle stream
+                yield ': ping\n\n'
+            else:
+                yield f'event: status\ndata: {json.dumps(job_payload(job))}\n\n'
+    
+    response = Response(stream_with_context(events(job)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/gemini/generate-text', methods=['POST'])
 def generate_text():
@@ -339,98 +990,36 @@ def generate_text():
     try:
         data = request.get_json()
         prompt = data.get('prompt', '').strip()
-        text_type = data.get('type', 'title')  # 'title' or 'subtitle'
+        text_type = data.get('type', 'title')  # 'title', 'subtitle' or 'both'
+        if text_type not in TEXT_TYPES:
+            text_type = 'subtitle'
+        
+        # 0 for the first generation, 1, 2, ... when the user regenerates
+        try:
+            variant = max(int(data.get('variant', 0)), 0)
+        except (TypeError, ValueError):
+            variant = 0
         
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
         
-        # Check if Gemini API key is available
-        api_key = os.environ.get('GEMINI_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'Gemini API key not configured'}), 503
-        
-        # Initialize Gemini client
-        client = genai.Client(api_key=api_key)
-        
-        # Create prompt for both title and subtitle generation
-        if text_type == 'both':
-            system_prompt = f"""
-            Generate both a compelling advertising title and subtitle for: {prompt}
-            
-            Requirements:
-            - Title: Short, catchy, max 10 words, under 200 characters
-            - Subtitle: Persuasive tagline that complements the title, max 15 words, under 200 characters
-            - Return in JSON format: {{"title": "Your Title", "subtitle": "Your Subtitle"}}
-            - Only return the JSON, nothing else
-            """
-        else:
-            # Fallback for individual text generation
-            if text_type == 'title':
-                system_prompt = f"Generate a compelling, concise ad title (maximum 200 characters, preferably under 8 words) for: {prompt}. Return only the title text, no quotes or explanations."
-            else:  # subtitle
-                system_prompt = f"Generate an engaging subtitle or description (maximum 200 characters, preferably under 25 words) for: {prompt}. Return only the subtitle text, no quotes or explanations."
-        
-        # Generate text with Gemini
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=system_prompt
-        )
-        
-        if not response or not response.text:
-            return jsonify({'error': 'No text generated'}), 500
+        generated, variant, cached = text_variants.get(prompt, text_type, variant, text_client)
         
-        # Handle combined text generation
+        result = {'success': True, 'variant': variant, 'cached': cached}
         if text_type == 'both':
-            try:
-                import json
-                generated_text = response.text.strip()
-                
-                # Remove any markdown formatting if present
-                if generated_text.startswith('```json'):
-                    generated_text = generated_text.replace('```json', '').replace('```', '').strip()
-                elif generated_text.startswith('```'):
-                    generated_text = generated_text.replace('```', '').strip()
-                
-                result = json.loads(generated_text)
-                
-                return jsonify({
-                    'success': True,
-                    'title': result.get('title', '').strip()[:200],
-                    'subtitle': result.get('subtitle', '').strip()[:200]
-                })
-                
-            except json.JSONDecodeError:
-                # Fallback: try to extract title and subtitle from plain text
-                lines = [line.strip() for line in generated_text.split('\n') if line.strip()]
-                title = lines[0] if len(lines) > 0 else f"Amazing {prompt}"
-                subtitle = lines[1] if len(lines) > 1 else f"Discover the best {prompt}"
-                
-                return jsonify({
-                    'success': True,
-                    'title': title[:200],
-                    'subtitle': subtitle[:200]
-                })
+            result.update(title=generated['title'], subtitle=generated['subtitle'])
         else:
-            # Handle individual text generation
-            generated_text = response.text.strip()
-            # Remove quotes if present
-            if generated_text.startswith('"') and generated_text.endswith('"'):
-                generated_text = generated_text[1:-1]
-            if generated_text.startswith("'") and generated_text.endswith("'"):
-                generated_text = generated_text[1:-1]
-            
-            # Ensure text doesn't exceed 200 characters
-            if len(generated_text) > 200:
-                generated_text = generated_text[:200].strip()
-        
-        return jsonify({
-            'success': True,
-            'text': generated_text
-        })
+            result['text'] = generated
+        return jsonify(result)
         
+    except GeminiError as e:
+        return jsonify({'error': e.message}), e.status
+    except UpstreamUnavailable as e:
+        return upstream_unavailable(e, 'Text generation is temporarily unavailable, please retry')
     except Exception as e:
         current_app.logger.error(f"Gemini text generation error: {str(e)}")
-        return jsonify({'error': f'Text generation failed: {str(e)}'}), 500
+        error = classify_error(e, 'Text generation', 'text')
+        return jsonify({'error': error.message}), error.status
 
 @app.errorhandler(413)
 def too_large(e):
@@ -0,0 +1,390 @@
+"""
+Helpers shared by the server-side renderers of Fabric.js scene JSON
+
+A scene document is what TemplateAdsEditor produces with canvas.toJSON(['id'])
+plus the canvas size: {"scene": {"background": ..., "objects": [...]},
+"width": 1528, "height": 800}. Coordinates are CSS pixels (96 per inch).
+"""
+import os
+import io
+import re
+import math
+import base64
+import hashlib
+from functools import lru_cache
+from PIL import ImageColor
+from cache import LRUCache
+from imaging import decode_image
+
+CSS_DPI = 96
+
+# Fabric.js text metrics constants (fabric.Text._fontSizeMult / _fontSizeFraction)
+FABRIC_FONT_SIZE_MULT = 1.13
+FABRIC_FONT_SIZE_FRACTION = 0.222
+
+ORIGIN_FRACTIONS = {'left': 0.0, 'top': 0.0, 'center': 0.5, 'right': 1.0, 'bottom': 1.0}
+
+TEXT_TYPES = ('text', 'textbox', 'i-text')
+
+# Output pixels per scene pixel; 8x is about 770 DPI, beyond any print need
+MAX_MULTIPLIER = 8.0
+
+# Object, clipPath and shadow fields the renderers read as numbers
+NUMERIC_FIELDS = (
+    'left', 'top', 'width', 'height', 'scaleX', 'scaleY', 'angle', 'opacity',
+    'strokeWidth', 'rx', 'cropX', 'cropY', 'fontSize', 'lineHeight',
+    'offsetX', 'offsetY', 'blur'
+)
+
+FONT_DIR = os.environ.get('FONT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'fonts'))
+SYSTEM_FONT_DIRS = ('/usr/share/fonts', '/usr/local/share/fonts', os.path.expanduser('~/.fonts'), '/Library/Fonts')
+FALLBACK_FAMILIES = ('DejaVu Sans', 'Vera', 'Liberation Sans', 'Arial')
+
+
+class SceneError(ValueError):
+    """Raised for scene documents that cannot be rendered"""
+
+
+def parse_number(value):
+    """float(value) for finite numbers, else None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def coerce_numbers(obj):
+    """
+    Turn the numeric fields of a scene object (and its clipPath, shadow and
+    group children) into floats in place, so renderers can trust them
+    """
+    for field in NUMERIC_FIELDS:
+        value = obj.get(field)
+        if value is None or value == '':
+            # Renderers fall back to the Fabric default
+            obj.pop(field, None)
+            continue
+        number = parse_number(value)
+        if number is None:
+            raise SceneError(f'Invalid {field} {value!r} ({obj.get("type", "scene")} object)')
+        obj[field] = number
+    for key in ('clipPath', 'shadow'):
+        if isinstance(obj.get(key), dict):
+            coerce_numbers(obj[key])
+    children = obj.get('objects')
+    if children is not None:
+        if not isinstance(children, list):
+            raise SceneError('Group objects must be a list')
+        for child in children:
+            if isinstance(child, dict):
+                coerce_numbers(child)
+
+
+def parse_scene_document(document):
+    """Validate a scene document and return (scene, width, height)"""
+    if not isinstance(document, dict):
+        raise SceneError('Scene document must be a JSON object')
+    scene = document.get('scene')
+    if not isinstance(scene, dict) or not isinstance(scene.get('objects', []), list):
+        raise SceneError('Scene must contain an objects list')
+    width = parse_number(document.get('width') or scene.get('width'))
+    height = parse_number(document.get('height') or scene.get('height'))
+    if width is None or height is None:
+        raise SceneError('Scene width and height are required')
+    if width <= 0 or height <= 0:
+        raise SceneError('Scene width and height must be positive')
+    for obj in scene.get('objects', []):
+        if isinstance(obj, dict):
+            coerce_numbers(obj)
+    return scene, width, height
+
+
+def scene_multiplier(options):
+    """Output pixels per scene pixel, from an explicit multiplier or a target DPI"""
+    if options.get('multiplier') is not None:
+        multiplier = parse_number(options['multiplier'])
+    elif options.get('dpi') is not None:
+        dpi = parse_number(options['dpi'])
+        multiplier = dpi / CSS_DPI if dpi is not None else None
+    else:
+        return 1.0
+    if multiplier is None or multiplier <= 0:
+        raise SceneError('Invalid multiplier or dpi')
+    if multiplier > MAX_MULTIPLIER:
+        raise SceneError(f'Multiplier is limited to {MAX_MULTIPLIER:g}x ({MAX_MULTIPLIER * CSS_DPI:g} DPI)')
+    return multiplier
+
+
+def parse_color(value):
+    """Parse a CSS color into an (r, g, b, a) tuple; None for empty/transparent"""
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    if value.lower() in ('transparent', 'none'):
+        return None
+    match = re.match(r'rgba?\(\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)\s*(?:,\s*([\d.]+)\s*)?\)$', value)
+    if match:
+        r, g, b = (int(float(match.group(i))) for i in (1, 2, 3))
+        alpha = float(match.group(4)) if match.group(4) is not None else 1.0
+        return (r, g, b, int(round(min(max(alpha, 0.0), 1.0) * 255)))
+    try:
+        color = ImageColor.getrgb(value)
+    except ValueError:
+        return None
+    return color if len(color) == 4 else color + (255,)
+
+
+def origin_fraction(origin):
+    if isinstance(origin, (int, float)):
+        return float(origin)
+    return ORIGIN_FRACTIONS.get(origin, 0.0)
+
+
+def object_size(obj):
+    """Unscaled (width, height) of a Fabric object"""
+    return float(obj.get('width') or 0), float(obj.get('height') or 0)
+
+
+def object_center(obj):
+    """
+    Center of an object in its parent's coordinate space
+
+    Fabric positions objects by (left, top) at their origin point; the center
+    is offset from there by the scaled size, rotated by the object's angle.
+    """
+    width, height = object_size(obj)
+    scaled_w = width * float(obj.get('scaleX', 1))
+    scaled_h = height * float(obj.get('scaleY', 1))
+    dx = (0.5 - origin_fraction(obj.get('originX', 'left'))) * scaled_w
+    dy = (0.5 - origin_fraction(obj.get('originY', 'top'))) * scaled_h
+    angle = math.radians(float(obj.get('angle', 0) or 0))
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    return (
+        float(obj.get('left', 0)) + dx * cos_a - dy * sin_a,
+        float(obj.get('top', 0)) + dx * sin_a + dy * cos_a
+    )
+
+
+def absolute_clip_box(obj):
+    """Canvas-space (x0, y0, x1, y1) of an absolutely positioned rect clipPath, or None"""
+    clip = obj.get('clipPath')
+    if not isinstance(clip, dict) or not clip.get('absolutePositioned'):
+        return None
+    width, height = object_size(clip)
+    width *= float(clip.get('scaleX', 1))
+    height *= float(clip.get('scaleY', 1))
+    x0 = float(clip.get('left', 0)) - origin_fraction(clip.get('originX', 'left')) * width
+    y0 = float(clip.get('top', 0)) - origin_fraction(clip.get('originY', 'top')) * height
+    return (x0, y0, x0 + width, y0 + height)
+
+
+def is_bold(weight):
+    if isinstance(weight, str) and weight.lower() in ('bold', 'bolder'):
+        return True
+    try:
+        return int(weight) >= 600
+    except (TypeError, ValueError):
+        return False
+
+
+def is_italic(style):
+    return isinstance(style, str) and style.lower() in ('italic', 'oblique')
+
+
+def primary_family(font_family):
+    """First family of a CSS font-family list ('Source Sans Pro, sans-serif' -> 'Source Sans Pro')"""
+    family = (font_family or '').split(',')[0].strip().strip('"\'')
+    return family or FALLBACK_FAMILIES[0]
+
+
+class FontResolver:
+    """
+    Maps CSS font families to TrueType/OpenType files
+
+    Looks in FONT_DIR first (drop e.g. Roboto-Bold.ttf there), then the
+    system font directories, and falls back to a generic sans-serif face.
+    """
+
+    STYLE_SUFFIXES = {
+        (False, False): ('regular', ''),
+        (True, False): ('bold',),
+        (False, True): ('italic', 'oblique'),
+        (True, True): ('bolditalic', 'boldoblique'),
+    }
+
+    def __init__(self, font_dirs):
+        self.font_dirs = font_dirs
+        self._index = None
+
+    @staticmethod
+    def _normalize(name):
+        return re.sub(r'[\s_\-]', '', name).lower()
+
+    def _build_index(self):
+        index = {}
+        for directory in self.font_dirs:
+            for root, _, files in os.walk(directory):
+                for filename in files:
+                    stem, ext = os.path.splitext(filename)
+                    if ext.lower() in ('.ttf', '.otf'):
+                        index.setdefault(self._normalize(stem), os.path.join(root, filename))
+        return index
+
+    @lru_cache(maxsize=256)
+    def find(self, family, bold=False, italic=False):
+        """Return the font file for a family/style, or None when nothing matches"""
+        if self._index is None:
+            self._index = self._build_index()
+        styles = [(bold, italic), (bold, False), (False, False)]
+        for candidate in (family,) + FALLBACK_FAMILIES:
+            base = self._normalize(candidate)
+            # Prefer the requested family in another style over a fallback family
+            for style in styles:
+                for suffix in self.STYLE_SUFFIXES[style]:
+                    path = self._index.get(base + suffix)
+                    if path:
+                        return path
+        return None
+
+
+font_resolver = FontResolver((FONT_DIR,) + SYSTEM_FONT_DIRS)
+
+
+@lru_cache(maxsize=128)
+def load_font(path, size):
+    """Cached Pillow font for a file and pixel size"""
+    # FreeType bindings load with the first text render, not at startup
+    from PIL import ImageFont
+
+    if path is None:
+        return ImageFont.load_default(size)
+    return ImageFont.truetype(path, size)
+
+
+def font_for(obj, scale=1.0):
+    """Pillow font for a text object rendered at the given scale"""
+    path = font_resolver.find(
+        primary_family(obj.get('fontFamily')),
+        is_bold(obj.get('fontWeight')),
+        is_italic(obj.get('fontStyle'))
+    )
+    size = max(int(round(float(obj.get('fontSize', 40)) * scale)), 1)
+    return load_font(path, size)
+
+
+@lru_cache(maxsize=16384)
+def measure_text(font, text):
+    """Cached advance width of a string in a Pillow font"""
+    return font.getlength(text)
+
+
+def wrap_paragraph(paragraph, measure, max_width):
+    """Greedy word wrap matching fabric.Textbox (long words stay on their own line)"""
+    words = paragraph.split(' ')
+    lines = []
+    current = ''
+    for word in words:
+        candidate = f'{current} {word}' if current else word
+        if current and measure(candidate) > max_width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    lines.append(current)
+    return lines
+
+
+def layout_text(obj, measure):
+    """
+    Lay out a Fabric Text/Textbox in object-local, unscaled units
+
+    measure(text) returns the advance width at the object's fontSize. Returns
+    a list of (line, x, baseline) with (0, 0) at the object's top-left corner.
+    """
+    font_size = float(obj.get('fontSize', 40))
+    line_height = float(obj.get('lineHeight', 1.16))
+    width = float(obj.get('width') or 0)
+    wrap = obj.get('type') == 'textbox' and width > 0
+
+    lines = []
+    for paragraph in str(obj.get('text', '')).split('\n'):
+        lines.extend(wrap_paragraph(paragraph, measure, width) if wrap else [paragraph])
+
+    max_height = font_size * FABRIC_FONT_SIZE_MULT
+    line_step = max_height * line_height
+    align = obj.get('textAlign', 'left')
+
+    layout = []
+    for index, line in enumerate(lines):
+        line_width = measure(line)
+        if align == 'center':
+            x = (width - line_width) / 2
+        elif align == 'right':
+            x = width - line_width
+        else:
+            x = 0.0
+        baseline = index * line_step + max_height * (1 - FABRIC_FONT_SIZE_FRACTION)
+        layout.append((line, x, baseline))
+    return layout
+
+
+def image_bytes(image):
+    """Memory held by a decoded image"""
+    return image.width * image.height * len(image.getbands())
+
+
+# Decoded scene images, keyed by resolved file path or data URL hash, bounded by decoded size
+_image_cache = LRUCache(
+    max_entries=int(os.environ.get('SCENE_IMAGE_CACHE_SIZE', 32)),
+    default_ttl=3600,
+    max_bytes=int(os.environ.get('SCENE_IMAGE_CACHE_BYTES', 128 * 1024 * 1024)),
+    sizeof=image_bytes
+)
+
+
+def load_scene_image(src, resolve_asset):
+    """
+    Decode an image referenced by a scene as RGBA, using the shared cache
+
+    Data URLs are decoded inline; anything else must be mapped to a local file
+    by resolve_asset(src) -- scenes never trigger arbitrary remote fetches.
+    """
+    if not src:
+        return None
+    if src.startswith('data:'):
+        key = 'data:' + hashlib.sha256(src.encode('utf-8')).hexdigest()
+        source = lambda: io.BytesIO(base64.b64decode(src.split(',', 1)[1]))
+    else:
+        path = resolve_asset(src)
+        if not path:
+            return None
+        key = path
+        source = lambda: path
+
+    image = _image_cache.get(key)
+    if image is None:
+        # Data URLs are client input; both kinds go through the pixel budget
+        image = decode_image(source())
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        _image_cache.set(key, image)
+    return image
+
+
+def image_source(obj):
+    """Prefer the full-resolution original the editor keeps next to a preview"""
+    return obj.get('originalSrc') or obj.get('src')
+
+
+def scene_image_sources(objects):
+    """Every image src referenced by a list of scene objects, including inside groups"""
+    for obj in objects:
+        if not isinstance(obj, dict):
+            continue
+        if obj.get('type') == 'image' and image_source(obj):
+            yield image_source(obj)
+        if obj.get('type') == 'group':
+            yield from scene_image_sources(obj.get('objects', []))
@@ -0,0 +1,249 @@
+"""Rasterize Fabric.js scene JSON with Pillow at any resolution"""
+import math
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
+from imaging import check_dimensions
+from scene import (
+    TEXT_TYPES, FABRIC_FONT_SIZE_MULT, FABRIC_FONT_SIZE_FRACTION,
+    parse_scene_document, parse_color, object_size, object_center, absolute_clip_box,
+    font_for, measure_text, layout_text, load_scene_image, image_source
+)
+
+
+class RasterRenderer:
+    """
+    Renders a scene document to an RGBA Pillow image
+
+    Each object is drawn unrotated into its own layer at output resolution,
+    then shadowed, faded, rotated and composited at its center, which mirrors
+    how Fabric transforms objects around their center point.
+
+    The output and every layer are held to the same pixel budget as decoded
+    images (imaging.check_dimensions), so an oversized scene is refused with
+    a 413 like an oversized upload.
+    """
+
+    def __init__(self, resolve_asset, multiplier=1.0, max_pixels=None):
+        self.resolve_asset = resolve_asset
+        self.multiplier = multiplier
+        self.max_pixels = max_pixels
+
+    def render(self, document):
+        scene, width, height = parse_scene_document(document)
+        out_w = max(int(round(width * self.multiplier)), 1)
+        out_h = max(int(round(height * self.multiplier)), 1)
+        check_dimensions(out_w, out_h, self.max_pixels)
+
+        canvas = Image.new('RGBA', (out_w, out_h), parse_color(scene.get('background')) or (0, 0, 0, 0))
+        for obj in scene.get('objects', []):
+            self._place(canvas, obj, (0.0, 0.0), self.multiplier, self.multiplier, clip=True)
+        return canvas
+
+    def _place(self, target, obj, origin, scale_x, scale_y, clip=False):
+        """Composite obj onto target; origin is where the parent's (0, 0) lands"""
+        prepared = self._prepare(obj, scale_x, scale_y)
+        if prepared is None:
+            return
+        layer, center_x, center_y = prepared
+        x = origin[0] + center_x - layer.width / 2
+        y = origin[1] + center_y - layer.height / 2
+
+        clip_box = absolute_clip_box(obj) if clip else None
+        if clip_box:
+            clip_box = tuple(value * self.multiplier for value in clip_box)
+        composite(target, layer, x, y, clip_box)
+
+    def _prepare(self, obj, scale_x, scale_y):
+        """
+        Render obj with its effects applied
+
+        Returns (layer, center_x, center_y) with the center in output pixels
+        relative to the parent's origin, or None for nothing to draw.
+        """
+        if not isinstance(obj, dict) or obj.get('visible') is False:
+            return None
+        sx = scale_x * float(obj.get('scaleX', 1))
+        sy = scale_y * float(obj.get('scaleY', 1))
+        layer = self._render_layer(obj, sx, sy)
+        if layer is None:
+            return None
+
+        if obj.get('flipX'):
+            layer = ImageOps.mirror(layer)
+        if obj.get('flipY'):
+            layer = ImageOps.flip(layer)
+
+        opacity = float(obj.get('opacity', 1))
+        if opacity < 1:
+            alpha = layer.getchannel('A').point(lambda a: int(a * opacity))
+            layer.putalpha(alpha)
+
+        layer = self._apply_shadow(layer, obj.get('shadow'), sx, sy)
+
+        angle = float(obj.get('angle', 0) or 0)
+        if angle:
+            radians = math.radians(angle)
+            cos_a, sin_a = abs(math.cos(radians)), abs(math.sin(radians))
+            self._check_size(layer.width * cos_a + layer.height * sin_a, layer.width * sin_a + layer.height * cos_a)
+            layer = layer.rotate(-angle, resample=Image.BICUBIC, expand=True)
+
+        center_x, center_y = object_center(obj)
+        return layer, center_x * scale_x, center_y * scale_y
+
+    def _render_layer(self, obj, sx, sy):
+        kind = obj.get('type')
+        if kind == 'rect':
+            return self._render_rect(obj, sx, sy)
+        if kind == 'image':
+            return self._render_image(obj, sx, sy)
+        if kind in TEXT_TYPES:
+            return self._render_text(obj, sx, sy)
+        if kind == 'group':
+            return self._render_group(obj, sx, sy)
+        return None
+
+    def _check_size(self, width, height):
+        """Integer (width, height) of a layer, refused with a 413 when over the pixel budget"""
+        size = max(int(math.ceil(width)), 1), max(int(math.ceil(height)), 1)
+        check_dimensions(*size, self.max_pixels)
+        return size
+
+    def _layer_size(self, obj, sx, sy):
+        width, height = object_size(obj)
+        return self._check_size(width * sx, height * sy)
+
+    def _render_rect(self, obj, sx, sy):
+        size = self._layer_size(obj, sx, sy)
+        layer = Image.new('RGBA', size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        radius = float(obj.get('rx', 0) or 0) * min(sx, sy)
+        stroke = parse_color(obj.get('stroke'))
+        stroke_width = int(round(float(obj.get('strokeWidth', 0) or 0) * min(sx, sy))) if stroke else 0
+        draw.rounded_rectangle(
+            (0, 0, size[0] - 1, size[1] - 1),
+            radius=radius,
+            fill=parse_color(obj.get('fill')),
+            outline=stroke,
+            width=stroke_width
+        )
+        return layer
+
+    def _render_image(self, obj, sx, sy):
+        image = load_scene_image(image_source(obj), self.resolve_asset)
+        if image is None:
+            return None
+        if not obj.get('originalSrc'):
+            # Crop offsets are relative to the element the editor loaded
+            crop_x = float(obj.get('cropX', 0) or 0)
+            crop_y = float(obj.get('cropY', 0) or 0)
+            width, height = object_size(obj)
+            if crop_x or crop_y or (width and width < image.width) or (height and height < image.height):
+                image = image.crop((crop_x, crop_y, crop_x + (width or image.width), crop_y + (height or image.height)))
+        return image.resize(self._layer_size(obj, sx, sy), Image.LANCZOS)
+
+    def _render_text(self, obj, sx, sy):
+        # Draw at the vertical scale, then stretch horizontally if scaling is uneven
+        font = font_for(obj, sy)
+        base_font = font_for(obj, 1.0)
+        measure = lambda text: measure_text(base_font, text)
+        lines = layout_text(obj, measure)
+        if not lines:
+            return None
+
+        width, height = object_size(obj)
+        stroke = parse_color(obj.get('stroke'))
+        stroke_width = float(obj.get('strokeWidth', 0) or 0) if stroke else 0.0
+
+        # Server fonts can be wider than the browser's; pad symmetrically so
+        # overflowing text is not cut off and the object's center stays put
+        font_size = float(obj.get('fontSize', 40))
+        descent = font_size * FABRIC_FONT_SIZE_MULT * FABRIC_FONT_SIZE_FRACTION
+        left = min(x for _, x, _ in lines)
+        right = max(x + measure(line) for line, x, _ in lines)
+        bottom = lines[-1][2] + descent
+        pad_x = max(0.0, -left, right - width) + stroke_width
+        pad_y = max(0.0, bottom - height) + stroke_width
+
+        layer = Image.new('RGBA', self._check_size((width + 2 * pad_x) * sy, (height + 2 * pad_y) * sy), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        fill = parse_color(obj.get('fill')) or (0, 0, 0, 255)
+        for line, x, baseline in lines:
+            draw.text(
+                ((x + pad_x) * sy, (baseline + pad_y) * sy),
+                line,
+                font=font,
+                fill=fill,
+                anchor='ls',
+                stroke_width=int(round(stroke_width * sy)),
+                stroke_fill=stroke
+            )
+
+        if abs(sx - sy) > 1e-6:
+            layer = layer.resize(self._check_size(round(layer.width * sx / sy), layer.height), Image.LANCZOS)
+        return layer
+
+    def _render_group(self, obj, sx, sy):
+        children = [self._prepare(child, sx, sy) for child in obj.get('objects', [])]
+        children = [child for child in children if child is not None]
+
+        # Group children are positioned relative to the group's center; grow
+        # the layer symmetrically if any child reaches past the group bounds
+        width, height = self._layer_size(obj, sx, sy)
+        half_w, half_h = width / 2, height / 2
+        for layer, center_x, center_y in children:
+            half_w = max(half_w, abs(center_x) + layer.width / 2)
+            half_h = max(half_h, abs(center_y) + layer.height / 2)
+
+        group_layer = Image.new('RGBA', self._check_size(half_w * 2, half_h * 2), (0, 0, 0, 0))
+        for layer, center_x, center_y in children:
+            composite(group_layer, layer, half_w + center_x - layer.width / 2, half_h + center_y - layer.height / 2)
+        return group_layer
+
+    def _apply_shadow(self, layer, shadow, sx, sy):
+        if not isinstance(shadow, dict):
+            return layer
+        color = parse_color(shadow.get('color'))
+        if color is None:
+            return layer
+        offset_x = float(shadow.get('offsetX', 0) or 0) * sx
+        offset_y = float(shadow.get('offsetY', 0) or 0) * sy
+        blur = float(shadow.get('blur', 0) or 0) * (sx + sy) / 2
+
+        # Grow the layer so the blurred, offset shadow is not cut off
+        pad = int(math.ceil(blur + max(abs(offset_x), abs(offset_y))))
+        size = self._check_size(layer.width + 2 * pad, layer.height + 2 * pad)
+        shadow_alpha = Image.new('L', size, 0)
+        shadow_alpha.paste(layer.getchannel('A'), (pad + int(round(offset_x)), pad + int(round(offset_y))))
+        if blur:
+            shadow_alpha = shadow_alpha.filter(ImageFilter.GaussianBlur(blur / 2))
+        if color[3] < 255:
+            shadow_alpha = shadow_alpha.point(lambda a: a * color[3] // 255)
+
+        result = Image.new('RGBA', size, color[:3] + (0,))
+        result.putalpha(shadow_alpha)
+        result.alpha_composite(layer, (pad, pad))
+        return result
+
+
+def composite(target, layer, x, y, clip_box=None):
+    """alpha_composite layer at a float position, cropping to the target and clip box"""
+    x0, y0 = int(round(x)), int(round(y))
+    bounds = (0, 0, target.width, target.height)
+    if clip_box:
+        bounds = (
+            max(bounds[0], int(round(clip_box[0]))),
+            max(bounds[1], int(round(clip_box[1]))),
+            min(bounds[2], int(round(clip_box[2]))),
+            min(bounds[3], int(round(clip_box[3])))
+        )
+    left = max(x0, bounds[0])
+    top = max(y0, bounds[1])
+    right = min(x0 + layer.width, bounds[2])
+    bottom = min(y0 + layer.height, bounds[3])
+    if right <= left or bottom <= top:
+        return
+    target.alpha_composite(layer, (left, top), (left - x0, top - y0, right - x0, bottom - y0))
+
+
+def render_scene(document, resolve_asset, multiplier=1.0, max_pixels=None):
+    """Render a scene document to an RGBA image (max_pixels defaults to IMAGE_MAX_PIXELS)"""
+    return RasterRenderer(resolve_asset, multiplier, max_pixels).render(document)
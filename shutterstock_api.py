@@ -1,24 +1,151 @@
 import os
+import asyncio
+import threading
 import requests
 import base64
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import upstream_call
+from upstream_guard import shutterstock_guard, preview_guard, is_failure_status
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class PoolStats:
+    """Thread-safe counters describing how well the connection pool is reused"""
 
-class ShutterstockAPI:
     def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+
+class _CountingRetry(Retry):
+    """urllib3 Retry that reports every retry attempt to a PoolStats instance"""
+
+    def __init__(self, *args, stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.stats = self.stats
+        return retry
+
+    def increment(self, *args, **kwargs):
+        # Raises MaxRetryError once retries are exhausted; only count the retries that happen
+        retry = super().increment(*args, **kwargs)
+        if self.stats is not None:
+            self.stats.record_retry()
+        return retry
+
+
+class ShutterstockAPI:
+    def __init__(self, session=None, timeout=None):
         self.api_token = os.environ.get('SHUTTERSTOCK_API_TOKEN')
-        self.base_url = 'https://api-sandbox.shutterstock.com/v2'
-        
+        self.base_url = os.environ.get('SHUTTERSTOCK_API_BASE', 'https://api-sandbox.shutterstock.com/v2').rstrip('/')
+
         if not self.api_token:
             raise ValueError("Shutterstock API token not found in environment variables")
-    
+
+        # Connection pooling: one keep-alive session shared by every call
+        self.stats = PoolStats()
+        self.session = session or self._build_session()
+        self.timeout = timeout or (
+            _env_float('SHUTTERSTOCK_CONNECT_TIMEOUT', 3.05),
+            _env_float('SHUTTERSTOCK_READ_TIMEOUT', 15)
+        )
+
+    def _build_session(self):
+        """Create a pooled session with retry-with-backoff for 429/5xx responses"""
+        pool_size = _env_int('SHUTTERSTOCK_POOL_SIZE', 10)
+        retry = _CountingRetry(
+            total=_env_int('SHUTTERSTOCK_MAX_RETRIES', 3),
+            backoff_factor=_env_float('SHUTTERSTOCK_RETRY_BACKOFF', 0.3),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            stats=self.stats
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _get(self, url, operation, **kwargs):
+        """
+        Issue a GET through the pooled session, timing it as `operation`
+
+        Raises UpstreamUnavailable while the upstream's breaker is open or
+        its rate limit is used up.
+        """
+        self.stats.record_request()
+        kwargs.setdefault('timeout', self.timeout)
+        guard = preview_guard if operation == 'preview' else shutterstock_guard
+        with guard.call() as guarded, upstream_call('shutterstock', operation) as call:
+            response = self.session.get(url, **kwargs)
+            if not response.ok:
+                call.outcome = str(response.status_code)
+                guarded.failed = is_failure_status(response.status_code)
+        return response
+
+    def pool_stats(self):
+        """
+        Report connection reuse for this client
+
+        Returns a dict with the number of requests sent, new connections opened,
+        requests served on an already-open connection (hits) and retries.
+        """
+        new_connections = 0
+        pooled_requests = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                new_connections += pool.num_connections
+                pooled_requests += pool.num_requests
+
+        return {
+            'requests': self.stats.requests,
+            'new_connections': new_connections,
+            'hits': max(pooled_requests - new_connections, 0),
+            'retries': self.stats.retries
+        }
+
     def get_auth_header(self):
         """Create Bearer token header for Shutterstock API"""
         return {"Authorization": f"Bearer {self.api_token}"}
-    
+
     def search_images(self, query, page=1, per_page=20, category=None, orientation=None):
         """
         Search for images on Shutterstock
-        
+
         Args:
             query: Search term
             page: Page number (default 1)
@@ -27,7 +154,7 @@ class ShutterstockAPI:
             orientation: 'horizontal', 'vertical', or 'square'
         """
         endpoint = f"{self.base_url}/images/search"
-        
+
         params = {
             'query': query,
             'page': page,
@@ -35,40 +162,222 @@ class ShutterstockAPI:
             'sort': 'popular',
             'safe': 'true'
         }
-        
+
         if category:
             params['category'] = category
-            
+
         if orientation:
             params['orientation'] = orientation
-        
+
         headers = self.get_auth_header()
         headers['Content-Type'] = 'application/json'
-        
+
         try:
-            response = requests.get(endpoint, headers=headers, params=params)
+            response = self._get(endpoint, 'search', headers=headers, params=params)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             raise Exception(f"Shutterstock API error: {str(e)}")
-    
+
     def get_image_details(self, image_id):
         """Get detailed information about a specific image"""
         endpoint = f"{self.base_url}/images/{image_id}"
         headers = self.get_auth_header()
-        
+
         try:
-            response = requests.get(endpoint, headers=headers)
+            response = self._get(endpoint, 'details', headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             raise Exception(f"Shutterstock API error: {str(e)}")
-    
+
+    def open_image_preview(self, image_url):
+        """Open a streaming response for an image preview; the caller must close it"""
+        try:
+            response = self._get(image_url, 'preview', stream=True)
+            if not response.ok:
+                response.close()
+            response.raise_for_status()
+            return response
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Image download error: {str(e)}")
+
     def download_image_preview(self, image_url):
         """Download image preview for use in the editor"""
         try:
-            response = requests.get(image_url)
+            response = self._get(image_url, 'preview')
             response.raise_for_status()
             return response.content
         except requests.exceptions.RequestException as e:
-            raise Exception(f"Image download error: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Image download error: {str(e)}")
+
+
+class AsyncShutterstockAPI:
+    """
+    Non-blocking Shutterstock client for the ASGI entry point (asgi.py)
+
+    Same endpoints, timeouts and retry policy as ShutterstockAPI, on one
+    pooled httpx.AsyncClient per worker process.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, client=None):
+        self.api_token = os.environ.get('SHUTTERSTOCK_API_TOKEN')
+        self.base_url = os.environ.get('SHUTTERSTOCK_API_BASE', 'https://api-sandbox.shutterstock.com/v2').rstrip('/')
+
+        if not self.api_token:
+            raise ValueError("Shutterstock API token not found in environment variables")
+
+        self.stats = PoolStats()
+        self.max_retries = _env_int('SHUTTERSTOCK_MAX_RETRIES', 3)
+        self.backoff = _env_float('SHUTTERSTOCK_RETRY_BACKOFF', 0.3)
+        self.client = client or self._build_client()
+
+    def _build_client(self):
+        import httpx
+
+        pool_size = _env_int('SHUTTERSTOCK_POOL_SIZE', 10)
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                _env_float('SHUTTERSTOCK_READ_TIMEOUT', 15),
+                connect=_env_float('SHUTTERSTOCK_CONNECT_TIMEOUT', 3.05)
+            ),
+            # Async calls are cheap to keep open, so allow more than the sync pool
+            limits=httpx.Limits(max_connections=pool_size * 10, max_keepalive_connections=pool_size)
+        )
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    async def _get(self, url, operation, stream=False, **kwargs):
+        """
+        GET with retry-with-backoff for 429/5xx and connection errors
+
+        The retries count as one call against the upstream's guard.
+        """
+        guard = preview_guard if operation == 'preview' else shutterstock_guard
+        async with guard.acall() as guarded:
+            response = await self._get_with_retries(url, operation, stream, **kwargs)
+            guarded.failed = is_failure_status(response.status_code)
+        return response
+
+    async def _get_with_retries(self, url, operation, stream, **kwargs):
+        import httpx
+
+        attempt = 0
+        while True:
+            self.stats.record_request()
+            request = self.client.build_request('GET', url, **kwargs)
+            try:
+                with upstream_call('shutterstock', operation) as call:
+                    response = await self.client.send(request, stream=stream)
+                    if response.is_error:
+                        call.outcome = str(response.status_code)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                response = None
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                await response.aclose()
+            self.stats.record_retry()
+            await asyncio.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    async def search_images(self, query, page=1, per_page=20, category=None, orientation=None):
+        """Search for images on Shutterstock (see ShutterstockAPI.search_images)"""
+        import httpx
+
+        params = {
+            'query': query,
+            'page': page,
+            'per_page': min(per_page, 50),
+            'sort': 'popular',
+            'safe': 'true'
+        }
+        if category:
+            params['category'] = category
+        if orientation:
+            params['orientation'] = orientation
+
+        headers = self.get_auth_header()
+        headers['Content-Type'] = 'application/json'
+
+        try:
+            response = await self._get(f"{self.base_url}/images/search", 'search', headers=headers, params=params)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            raise Exception(f"Shutterstock API error: {str(e)}")
+
+    async def open_image_preview(self, image_url):
+        """Open a streaming response for an image preview; the caller must aclose() it"""
+        import httpx
+
+        try:
+            response = await self._get(image_url, 'preview', stream=True)
+            if response.is_error:
+                await response.aclose()
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError as e:
+            raise Exception(f"Image download error: {str(e)}")
+
+    def get_auth_header(self):
+        return {"Authorization": f"Bearer {self.api_token}"}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def is_preview_url(image_url):
+    """Only proxy previews hosted on Shutterstock domains (SHUTTERSTOCK_PREVIEW_HOSTS)"""
+    allowed_hosts = os.environ.get('SHUTTERSTOCK_PREVIEW_HOSTS', 'shutterstock.com')
+    parsed = urlparse(image_url)
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme not in ('http', 'https') or not host:
+        return False
+    for allowed in allowed_hosts.split(','):
+        allowed = allowed.strip().lower()
+        if allowed and (host == allowed or host.endswith('.' + allowed)):
+            return True
+    return False
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_shutterstock_client():
+    """
+    Return the per-worker ShutterstockAPI instance, creating it on first use
+
+    Raises ValueError (like ShutterstockAPI()) when the API token is missing,
+    so callers can keep reporting unconfigured credentials.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ShutterstockAPI()
+    return _client
+
+
+_async_client = None
+
+
+def get_async_shutterstock_client():
+    """
+    Return the per-worker AsyncShutterstockAPI, creating it on first use
+
+    Only called from the event loop, so no lock is needed.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncShutterstockAPI()
+    return _async_client
@@ -19,6 +19,11 @@ class TemplateAdsEditor {
         this.init();
     }
     
+    assetUrl(name) {
+        // index.html lists the content-hashed URLs; fall back to the plain static path
+        return (window.ASSET_URLS && window.ASSET_URLS[name]) || `/static/${name}`;
+    }
+    
     init() {
         // Initialize Fabric.js canvas
         this.canvas = new fabric.Canvas('designCanvas', {
@@ -76,7 +81,7 @@ class TemplateAdsEditor {
         this.loadTemplate(this.currentTemplate);
         
         // Load default image with proper error handling
-        const defaultImagePath = 'static/images/default-placeholder.png';
+        const defaultImagePath = this.assetUrl('images/default-placeholder.png');
 
         
         fabric.Image.fromURL(defaultImagePath, (img) => {
@@ -137,7 +142,7 @@ class TemplateAdsEditor {
 
     loadDefaultImage() {
         // Load the default placeholder image on page load
-        const defaultImagePath = '/static/images/default-placeholder.png';
+        const defaultImagePath = this.assetUrl('images/default-placeholder.png');
         this.addImageToCanvas(defaultImagePath, 'main');
     }
 
@@ -656,6 +661,14 @@ class TemplateAdsEditor {
             });
         }
         
+        const exportAll = document.getElementById('exportAll');
+        if (exportAll) {
+            exportAll.addEventListener('click', () => {
+                this.exportBatch(['png', 'jpeg', 'webp', 'pdf']);
+                this.hideExportDropdown();
+            });
+        }
+        
         // Close dropdown when clicking outside
         document.addEventListener('click', (e) => {
             if (!document.querySelector('.export-container').contains(e.target)) {
@@ -2989,7 +3002,7 @@ class TemplateAdsEditor {
         const canvasWidth = this.canvas.getWidth();
         const canvasHeight = this.canvas.getHeight();
         
-        // Clone the existing image
+        // Clone the existing image (keeping its full-resolution source)
         existingImg.clone((clonedImg) => {
             if (type === 'main') {
                 // Get image dimensions and position based on current template
@@ -3125,7 +3138,7 @@ class TemplateAdsEditor {
             }
             
             this.canvas.renderAll();
-        });
+        }, ['originalSrc']);
     }
     
     handleImageUpload(event, type) {
@@ -3142,7 +3155,12 @@ class TemplateAdsEditor {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                this.addImageToCanvas(data.data_url, type);
+                // Edit the main image on a downscaled preview; exports swap in the original
+                if (type === 'main' && data.preview_url) {
+                    this.addImageToCanvas(data.preview_url, type, data.url);
+                } else {
+                    this.addImageToCanvas(data.url, type);
+                }
             } else {
                 alert('Upload failed: ' + data.error);
             }
@@ -3153,8 +3171,17 @@ class TemplateAdsEditor {
         });
     }
     
-    addImageToCanvas(dataUrl, type) {
-        fabric.Image.fromURL(dataUrl, (img) => {
+    addImageToCanvas(dataUrl, type, originalUrl = null) {
+        fabric.Image.fromURL(dataUrl, (img, isError) => {
+            if (isError) {
+                console.error('Failed to load image from:', dataUrl);
+                alert('Failed to add image to canvas. Please try again.');
+                return;
+            }
+            
+            // Full-resolution source used only at export time
+            img.originalSrc = originalUrl;
+            
             const canvasWidth = this.canvas.getWidth();
             const canvasHeight = this.canvas.getHeight();
             
@@ -3374,22 +3401,65 @@ class TemplateAdsEditor {
         slider.style.setProperty('--fill-percent', `${percentage}%`);
     }
     
-    exportImage(format) {
-        const dataURL = this.canvas.toDataURL({
-            format: format === 'jpg' ? 'jpeg' : 'png',
-            quality: 0.95,
-            multiplier: 2 // Higher resolution
-        });
+    async withOriginalImages(render) {
+        // Temporarily swap downscaled editing previews for their originals
+        const images = this.canvas.getObjects().filter(obj =>
+            obj.type === 'image' && obj.originalSrc && obj.getSrc() !== obj.originalSrc
+        );
+        
+        const swapped = await Promise.all(images.map(img => new Promise(resolve => {
+            const previous = {
+                img: img,
+                src: img.getSrc(),
+                width: img.width,
+                scaleX: img.scaleX,
+                scaleY: img.scaleY
+            };
+            img.setSrc(img.originalSrc, (loaded, isError) => {
+                if (isError || !img.width) {
+                    resolve(null);
+                    return;
+                }
+                // Keep the on-canvas size identical with the larger bitmap
+                const ratio = previous.width / img.width;
+                img.set({ scaleX: previous.scaleX * ratio, scaleY: previous.scaleY * ratio });
+                resolve(previous);
+            }, { crossOrigin: 'anonymous' });
+        })));
         
-        fetch('/export-image', {
+        try {
+            return render();
+        } finally {
+            swapped.filter(Boolean).forEach(previous => {
+                previous.img.setSrc(previous.src, () => {
+                    previous.img.set({ scaleX: previous.scaleX, scaleY: previous.scaleY });
+                    this.canvas.requestRenderAll();
+                }, { crossOrigin: 'anonymous' });
+            });
+        }
+    }
+    
+    canvasToBlob(mimeType, quality, multiplier) {
+        // Render at export resolution and encode straight to a binary Blob
+        const element = this.canvas.toCanvasElement(multiplier);
+        return new Promise(resolve => element.toBlob(resolve, mimeType, quality));
+    }
+    
+    async exportImage(format) {
+        const mimeType = format === 'jpg' ? 'image/jpeg' : 'image/png';
+        const blob = await this.withOriginalImages(() => this.canvasToBlob(
+            mimeType,
+            0.95,
+            2 // Higher resolution
+        ));
+        
+        // Send the raw image bytes instead of a base64 data URL inside JSON
+        fetch(`/export-image?format=${encodeURIComponent(format)}`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': mimeType
             },
-            body: JSON.stringify({
-                imageData: dataURL,
-                format: format
-            })
+            body: blob
         })
         .then(response => {
             if (response.ok) {
@@ -3414,21 +3484,15 @@ class TemplateAdsEditor {
         });
     }
     
-    exportPdf() {
-        const dataURL = this.canvas.toDataURL({
-            format: 'png',
-            quality: 1,
-            multiplier: 2
-        });
+    async exportPdf() {
+        const blob = await this.withOriginalImages(() => this.canvasToBlob('image/png', 1, 2));
         
         fetch('/export-pdf', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'image/png'
             },
-            body: JSON.stringify({
-                imageData: dataURL
-            })
+            body: blob
         })
         .then(response => {
             if (response.ok) {
@@ -3453,6 +3517,41 @@ class TemplateAdsEditor {
         });
     }
     
+    async exportBatch(formats, sizes = ['original']) {
+        const blob = await this.withOriginalImages(() => this.canvasToBlob('image/png', 1, 2));
+        const query = `formats=${encodeURIComponent(formats.join(','))}&sizes=${encodeURIComponent(sizes.join(','))}`;
+        
+        // One upload; the server encodes every format/size and streams back a ZIP
+        fetch(`/export-batch?${query}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'image/png'
+            },
+            body: blob
+        })
+        .then(response => {
+            if (response.ok) {
+                return response.blob();
+            } else {
+                throw new Error('Batch export failed');
+            }
+        })
+        .then(blob => {
+            const url = window.URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = 'template_ads.zip';
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
+            window.URL.revokeObjectURL(url);
+        })
+        .catch(error => {
+            console.error('Batch export error:', error);
+            alert('Export failed. Please try again.');
+        });
+    }
+    
     resetCanvas() {
         try {
             // Reset form values to defaults - only access elements that exist
@@ -3490,7 +3589,7 @@ class TemplateAdsEditor {
             this.loadTemplate(currentTemplate);
             
             // Preload default image for smooth transition
-            const defaultImagePath = 'static/images/default-placeholder.png';
+            const defaultImagePath = this.assetUrl('images/default-placeholder.png');
             fabric.Image.fromURL(defaultImagePath, (defaultImg) => {
                 if (defaultImg) {
                     // Store the preloaded image
@@ -4403,22 +4502,10 @@ class TemplateAdsEditor {
         });
     }
 
-    async useStockImage(imageUrl) {
-        try {
-            const response = await fetch(`/api/shutterstock/download?url=${encodeURIComponent(imageUrl)}`);
-            const data = await response.json();
-            
-            if (!response.ok) {
-                throw new Error(data.error || 'Download failed');
-            }
-            
-            // Add the stock image to canvas
-            this.addImageToCanvas(data.image_data, 'main');
-            
-        } catch (error) {
-            console.error('Stock image download error:', error);
-            alert('Failed to add image to canvas. Please try again.');
-        }
+    useStockImage(imageUrl) {
+        // Load through the caching preview proxy instead of a base64 JSON round-trip
+        const proxyUrl = `/api/shutterstock/preview?url=${encodeURIComponent(imageUrl)}`;
+        this.addImageToCanvas(proxyUrl, 'main');
     }
 
     async generateAIImage(prompt) {
@@ -4445,7 +4532,9 @@ class TemplateAdsEditor {
                 throw new Error(data.error || 'Generation failed');
             }
             
-            this.displayGeneratedImage(data.image_url);
+            // Generation runs as a background job; poll until it finishes
+            const job = await this.waitForJob(data.status_url);
+            this.displayGeneratedImage(job.image_url, job.preview_url);
             
         } catch (error) {
             console.error('AI generation error:', error);
@@ -4459,13 +4548,33 @@ class TemplateAdsEditor {
         }
     }
 
-    displayGeneratedImage(imageUrl) {
+    async waitForJob(statusUrl, timeoutMs = 180000) {
+        const deadline = Date.now() + timeoutMs;
+        let delay = 1000;
+        
+        while (Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            const response = await fetch(statusUrl, { cache: 'no-store' });
+            const job = await response.json();
+            
+            if (!response.ok || job.status === 'failed') {
+                throw new Error(job.error || 'Generation failed');
+            }
+            if (job.status === 'succeeded') {
+                return job;
+            }
+            delay = Math.min(delay * 1.5, 3000);
+        }
+        throw new Error('Generation timed out');
+    }
+
+    displayGeneratedImage(imageUrl, previewUrl = imageUrl) {
         const generateResults = document.getElementById('generateResults');
         
         const imageHTML = `
             <div class="generated-image-container">
-                <div class="generated-image-item" data-url="${imageUrl}">
-                    <img src="${imageUrl}" alt="Generated image" loading="lazy">
+                <div class="generated-image-item" data-url="${imageUrl}" data-preview-url="${previewUrl}">
+                    <img src="${previewUrl}" alt="Generated image" loading="lazy">
                     <div class="use-image-overlay">
                         <button class="use-image-btn">Use This Image</button>
                     </div>
@@ -4480,27 +4589,15 @@ class TemplateAdsEditor {
         if (generateItem) {
             generateItem.addEventListener('click', () => {
                 const imageUrl = generateItem.getAttribute('data-url');
-                this.useGeneratedImage(imageUrl);
+                const previewUrl = generateItem.getAttribute('data-preview-url');
+                this.useGeneratedImage(imageUrl, previewUrl);
             });
         }
     }
 
-    async useGeneratedImage(imageUrl) {
-        try {
-            // Convert image URL to base64 for canvas
-            const response = await fetch(imageUrl);
-            const blob = await response.blob();
-            
-            const reader = new FileReader();
-            reader.onload = () => {
-                this.addImageToCanvas(reader.result, 'main');
-            };
-            reader.readAsDataURL(blob);
-            
-        } catch (error) {
-            console.error('Generated image use error:', error);
-            alert('Failed to add image to canvas. Please try again.');
-        }
+    useGeneratedImage(imageUrl, previewUrl) {
+        // Generated images live in the upload store; edit on the preview like uploads
+        this.addImageToCanvas(previewUrl || imageUrl, 'main', imageUrl);
     }
 
     setupTextGeneration() {
@@ -4579,6 +4676,13 @@ class TemplateAdsEditor {
         generateButton.disabled = true;
         generateButton.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Generating...';
         
+        // Asking again for the same prompt means "regenerate": request the next
+        // variant, which the server usually has cached from the first call
+        const previous = this.lastTextGeneration;
+        const variant = previous && previous.prompt === prompt && previous.type === textType
+            ? previous.variant + 1
+            : 0;
+        
         try {
             const response = await fetch('/api/gemini/generate-text', {
                 method: 'POST',
@@ -4587,13 +4691,16 @@ class TemplateAdsEditor {
                 },
                 body: JSON.stringify({
                     prompt: prompt,
-                    type: textType
+                    type: textType,
+                    variant: variant
                 })
             });
 
             const data = await response.json();
 
             if (data.success) {
+                this.lastTextGeneration = { prompt: prompt, type: textType, variant: data.variant };
+                
                 // Update both title and subtitle fields with generated text
                 if (titleInput && data.title) {
                     titleInput.value = data.title;
@@ -0,0 +1,202 @@
+"""
+Background janitor for everything kept under UPLOAD_FOLDER
+
+Every worker runs a sweeper thread that wakes every half to whole
+`interval`. A sweep runs under an flock and is skipped when any worker
+finished one less than half an interval ago, so the workers take turns
+instead of repeating each other's work. A sweep:
+
+- evicts blobs by age and total size from each registered BlobStore
+- deletes temp files of crashed writers and refs to evicted blobs
+- moves files from before the blob store into the media store:
+  `generated_image_*.png` left by image generation requests that crashed
+  between write and delete, and uploads saved as `<uuid>.<ext>`. Each is
+  stored under a `legacy:<filename>` ref and only then removed, so from
+  there on the media store's own retention applies to it. Files that are
+  not images Pillow can read are left where they are.
+"""
+import os
+import re
+import json
+import time
+import fcntl
+import random
+import shutil
+import logging
+import tempfile
+import threading
+from PIL import Image
+from imaging import open_image
+from metrics import registry as metrics_registry
+
+logger = logging.getLogger(__name__)
+
+LEGACY_PATTERNS = (
+    re.compile(r'^generated_image_[0-9a-f]{8}\.png$'),
+    re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\.(png|jpe?g|gif|bmp|webp)$'),
+)
+
+storage_removed = metrics_registry.counter(
+    'storage_removed_files_total', 'Files deleted by the storage janitor', ('store', 'reason'))
+legacy_migrated = metrics_registry.counter(
+    'storage_legacy_migrated_total', 'Pre-blob-store files moved into the upload store by the storage janitor')
+
+
+def is_legacy_file(name):
+    return any(pattern.match(name) for pattern in LEGACY_PATTERNS)
+
+
+def legacy_metadata(path):
+    """Blob metadata for a legacy image from its header, or None if it is not an image within the budget"""
+    try:
+        with open_image(path) as image:
+            return {
+                'content_type': Image.MIME.get(image.format, 'application/octet-stream'),
+                'format': image.format,
+                'width': image.width,
+                'height': image.height
+            }
+    except Exception:
+        return None
+
+
+def legacy_ref(filename):
+    """Ref under which a migrated pre-blob-store file is kept"""
+    return f'legacy:{filename}'
+
+
+class StorageJanitor:
+    """
+    Sweeps the blob stores and migrates legacy files under one uploads folder
+
+    Legacy files are migrated into legacy_store once they are older than
+    legacy_min_age, so a worker still running the old code is never raced.
+    """
+
+    def __init__(self, folder, stores, interval=600, legacy_store=None, legacy_min_age=3600):
+        self.folder = folder
+        self.stores = dict(stores)
+        self.interval = interval
+        self.legacy_store = legacy_store
+        self.legacy_min_age = legacy_min_age
+        self.lock_path = os.path.join(folder, '.janitor.lock')
+        self.state_path = os.path.join(folder, '.janitor.json')
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start this process's sweeper thread; safe to call on every request"""
+        if not self.interval or (self._pid == os.getpid() and self._thread.is_alive()):
+            return
+        with self._start_lock:
+            # A preloaded app is forked after import; threads do not survive that
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='storage-janitor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # Jitter keeps workers started together from waking together
+            time.sleep(self.interval * random.uniform(0.5, 1))
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f'Storage sweep failed: {e}')
+
+    def last_sweep(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def sweep(self, force=False):
+        """Run one sweep unless a worker finished one within half an interval; returns its summary or None"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                previous = self.last_sweep()
+                if not force and previous and time.time() - previous['finished'] < self.interval * 0.5:
+                    return None
+                summary = self._sweep()
+                self._save_state(summary)
+                return summary
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sweep(self):
+        started = time.time()
+        summary = {'started': started, 'stores': {}}
+        for name, store in self.stores.items():
+            removed = {
+                'evicted': store.evict(),
+                'tmp': store.remove_stale_tmp(),
+                'refs': store.prune_refs(),
+            }
+            for reason, count in removed.items():
+                if count:
+                    storage_removed.inc(name, reason, amount=count)
+            summary['stores'][name] = removed
+        summary['legacy'] = self.migrate_legacy_files()
+        if summary['legacy']:
+            legacy_migrated.inc(amount=summary['legacy'])
+        summary['finished'] = time.time()
+        logger.info(f"Storage sweep took {summary['finished'] - started:.2f}s: {summary}")
+        return summary
+
+    def migrate_legacy_files(self):
+        """Move old enough legacy files into legacy_store; returns how many were moved"""
+        if self.legacy_store is None:
+            return 0
+        migrated = 0
+        now = time.time()
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not is_legacy_file(entry.name):
+                continue
+            try:
+                modified = entry.stat().st_mtime
+                if now - modified <= self.legacy_min_age:
+                    continue
+                metadata = legacy_metadata(entry.path)
+                if metadata is None:
+                    continue
+                metadata['created'] = modified
+                with open(entry.path, 'rb') as f, self.legacy_store.writer() as writer:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        writer.write(chunk)
+                    digest = writer.commit(metadata)
+                self.legacy_store.set_ref(legacy_ref(entry.name), digest)
+                os.remove(entry.path)
+                migrated += 1
+            except OSError as e:
+                logger.warning(f'Could not migrate {entry.name}: {e}')
+        return migrated
+
+    def _save_state(self, summary):
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(summary, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """Per-store usage, legacy files still present, disk space and the last sweep"""
+        disk = shutil.disk_usage(self.folder)
+        return {
+            'stores': {name: store.usage() for name, store in self.stores.items()},
+            'legacy_files': sum(1 for entry in os.scandir(self.folder) if entry.is_file() and is_legacy_file(entry.name)),
+            'disk': {'total': disk.total, 'used': disk.used, 'free': disk.free},
+            'sweep_interval': self.interval,
+            'last_sweep': self.last_sweep()
+        }
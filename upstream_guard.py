@@ -0,0 +1,287 @@
+"""
+Rate limits and circuit breakers for the external APIs, shared by all workers
+
+Every call to Shutterstock or Gemini first takes a token from its upstream's
+bucket (`<NAME>_RATE_LIMIT` calls per second, bursts of `<NAME>_RATE_BURST`;
+0 = unlimited). After `<NAME>_BREAKER_THRESHOLD` failures in a row
+(connection errors, timeouts, 429 and 5xx responses) the breaker opens and
+calls are refused without touching the network for `<NAME>_BREAKER_RESET`
+seconds. Then a single probe call is let through: success closes the
+breaker, failure opens it again.
+
+Refused calls raise UpstreamUnavailable with a Retry-After hint, so routes
+answer 503 at once or fall back to stale cached data instead of tying up a
+worker. With a state directory configured (UPSTREAM_STATE_FOLDER), bucket
+and breaker live in one small JSON file per upstream, read and written
+under an flock, so the limits hold for the whole machine rather than per
+worker.
+"""
+import os
+import json
+import time
+import fcntl
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from metrics import registry as metrics_registry
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+upstream_rejections = metrics_registry.counter(
+    'upstream_rejections_total', 'Calls refused by an upstream guard, by reason (open, rate_limited)', ('upstream', 'reason'))
+breaker_transitions = metrics_registry.counter(
+    'upstream_breaker_transitions_total', 'Circuit breaker state changes', ('upstream', 'state'))
+
+
+class UpstreamUnavailable(Exception):
+    """A call refused because the upstream's breaker is open or its rate limit is used up"""
+
+    def __init__(self, upstream, reason, retry_after):
+        super().__init__(f'{upstream} is unavailable ({reason}), retry in {retry_after:.1f}s')
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def http_status(error):
+    """HTTP status carried by an API error (google-genai's APIError.code, or an httpx/requests response), or None"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def is_failure_status(status):
+    """Responses that say the upstream is unhealthy or overloaded, rather than that the request was wrong"""
+    return status == 429 or status >= 500
+
+
+def is_upstream_failure(error):
+    """Whether an exception from a call should count against the breaker"""
+    status = http_status(error)
+    # No status: connection errors, timeouts and cancelled calls
+    return status is None or is_failure_status(status)
+
+
+class GuardedCall:
+    """One call through a guard; set failed for responses that did not raise"""
+
+    def __init__(self):
+        self.failed = False
+
+
+class UpstreamGuard:
+    """Token bucket and circuit breaker for one upstream"""
+
+    def __init__(self, name, rate=0, burst=None, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.directory = None
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def set_directory(self, directory):
+        """Keep state in directory, shared by every worker; None keeps it per process"""
+        self.directory = directory or None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _initial_state(self, now):
+        return {'state': CLOSED, 'failures': 0, 'opened_at': 0, 'probe_at': 0,
+                'tokens': float(self.burst), 'refilled_at': now}
+
+    @contextmanager
+    def _state(self, write=True):
+        """The current state dict, saved on exit when write is set"""
+        now = time.time()
+        if not self.directory:
+            with self._lock:
+                state = self._memory or self._initial_state(now)
+                yield state
+                if write:
+                    self._memory = state
+            return
+        path = os.path.join(self.directory, f'{self.name}.json')
+        with open(path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or 'null') or self._initial_state(now)
+                except ValueError:
+                    state = self._initial_state(now)
+                yield state
+                if write:
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _transition(self, state, new_state, now):
+        state['state'] = new_state
+        if new_state == OPEN:
+            state['opened_at'] = now
+        elif new_state == CLOSED:
+            state['failures'] = 0
+        breaker_transitions.inc(self.name, new_state)
+
+    def _refill(self, state, now):
+        if self.rate > 0:
+            elapsed = max(now - state['refilled_at'], 0)
+            state['tokens'] = min(float(self.burst), state['tokens'] + elapsed * self.rate)
+        state['refilled_at'] = now
+
+    def _reject(self, reason, retry_after):
+        upstream_rejections.inc(self.name, reason)
+        raise UpstreamUnavailable(self.name, reason, max(retry_after, 0.1))
+
+    def _open_retry_after(self, state, now):
+        """Seconds until the breaker lets a call through, or 0"""
+        if state['state'] == OPEN:
+            return state['opened_at'] + self.reset_timeout - now
+        if state['state'] == HALF_OPEN and now - state['probe_at'] < self.reset_timeout:
+            # A probe is in flight; it gets reset_timeout to finish before another is allowed
+            return state['probe_at'] + self.reset_timeout - now
+        return 0
+
+    def check(self):
+        """Raise UpstreamUnavailable while the breaker is open, without taking a token"""
+        now = time.time()
+        with self._state(write=False) as state:
+            retry_after = self._open_retry_after(state, now)
+        if retry_after > 0:
+            self._reject(OPEN, retry_after)
+
+    def acquire(self):
+        """Take a token and pass the breaker, or raise UpstreamUnavailable"""
+        now = time.time()
+        with self._state() as state:
+            retry_after = self._open_retry_after(state, now)
+            if retry_after > 0:
+                self._reject(OPEN, retry_after)
+            self._refill(state, now)
+            if self.rate > 0 and state['tokens'] < 1:
+                self._reject('rate_limited', (1 - state['tokens']) / self.rate)
+            if self.rate > 0:
+                state['tokens'] -= 1
+            if state['state'] != CLOSED:
+                # The reset timeout is over (or the last probe never reported): this call is the probe
+                if state['state'] == OPEN:
+                    self._transition(state, HALF_OPEN, now)
+                state['probe_at'] = now
+
+    def record(self, success):
+        """Report the outcome of a call let through by acquire()"""
+        now = time.time()
+        with self._state() as state:
+            if success:
+                if state['state'] == HALF_OPEN:
+                    self._transition(state, CLOSED, now)
+                elif state['state'] == CLOSED:
+                    state['failures'] = 0
+                return
+            state['failures'] += 1
+            if state['state'] == HALF_OPEN or (
+                    state['state'] == CLOSED and state['failures'] >= self.failure_threshold):
+                self._transition(state, OPEN, now)
+
+    @contextmanager
+    def call(self, is_failure=is_upstream_failure):
+        """
+        Guard one upstream call
+
+        Exceptions count as failures when is_failure says so; a call that
+        returned an error response sets `failed` on the yielded GuardedCall.
+        """
+        self.acquire()
+        call = GuardedCall()
+        try:
+            yield call
+        except BaseException as e:
+            call.failed = not isinstance(e, Exception) or is_failure(e)
+            raise
+        finally:
+            self.record(not call.failed)
+
+    async def _run(self, fn, *args):
+        # The shared state file is locked and rewritten on a thread, off the event loop
+        if self.directory:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    @asynccontextmanager
+    async def acall(self, is_failure=is_upstream_failure):
+        """call() for coroutines"""
+        await self._run(self.acquire)
+        call = GuardedCall()
+        try:
+            yield call
+        except BaseException as e:
+            call.failed = not isinstance(e, Exception) or is_failure(e)
+            raise
+        finally:
+            await self._run(self.record, not call.failed)
+
+    def stats(self):
+        """Breaker state, recent failures and the tokens left in the bucket"""
+        now = time.time()
+        with self._state(write=False) as state:
+            self._refill(state, now)
+            retry_after = self._open_retry_after(state, now)
+            return {
+                'state': state['state'],
+                'failures': state['failures'],
+                'opened_at': state['opened_at'] or None,
+                'retry_after': round(retry_after, 1) if retry_after > 0 else 0,
+                'tokens': round(state['tokens'], 2) if self.rate > 0 else None,
+                'rate': self.rate or None,
+                'burst': self.burst if self.rate > 0 else None,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout
+            }
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def guard_from_env(name, prefix, rate=0, burst=None, failure_threshold=5, reset_timeout=30):
+    """An UpstreamGuard whose defaults can be overridden through <prefix>_RATE_LIMIT and friends"""
+    return UpstreamGuard(
+        name,
+        rate=_env_float(f'{prefix}_RATE_LIMIT', rate),
+        burst=int(_env_float(f'{prefix}_RATE_BURST', burst or 0)) or None,
+        failure_threshold=int(_env_float(f'{prefix}_BREAKER_THRESHOLD', failure_threshold)),
+        reset_timeout=_env_float(f'{prefix}_BREAKER_RESET', reset_timeout)
+    )
+
+
+# Search and image details on the Shutterstock API
+shutterstock_guard = guard_from_env('shutterstock', 'SHUTTERSTOCK', rate=10, burst=20)
+# Preview images come from Shutterstock's CDN, which fails and scales independently of the API
+preview_guard = guard_from_env('shutterstock_previews', 'SHUTTERSTOCK_PREVIEW')
+# Text and image generation share one API key's quota
+gemini_guard = guard_from_env('gemini', 'GEMINI', rate=2, burst=10)
+
+GUARDS = {guard.name: guard for guard in (shutterstock_guard, preview_guard, gemini_guard)}
+
+
+def set_state_directory(directory):
+    """Share every guard's state through directory (the app points this at UPSTREAM_STATE_FOLDER)"""
+    for guard in GUARDS.values():
+        guard.set_directory(directory)
+
+
+def stats():
+    return {name: guard.stats() for name, guard in GUARDS.items()}